@@ -0,0 +1,130 @@
+"""This module contains an executor for running waveform analysis across multiple processes.
+
+Waveforms are passed to the worker processes through shared memory blocks rather than being pickled, and the workers
+write their scalar and array results directly into shared output buffers.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, Tuple, List
+
+import numpy as np
+
+from .data_model import Scan
+
+
+class AnalysisExecutor:
+    """A class that runs Scan.analyze_signals on blocks of waveforms in a pool of worker processes.
+
+    With workers <= 1 no processes are started and the analysis runs in the calling process.  Create one executor and
+    reuse it for many scans since starting the worker processes is expensive.
+    """
+
+    def __init__(self, workers: int = 1):
+        """Start the worker processes.
+
+        Args:
+            workers: The number of worker processes.  If less than two, analysis runs in the calling process.
+        """
+        self.workers = workers
+        self._pool = None
+        if workers > 1:
+            self._pool = ProcessPoolExecutor(max_workers=workers)
+
+    def __enter__(self) -> 'AnalysisExecutor':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    # pylint: disable=too-many-locals
+    def analyze_signals(self, matrix, sampling_rate=5000) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """Computes the same results as Scan.analyze_signals, splitting the rows across the worker processes.
+
+        Args:
+            matrix (np.array): A 2D array of shape (n_waveforms, 8192) with one waveform per row
+            sampling_rate (float): samping frequency represented by data in Hz
+
+        Returns:
+            Tuple[dict, dict]: dictionary of scalar statistical metrics where each value is an array of length
+                               n_waveforms, dictionary of arrays data where each value is a 2D array with one row per
+                               waveform (e.g. power spectrum array)
+        """
+        matrix = np.asarray(matrix)
+        if self._pool is None or matrix.ndim != 2 or matrix.shape[0] < 2:
+            return Scan.analyze_signals(matrix, sampling_rate=sampling_rate)
+        if not np.issubdtype(matrix.dtype, np.number):
+            raise ValueError("Input array must contain only numerical values.")
+
+        n_rows, n_samples = matrix.shape
+        # The workers analyze the input in the same dtype as the in process analysis and return results in that dtype
+        dtype = Scan.result_dtype(matrix.dtype)
+        # A one-sided periodogram of a real signal has n_samples/2 + 1 frequencies
+        n_freqs = n_samples // 2 + 1
+        shapes = {
+            'in': (n_rows, n_samples),
+            'scalars': (len(Scan.scalar_names), n_rows),
+            'arrays': (len(Scan.array_names), n_rows, n_freqs),
+        }
+
+        blocks = {}
+        try:
+            for key, shape in shapes.items():
+                size = int(np.prod(shape)) * dtype.itemsize
+                blocks[key] = shared_memory.SharedMemory(create=True, size=max(1, size))
+            np.ndarray(shapes['in'], dtype=dtype, buffer=blocks['in'].buf)[:] = matrix
+
+            names = {key: block.name for key, block in blocks.items()}
+            bounds = np.linspace(0, n_rows, min(self.workers, n_rows) + 1, dtype=int)
+            futures = [self._pool.submit(_analyze_block, names, shapes, dtype.str, start, stop, sampling_rate)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+
+            # Copy the results out of shared memory before the blocks are released
+            scalar_out = np.ndarray(shapes['scalars'], dtype=dtype, buffer=blocks['scalars'].buf).copy()
+            array_out = np.ndarray(shapes['arrays'], dtype=dtype, buffer=blocks['arrays'].buf).copy()
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+
+        scalars = dict(zip(Scan.scalar_names, scalar_out))
+        arrays = dict(zip(Scan.array_names, array_out))
+        return scalars, arrays
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def _analyze_block(names: Dict[str, str], shapes: Dict[str, Tuple[int, ...]], dtype: str, start: int, stop: int,
+                   sampling_rate: float):
+    """Analyze rows [start, stop) of the shared input matrix and write the results to the shared output buffers."""
+    blocks: List[shared_memory.SharedMemory] = []
+    views = {}
+    failed = True
+    try:
+        for key, name in names.items():
+            blocks.append(shared_memory.SharedMemory(name=name))
+            views[key] = np.ndarray(shapes[key], dtype=dtype, buffer=blocks[-1].buf)
+
+        scalars, arrays = Scan.analyze_signals(views['in'][start:stop], sampling_rate=sampling_rate)
+        for idx, name in enumerate(Scan.scalar_names):
+            views['scalars'][idx, start:stop] = scalars[name]
+        for idx, name in enumerate(Scan.array_names):
+            views['arrays'][idx, start:stop] = arrays[name]
+        failed = False
+    finally:
+        # The views must be released before the shared memory can be closed
+        views.clear()
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # The traceback of a failed analysis may still reference a view.  Raise the original error instead.
+                if not failed:
+                    raise
@@ -0,0 +1,330 @@
+"""This module contains opt-in caches of decoded query results.
+
+Scans are never modified after they are inserted, so the waveform data and metadata of a scan can be reused across
+queries and sessions.  QueryCache stores results on disk one entry per scan so that overlapping queries only fetch the
+scans that are not already cached.  Each entry is an uncompressed .npz file holding the row metadata as JSON and one
+array per row.  ArrayCache keeps recently used waveform arrays in memory for use within a single process.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Bump if the layout of a cache entry changes so that old entries are never read
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+DEFAULT_ARRAY_CACHE_BYTES = 512 * 1024 ** 2
+
+
+def fingerprint(**parts: Any) -> str:
+    """Generate a canonical hash of the keyword arguments.
+
+    Top-level lists, tuples and sets (signal names, filter terms, etc.) are sorted and de-duplicated since the results
+    of the database queries do not depend on their order.  Nested lists and tuples keep their order since their
+    positions matter, e.g., the name, operator and value of a filter term.  None is kept distinct from an empty list
+    since None typically means 'no filter'.
+
+    Returns:
+        The hex digest of the SHA-256 hash
+    """
+    text = json.dumps({key: _canonical(value) for key, value in parts.items()}, sort_keys=True,
+                      separators=(",", ":"), default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class QueryCache:
+    """A size-bounded, least recently used cache of query results stored in a local directory.
+
+    The cache is safe to share between threads.  Multiple processes may share a directory, but each keeps its own view
+    of the entries and their usage, so the size bound is only enforced per process.
+
+    Deleted scans are never returned by Query.stage(), so stale entries are harmless and are eventually evicted.  Call
+    clear() to reclaim the space immediately.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        """Open or create a cache directory.  Existing entries are reused.
+
+        Args:
+            path: The directory that holds the cache entries
+            max_bytes: The maximum total size of the entries in bytes.  The least recently used entries are removed
+                       once this is exceeded.
+        """
+        if max_bytes < 0:
+            raise ValueError("max_bytes must be non-negative")
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # key -> size in bytes ordered from least to most recently used
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._n_bytes = 0
+
+        os.makedirs(path, exist_ok=True)
+        files = []
+        for entry in os.scandir(path):
+            if entry.is_file() and entry.name.endswith(".npz"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._n_bytes += size
+        with self._lock:
+            self._evict()
+
+    def get_rows(self, kind: str, sids: Iterable[int], fetch: Callable[[List[int]], List[Dict[str, Any]]],
+                 **params: Any) -> List[Dict[str, Any]]:
+        """Get the rows of a per-scan query, fetching only the scans that are not cached.
+
+        Args:
+            kind: The type of results (e.g., waveform_data).  Part of the key.
+            sids: The scan IDs to get rows for
+            fetch: Queries the database for the rows of a list of sids.  Every row must have a 'sid' key.  Any numpy
+                   array values of the rows are stored as arrays, and the other values must be JSON serializable.
+            **params: The other query parameters that affect the results (signal names, array names, etc.).  Part of
+                      the key.
+
+        Returns:
+            The rows in order of sid
+        """
+        sids = sorted(set(sids))
+        keys = {sid: fingerprint(version=CACHE_FORMAT_VERSION, kind=kind, sid=sid, **params) for sid in sids}
+
+        results = {}
+        missing = []
+        for sid in sids:
+            rows = self._load(keys[sid])
+            if rows is None:
+                missing.append(sid)
+            else:
+                results[sid] = rows
+
+        with self._lock:
+            self.hits += len(results)
+            self.misses += len(missing)
+
+        if len(missing) > 0:
+            fetched = {sid: [] for sid in missing}
+            for row in fetch(missing):
+                fetched[row['sid']].append(row)
+            for sid, rows in fetched.items():
+                self._store(keys[sid], rows)
+            results.update(fetched)
+
+        out = []
+        for sid in sids:
+            out += results[sid]
+        return out
+
+    def stats(self) -> Dict[str, int | float]:
+        """Get the hit and miss statistics and the size of the cache.  Hits and misses are counted per scan."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+                "n_entries": len(self._entries),
+                "n_bytes": self._n_bytes,
+            }
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self._remove(key)
+
+    def _load(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """Read an entry.  Returns None if it does not exist."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+
+        filename = self._filename(key)
+        try:
+            with np.load(filename, allow_pickle=False) as npz:
+                rows = json.loads(str(npz['rows']))
+                for idx, row in enumerate(rows):
+                    for name in row.pop('__arrays__'):
+                        row[name] = npz[f"{idx}:{name}"]
+        except FileNotFoundError:
+            # Removed by another process sharing the directory
+            with self._lock:
+                if key in self._entries:
+                    self._n_bytes -= self._entries.pop(key)
+            return None
+
+        # Record the use for the next process that opens the cache
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            pass
+        return rows
+
+    def _store(self, key: str, rows: List[Dict[str, Any]]):
+        """Write an entry and evict old entries if the cache is over its size limit."""
+        arrays = {}
+        meta = []
+        for idx, row in enumerate(rows):
+            row_meta = {'__arrays__': []}
+            for name, value in row.items():
+                if isinstance(value, np.ndarray):
+                    arrays[f"{idx}:{name}"] = value
+                    row_meta['__arrays__'].append(name)
+                else:
+                    row_meta[name] = value.item() if isinstance(value, np.generic) else value
+            meta.append(row_meta)
+
+        # Write to a temporary file first so that readers never see a partial entry
+        fd, tmp_name = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, rows=np.array(json.dumps(meta)), **arrays)
+            os.replace(tmp_name, self._filename(key))
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+        size = os.path.getsize(self._filename(key))
+        with self._lock:
+            self._n_bytes += size - self._entries.get(key, 0)
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes.  Caller must hold the lock."""
+        while self._n_bytes > self.max_bytes and len(self._entries) > 0:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        """Remove an entry.  Caller must hold the lock."""
+        self._n_bytes -= self._entries.pop(key)
+        try:
+            os.unlink(self._filename(key))
+        except FileNotFoundError:
+            pass
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.npz")
+
+
+class ArrayCache:
+    """A memory-bounded, least recently used cache of decoded waveform arrays keyed on (wid, array name).
+
+    Used by WaveformDB.query_waveform_data.  The cached arrays are read-only and are shared by every row returned for
+    the same (wid, name), so copy an array before modifying it.  The cache is safe to share between threads.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_ARRAY_CACHE_BYTES):
+        """Create an empty cache.
+
+        Args:
+            max_bytes: The maximum total size of the cached arrays in bytes.  The least recently used arrays are
+                       removed once this is exceeded.
+        """
+        if max_bytes < 0:
+            raise ValueError("max_bytes must be non-negative")
+
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._arrays: OrderedDict[Tuple[int, str], np.ndarray] = OrderedDict()
+        self._n_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._arrays)
+
+    def get(self, wid: int, name: str) -> Optional[np.ndarray]:
+        """Get a cached array and count the hit or miss.  Returns None if the array is not cached."""
+        with self._lock:
+            data = self._arrays.get((wid, name))
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._arrays.move_to_end((wid, name))
+            return data
+
+    def put(self, wid: int, name: str, data: np.ndarray) -> np.ndarray:
+        """Add an array to the cache and evict old arrays if the cache is over its size limit.
+
+        Args:
+            wid: The unique id of the waveform
+            name: The name of the array
+            data: The decoded array.  It is made read-only.
+
+        Returns:
+            The cached, read-only array
+        """
+        data.flags.writeable = False
+        if data.nbytes > self.max_bytes:
+            return data
+
+        with self._lock:
+            old = self._arrays.pop((wid, name), None)
+            if old is not None:
+                self._n_bytes -= old.nbytes
+            self._arrays[(wid, name)] = data
+            self._n_bytes += data.nbytes
+            while self._n_bytes > self.max_bytes:
+                _, evicted = self._arrays.popitem(last=False)
+                self._n_bytes -= evicted.nbytes
+                self.evictions += 1
+        return data
+
+    def stats(self) -> Dict[str, int | float]:
+        """Get the hit and miss statistics and the size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+                "n_entries": len(self._arrays),
+                "n_bytes": self._n_bytes,
+            }
+
+    def clear(self):
+        """Remove every array from the cache."""
+        with self._lock:
+            self._arrays.clear()
+            self._n_bytes = 0
+
+
+def _canonical(value: Any, ordered: bool = False) -> Any:
+    """Convert a value to a JSON serializable form.
+
+    Args:
+        value: The value to convert
+        ordered: Whether the order of a list or tuple is significant.  Sets are always sorted.
+    """
+    if isinstance(value, (set, frozenset)) or (not ordered and isinstance(value, (list, tuple, np.ndarray))):
+        items = [_canonical(item, ordered=True) for item in value]
+        return sorted({json.dumps(item, sort_keys=True, default=str): item for item in items}.values(),
+                      key=lambda item: json.dumps(item, sort_keys=True, default=str))
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_canonical(item, ordered=True) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _canonical(item, ordered=True) for key, item in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
@@ -0,0 +1,216 @@
+"""This module contains the logic for converting waveform arrays to and from their database representation.
+
+Arrays were originally stored as JSON text lists.  The binary format stores a small fixed size header followed by the
+array values.  The header layout (little-endian) is:
+
+    magic (4 bytes, b"RFSA") | version (uint8) | codec id (uint8) | dtype id (uint8) | filter flags (uint8) |
+    length (uint32)
+
+The codec id names the (optional) compression applied to the payload and the filter flags name the lossless
+pre-filters that were applied before compression.  Readers detect the magic bytes and fall back to parsing legacy JSON
+rows, so databases holding a mix of formats can be read transparently.
+"""
+
+import json
+import lzma
+import struct
+import zlib
+from typing import Union, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    zstandard = None
+
+MAGIC = b"RFSA"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sBBBBI")
+
+# Codec ids describe how the array payload that follows the header is stored.
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+CODEC_IDS = {
+    None: CODEC_RAW,
+    "zlib": CODEC_ZLIB,
+    "lzma": CODEC_LZMA,
+    "zstd": CODEC_ZSTD,
+}
+
+# Filter flags are bit flags.  Delta is applied before shuffle when encoding.
+FILTER_SHUFFLE = 1
+FILTER_DELTA = 2
+FILTER_FLAGS = {
+    "shuffle": FILTER_SHUFFLE,
+    "delta": FILTER_DELTA,
+}
+
+# Map dtype ids to little-endian numpy dtypes
+DTYPES = {
+    1: np.dtype("<f4"),
+    2: np.dtype("<f8"),
+}
+DTYPE_IDS = {dtype: dtype_id for dtype_id, dtype in DTYPES.items()}
+
+
+class ArrayCodec:
+    """This class encodes numpy arrays into the versioned binary format stored in waveform_adata."""
+
+    def __init__(self, dtype: Union[str, np.dtype] = "float64", *, compression: Optional[str] = None,
+                 filters: Sequence[str] = (), level: Optional[int] = None):
+        """Construct a codec that will store arrays using the given data type and compression.
+
+        Args:
+            dtype: The floating point type used for storage.  Either float32 or float64.  float32 halves the storage
+                   size at the cost of precision.
+            compression: The lossless compression applied to the array bytes.  One of None, 'zlib', 'lzma', or
+                         'zstd'.  'zstd' requires the optional zstandard package.
+            filters: Lossless pre-filters applied before compression.  'delta' stores the difference between
+                     consecutive values (computed on their bit patterns so it is exact) and 'shuffle' groups the
+                     bytes of each value by significance.  Both help smooth waveforms compress.
+            level: The compression level.  If None, the compression library's default is used.
+        """
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        if self.dtype not in DTYPE_IDS:
+            raise ValueError(f"Unsupported dtype {dtype}.  Supported types are float32 and float64.")
+        if compression not in CODEC_IDS:
+            raise ValueError(f"Unsupported compression {compression}.  Supported are {list(CODEC_IDS.keys())}.")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package.")
+        for f in filters:
+            if f not in FILTER_FLAGS:
+                raise ValueError(f"Unsupported filter {f}.  Supported are {list(FILTER_FLAGS.keys())}.")
+
+        self.compression = compression
+        self.filters = tuple(filters)
+        self.level = level
+        self.codec_id = CODEC_IDS[compression]
+        self.filter_flags = 0
+        for f in self.filters:
+            self.filter_flags |= FILTER_FLAGS[f]
+
+    def encode(self, arr: np.ndarray) -> bytes:
+        """Encode a one dimensional array into a header plus (possibly filtered and compressed) little-endian bytes.
+
+        Args:
+            arr: The array to encode
+
+        Returns:
+            The binary representation of the array
+        """
+        arr = np.ascontiguousarray(arr, dtype=self.dtype)
+        if arr.ndim != 1:
+            raise ValueError(f"Only one dimensional arrays are supported.  Got {arr.ndim} dimensions.")
+
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, self.codec_id, DTYPE_IDS[self.dtype], self.filter_flags,
+                             len(arr))
+        payload = _apply_filters(arr, self.filter_flags)
+        return header + _compress(payload, self.codec_id, self.level)
+
+    def __repr__(self) -> str:
+        return (f"ArrayCodec(dtype='{self.dtype.name}', compression={self.compression!r}, filters={self.filters!r}, "
+                f"level={self.level!r})")
+
+
+def encode_json(arr: np.ndarray) -> str:
+    """Encode an array using the legacy JSON text list format."""
+    return json.dumps(np.asarray(arr).tolist())
+
+
+def is_binary(data: Union[str, bytes, bytearray]) -> bool:
+    """Check if a stored array value uses the binary format rather than the legacy JSON format."""
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def read_header(data: Union[bytes, bytearray]) -> Tuple[int, np.dtype, int, int]:
+    """Read and validate the header of a binary array.
+
+    Args:
+        data: A binary array value (or at least its first HEADER.size bytes)
+
+    Returns:
+        The codec id, dtype, filter flags, and number of elements of the array
+    """
+    _, version, codec_id, dtype_id, filter_flags, length = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported array format version {version}")
+    if codec_id not in CODEC_IDS.values():
+        raise ValueError(f"Unsupported array codec id {codec_id}")
+    if dtype_id not in DTYPES:
+        raise ValueError(f"Unsupported array dtype id {dtype_id}")
+    return codec_id, DTYPES[dtype_id], filter_flags, length
+
+
+def decode_array(data: Union[str, bytes, bytearray]) -> np.ndarray:
+    """Decode an array stored in either the binary format or the legacy JSON format.
+
+    Uncompressed binary arrays are decoded without copying, so the returned array may be read-only.
+
+    Args:
+        data: The value of a waveform_adata.data column
+
+    Returns:
+        The decoded array
+    """
+    if not is_binary(data):
+        return np.array(json.loads(data))
+
+    codec_id, dtype, filter_flags, length = read_header(data)
+    if codec_id == CODEC_RAW and filter_flags == 0:
+        return np.frombuffer(data, dtype=dtype, count=length, offset=HEADER.size)
+
+    payload = _decompress(memoryview(data)[HEADER.size:], codec_id)
+    return _remove_filters(payload, dtype, length, filter_flags)
+
+
+def _apply_filters(arr: np.ndarray, filter_flags: int) -> bytes:
+    """Apply the pre-compression filters to a little-endian array and return its bytes."""
+    if filter_flags & FILTER_DELTA:
+        # Work on the bit patterns so that the round trip is exact.  Unsigned integer arithmetic wraps around.
+        ints = arr.view(f"<u{arr.itemsize}")
+        arr = np.empty_like(ints)
+        arr[:1] = ints[:1]
+        np.subtract(ints[1:], ints[:-1], out=arr[1:])
+
+    if filter_flags & FILTER_SHUFFLE:
+        return arr.view(np.uint8).reshape(len(arr), arr.itemsize).T.tobytes()
+    return arr.tobytes()
+
+
+def _remove_filters(payload: bytes, dtype: np.dtype, length: int, filter_flags: int) -> np.ndarray:
+    """Undo the pre-compression filters and return the decoded array."""
+    if filter_flags & FILTER_SHUFFLE:
+        arr = np.frombuffer(payload, dtype=np.uint8).reshape(dtype.itemsize, length).T.copy().view(dtype).ravel()
+    else:
+        arr = np.frombuffer(payload, dtype=dtype, count=length)
+
+    if filter_flags & FILTER_DELTA:
+        arr = np.cumsum(arr.view(f"<u{dtype.itemsize}"), dtype=f"<u{dtype.itemsize}").view(dtype)
+    return arr
+
+
+def _compress(payload: bytes, codec_id: int, level: Optional[int]) -> bytes:
+    """Compress the array payload with the given codec."""
+    if codec_id == CODEC_ZLIB:
+        return zlib.compress(payload, -1 if level is None else level)
+    if codec_id == CODEC_LZMA:
+        return lzma.compress(payload, preset=level)
+    if codec_id == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(payload)
+    return payload
+
+
+def _decompress(payload: memoryview, codec_id: int) -> bytes:
+    """Decompress the array payload with the given codec."""
+    if codec_id == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    if codec_id == CODEC_LZMA:
+        return lzma.decompress(payload)
+    if codec_id == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Decoding zstd compressed arrays requires the zstandard package.")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return bytes(payload)
@@ -1,18 +1,31 @@
 """A package for interacting with data at a more tractable level"""
 
-import json
+import warnings
 from datetime import datetime
-from typing import Optional, Dict, Tuple, Any, List
+from typing import Optional, Dict, Tuple, Any, List, Iterator, Sequence, TYPE_CHECKING
 
 import mysql.connector
-from mysql.connector.cursor import MySQLCursor
 import numpy as np
 import pandas as pd
 from numpy import ndarray
 from scipy.signal import periodogram
 
-from .db import WaveformDB, QueryFilter
-from .utils import get_datetime_as_utc
+from . import export
+from .cache import QueryCache
+from .codec import ArrayCodec, encode_json
+from .db import WaveformDB, QueryFilter, WaveformMetricFilter, DEFAULT_PAGE_SIZE, WAVEFORM_FIELDS
+from .utils import get_datetime_as_utc, get_frequency_range
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from .analysis import AnalysisExecutor
+
+# Query.estimate warns when a query would transfer more array data than this
+DEFAULT_WARN_BYTES = 4 * 1024 ** 3
+
+
+class QuerySizeWarning(UserWarning):
+    """Issued when a query is estimated to transfer more data than expected."""
 
 
 class Scan:
@@ -22,6 +35,16 @@ class Scan:
     additional data related to system state at the time of the scan.
     """
 
+    # The names of the scalar metrics and arrays produced by analyze_signals
+    scalar_names = ("minimum", "maximum", "peak_to_peak", "mean", "median", "standard_deviation", "rms",
+                    "25th_quartile", "75th_quartile", "dominant_frequency")
+    array_names = ("power_spectrum",)
+
+    # The number of (min, max) buckets of each min/max envelope stored when envelopes are requested.  Each must evenly
+    # divide the number of samples.
+    envelope_levels = (64, 256, 1024)
+    envelope_prefix = "envelope_"
+
     def __init__(self, start: datetime, end: datetime, sid: Optional[int] = None):
         """Construct an instance and initialize data attributes
 
@@ -81,139 +104,155 @@ class Scan:
         self.scan_data_float.update(float_data)
         self.scan_data_str.update(str_data)
 
-    def add_cavity_data(self, cavity: str, data: Dict[str, np.array], sampling_rate: float):
+    def add_cavity_data(self, cavity: str, data: Dict[str, np.array], sampling_rate: float,
+                        executor: Optional['AnalysisExecutor'] = None, *,
+                        envelope_levels: Optional[Sequence[int]] = None):
         """Add waveform data to this scan for a given cavity.  Analysis of the waveform values are done here.
 
         Args:
             cavity: The name of the cavity ("R123")
             data: Dictionary keyed on signal name ("Time", "GMES", etc.) with numpy arrays containing signal data
             sampling_rate: The sampling rate of the data given in Hertz (e.g. 5000 for 5 kHz).
+            executor: An optional executor used to run the analysis in worker processes.
+            envelope_levels: If given, also store min/max envelopes with these numbers of buckets.  See
+                             compute_envelopes.
         """
-        self.waveform_data[cavity] = data
-        self.analysis_scalar[cavity] = {}
-        self.analysis_array[cavity] = {}
-        self.sampling_rate[cavity] = sampling_rate
-
-        for signal_name in data.keys():
-            # Time is reflected in the sampling rate and can be ignored for analysis purposes
-            if signal_name == "Time":
-                continue
+        self.add_scan_waveforms({cavity: data}, sampling_rate, executor=executor, envelope_levels=envelope_levels)
 
-            scalars, arrays = self.analyze_signal(data[signal_name], sampling_rate=sampling_rate)
-            self.analysis_scalar[cavity][signal_name] = scalars
+    # pylint: disable=too-many-locals
+    def add_scan_waveforms(self, data: Dict[str, Dict[str, np.array]], sampling_rate: float | Dict[str, float],
+                           executor: Optional['AnalysisExecutor'] = None,
+                           envelope_levels: Optional[Sequence[int]] = None):
+        """Add waveform data for many cavities at once.  All waveforms sharing a sampling rate are analyzed together.
 
-            self.analysis_array[cavity][signal_name] = {}
-            for arr_name, array in arrays.items():
-                self.analysis_array[cavity][signal_name][arr_name] = array
-
-    def insert_data(self, conn: mysql.connector.MySQLConnection):
+        Args:
+            data: Dictionary keyed on cavity name whose values are dictionaries keyed on signal name ("Time", "GMES",
+                  etc.) with numpy arrays containing signal data.
+            sampling_rate: The sampling rate of the data given in Hertz (e.g. 5000 for 5 kHz).  Either a single value
+                           for every cavity or a dictionary keyed on cavity name.
+            executor: An optional executor used to run the analysis in worker processes.
+            envelope_levels: If given, also store min/max envelopes with these numbers of buckets next to the raw
+                             arrays, e.g., Scan.envelope_levels.  See compute_envelopes.
+        """
+        analyze_signals = self.analyze_signals if executor is None else executor.analyze_signals
+
+        if not isinstance(sampling_rate, dict):
+            sampling_rate = {cavity: sampling_rate for cavity in data.keys()}
+
+        # Group the waveforms by sampling rate so each group can be analyzed in a single call.
+        groups = {}
+        for cavity, cav_data in data.items():
+            self.waveform_data[cavity] = cav_data
+            self.analysis_scalar[cavity] = {}
+            self.analysis_array[cavity] = {}
+            self.sampling_rate[cavity] = sampling_rate[cavity]
+
+            for signal_name in cav_data.keys():
+                # Time is reflected in the sampling rate and can be ignored for analysis purposes
+                if signal_name == "Time":
+                    continue
+                groups.setdefault(sampling_rate[cavity], []).append((cavity, signal_name))
+
+        for rate, keys in groups.items():
+            matrix = np.vstack([data[cavity][signal_name] for cavity, signal_name in keys])
+            scalars, arrays = analyze_signals(matrix, sampling_rate=rate)
+            if envelope_levels is not None and len(envelope_levels) > 0:
+                # Cheap reductions, so they run here rather than in the executor's worker processes
+                arrays = {**arrays, **self.compute_envelopes(matrix, envelope_levels)}
+
+            for idx, (cavity, signal_name) in enumerate(keys):
+                self.analysis_scalar[cavity][signal_name] = {name: values[idx] for name, values in scalars.items()}
+                self.analysis_array[cavity][signal_name] = {name: values[idx] for name, values in arrays.items()}
+
+    def insert_data(self, conn: mysql.connector.MySQLConnection, array_codec: Optional[ArrayCodec] = None):
         """Insert all data related to this Scan into the database
 
         Args:
             conn: Connection to the database
+            array_codec: The codec used to store waveform arrays.  If None, the legacy JSON text format is used.
         """
+        WaveformDB.write_scans(conn, [self], array_codec=array_codec)
+
+    def get_scan_row(self) -> Tuple[str, str]:
+        """Get the (scan_start_utc, scan_end_utc) values for this scan's row in the scan table."""
         fmt = '%Y-%m-%d %H:%M:%S.%f'
         start_time = get_datetime_as_utc(self.start)
         end_time = get_datetime_as_utc(self.end)
-        cursor = None
-        try:
-            # Transaction started by default since autocommit is off.
-            cursor = conn.cursor()
-            # Note: execute and executemany do sanitation and prepared statements internally.
-            cursor.execute("INSERT INTO scan (scan_start_utc, scan_end_utc)  VALUES (%s, %s)",
-                           (start_time.strftime(fmt), end_time.strftime(fmt)))
-            cursor.execute("SELECT LAST_INSERT_ID()")
-            sid = cursor.fetchone()[0]
-
-            for cav, data in self.waveform_data.items():
-                for signal_name in data:
-                    if signal_name == "Time":
-                        continue
-                    wid = self._insert_waveform(cursor, sid, cav, signal_name)
-                    self._insert_waveform_adata(cursor, wid, cav, signal_name)
-                    self._insert_waveform_sdata(cursor, wid, cav, signal_name)
-
-            self._insert_scan_fdata(cursor, sid)
-            self._insert_scan_sdata(cursor, sid)
-
-            # Commit the transaction if we were able to successfully insert all the data.  Otherwise, an exception
-            # should have been raised that was caught to roll back the transaction.
-            conn.commit()
-        except (mysql.connector.Error, Exception) as e:
-            if conn is not None:
-                # There was a problem so this should roll back the entire transaction across all the tables.
-                conn.rollback()
-            if cursor is not None:
-                cursor.close()
-
-            raise e
-
-    def _insert_waveform(self, cursor: MySQLCursor, sid: int, cav: str, signal_name: str) -> int:
-        """Insert a waveform into the database and return it's wid key."""
-        cursor.execute("INSERT INTO waveform(sid, cavity, signal_name, sample_rate_hz) VALUES (%s, %s, %s, %s)",
-                       (sid, cav, signal_name, self.sampling_rate[cav]))
-        cursor.execute("SELECT LAST_INSERT_ID()")
-        return cursor.fetchone()[0]
-
-    def _insert_waveform_adata(self, cursor: MySQLCursor, wid: int, cav: str, signal_name: str):
-        """Insert the waveform array data to the database.
+        return start_time.strftime(fmt), end_time.strftime(fmt)
+
+    def get_waveform_keys(self) -> List[Tuple[str, str]]:
+        """Get the (cavity, signal_name) pairs of every waveform that will be stored for this scan."""
+        keys = []
+        for cav, data in self.waveform_data.items():
+            for signal_name in data:
+                # Time is reflected in the sampling rate and is not stored as a waveform
+                if signal_name == "Time":
+                    continue
+                keys.append((cav, signal_name))
+        return keys
+
+    def get_waveform_row(self, sid: int, cav: str, signal_name: str) -> Tuple[int, str, str, float]:
+        """Get the (sid, cavity, signal_name, sample_rate_hz) values for a waveform's row in the waveform table.
+
+        Args:
+            sid: The unique database scan ID
+            cav: The name of the cavity ("R123")
+            signal_name: The name of the signal ("GMES")
+        """
+        return sid, cav, signal_name, self.sampling_rate[cav]
+
+    def get_waveform_adata_rows(self, wid: int, cav: str, signal_name: str, array_codec: Optional[ArrayCodec] = None
+                                ) -> List[Tuple[int, str, str | bytes]]:
+        """Get the (wid, name, data) values of the waveform array data.
 
         Args:
-            cursor: A database cursor
             wid: The unique id of the waveform
             cav: The name of the cavity ("R123")
             signal_name: The name of the signal ("GMES")
+            array_codec: The codec used to encode the arrays.  If None, the legacy JSON text format is used.
         """
+        encode = encode_json if array_codec is None else array_codec.encode
+
         # Append the array data for the waveform.  'raw' is not an analytical waveform and needs to be done separately
-        array_data = [(wid, "raw", json.dumps(self.waveform_data[cav][signal_name].tolist()))]
+        array_data = [(wid, "raw", encode(self.waveform_data[cav][signal_name]))]
         for arr_name in self.analysis_array[cav][signal_name].keys():
-            array_data.append(
-                (wid, arr_name, json.dumps(self.analysis_array[cav][signal_name][arr_name].tolist())))
-
-        cursor.executemany("INSERT INTO waveform_adata (wid, name, data) VALUES (%s, %s, %s)",
-                           array_data)
+            array_data.append((wid, arr_name, encode(self.analysis_array[cav][signal_name][arr_name])))
+        return array_data
 
-    def _insert_waveform_sdata(self, cursor: MySQLCursor, wid: int, cav: str, signal_name: str):
-        """Insert the waveform scalar data to the database.
+    def get_waveform_sdata_rows(self, wid: int, cav: str, signal_name: str) -> List[Tuple[int, str, float]]:
+        """Get the (wid, name, value) values of the waveform scalar data.
 
         Args:
-            cursor: A database cursor
             wid: The unique id of the waveform
             cav: The name of the cavity ("R123")
             signal_name: The name of the signal ("GMES")
         """
-
         data = []
         for metric_name, value in self.analysis_scalar[cav][signal_name].items():
             data.append((wid, metric_name, value))
-        cursor.executemany("INSERT INTO waveform_sdata (wid, name, value) VALUES (%s, %s, %s)", data)
+        return data
 
-    def _insert_scan_fdata(self, cursor: MySQLCursor, sid: int):
-        """Insert the float data associated with this scan into the database.
+    def get_scan_fdata_rows(self, sid: int) -> List[Tuple[int, str, float]]:
+        """Get the (sid, name, value) values of the float data associated with this scan.
 
         Args:
-            cursor: A database cursor
             sid: The unique database scan ID
         """
         data = []
         for key, value in self.scan_data_float.items():
             data.append((sid, key, value))
+        return data
 
-        if len(data) > 0:
-            cursor.executemany("INSERT INTO scan_fdata (sid, name, value) VALUES (%s, %s, %s)", data)
-
-    def _insert_scan_sdata(self, cursor: MySQLCursor, sid: int):
-        """Insert the string data associated with this scan into the database.
+    def get_scan_sdata_rows(self, sid: int) -> List[Tuple[int, str, str]]:
+        """Get the (sid, name, value) values of the string data associated with this scan.
 
         Args:
-            cursor: A database cursor
             sid: The unique database scan ID
         """
         data = []
         for key, value in self.scan_data_str.items():
             data.append((sid, key, value))
-        if len(data) > 0:
-            cursor.executemany("INSERT INTO scan_sdata (sid, name, value) VALUES (%s, %s, %s)", data)
+        return data
 
     @staticmethod
     def analyze_signal(arr, sampling_rate=5000) -> Tuple[dict, dict]:
@@ -232,40 +271,133 @@ class Scan:
         if not isinstance(arr, (list, np.ndarray, tuple)):
             raise TypeError(f"Input must be a list, numpy array, or tuple. Not {type(arr)}")
 
-        arr = np.array(arr)
+        arr = np.asarray(arr)
+        if arr.ndim != 1:
+            raise ValueError(f"Input array must be one dimensional. Got {arr.ndim} dimensions.")
+
+        scalars, arrays = Scan.analyze_signals(arr[np.newaxis, :], sampling_rate=sampling_rate)
+        scalars = {name: values[0] for name, values in scalars.items()}
+        arrays = {name: values[0] for name, values in arrays.items()}
+
+        return scalars, arrays
+
+    @staticmethod
+    def analyze_signals(matrix, sampling_rate=5000) -> Tuple[Dict[str, ndarray], Dict[str, ndarray]]:
+        """Computes basic statistical metrics and power spectrum for many waveforms of length 8192 samples at once.
 
-        if not np.issubdtype(arr.dtype, np.number):
+        Each statistic is computed with a single reduction along the sample axis and every power spectrum is computed
+        with a single periodogram call.
+
+        Args:
+            matrix (np.array): A 2D array of shape (n_waveforms, 8192) with one waveform per row
+            sampling_rate (float): samping frequency represented by data in Hz
+
+        Returns:
+            Tuple[dict, dict]: dictionary of scalar statistical metrics where each value is an array of length
+                               n_waveforms, dictionary of arrays data where each value is a 2D array with one row per
+                               waveform (e.g. power spectrum array).  Every value has the dtype given by
+                               result_dtype(matrix.dtype).
+        """
+        matrix = np.asarray(matrix)
+
+        if not np.issubdtype(matrix.dtype, np.number):
             raise ValueError("Input array must contain only numerical values.")
+        dtype = Scan.result_dtype(matrix.dtype)
+        matrix = matrix.astype(dtype, copy=False)
 
-        if len(arr) != 8192:
-            raise ValueError(f"Input array must have exactly 8192 elements. Got {len(arr)} elements.")
+        if matrix.ndim != 2:
+            raise ValueError(f"Input matrix must be two dimensional. Got {matrix.ndim} dimensions.")
+
+        if matrix.shape[1] != 8192:
+            raise ValueError(f"Input array must have exactly 8192 elements. Got {matrix.shape[1]} elements.")
 
         # basic statistics
-        min_val = np.min(arr)
-        max_val = np.max(arr)
+        min_val = np.min(matrix, axis=1)
+        max_val = np.max(matrix, axis=1)
+        mean = np.mean(matrix, axis=1)
+
+        # A single partitioning pass for all the quantiles.  Same (linear) interpolation as np.median/np.percentile.
+        q25, median, q75 = np.quantile(matrix, [0.25, 0.5, 0.75], axis=1)
 
         # power spectrum analysis using Welch's method
-        f, pxx_den = periodogram(arr, sampling_rate)
+        f, pxx_den = periodogram(matrix, sampling_rate, axis=1)
 
         # noinspection PyUnresolvedReferences
         scalars = {
             "minimum": min_val,
             "maximum": max_val,
             "peak_to_peak": max_val - min_val,
-            "mean": np.mean(arr),
-            "median": np.median(arr),
-            "standard_deviation": np.std(arr),
-            "rms": np.sqrt(np.mean(np.square(arr))),
-            "25th_quartile": np.percentile(arr, 25),
-            "75th_quartile": np.percentile(arr, 75),
-            "dominant_frequency": f[np.argmax(pxx_den)]
+            "mean": mean,
+            "median": median,
+            "standard_deviation": np.std(matrix, axis=1),
+            "rms": np.sqrt(np.mean(np.square(matrix), axis=1)),
+            "25th_quartile": q25,
+            "75th_quartile": q75,
+            "dominant_frequency": f[np.argmax(pxx_den, axis=1)]
         }
         arrays: dict[str, ndarray] = {
             "power_spectrum": pxx_den
         }
 
+        # Some reductions (e.g., quantiles and the frequencies) are computed in float64
+        scalars = {name: values.astype(dtype, copy=False) for name, values in scalars.items()}
+        arrays = {name: values.astype(dtype, copy=False) for name, values in arrays.items()}
         return scalars, arrays
 
+    @staticmethod
+    def result_dtype(dtype: np.dtype) -> np.dtype:
+        """Get the dtype of the results of analyze_signals for an input dtype.
+
+        float32 and float64 inputs are analyzed in their own precision.  Any other numerical input is analyzed as
+        float64.
+        """
+        dtype = np.dtype(dtype)
+        if dtype in (np.dtype(np.float32), np.dtype(np.float64)):
+            return dtype
+        return np.dtype(np.float64)
+
+    @staticmethod
+    def envelope_name(level: int) -> str:
+        """Get the array name of the min/max envelope with level buckets."""
+        return f"{Scan.envelope_prefix}{level}"
+
+    @staticmethod
+    def compute_envelopes(matrix, levels: Sequence[int] = envelope_levels) -> Dict[str, ndarray]:
+        """Computes min/max envelopes of many waveforms at several decimation levels.
+
+        Each waveform is split into level equal buckets and the minimum and maximum of each bucket are interleaved as
+        [min_0, max_0, min_1, max_1, ...].  Plotting each pair as a vertical segment draws every peak of the waveform at
+        a fraction of the size.  Coarser levels are reduced from finer ones when they divide evenly.
+
+        Args:
+            matrix (np.array): A 2D array with one waveform per row
+            levels: The number of buckets of each envelope.  Each must evenly divide the number of samples.
+
+        Returns:
+            A dictionary keyed on envelope name (see envelope_name) of 2D arrays with one row of 2 * level values per
+            waveform
+        """
+        matrix = np.asarray(matrix)
+        if matrix.ndim != 2:
+            raise ValueError(f"Input matrix must be two dimensional. Got {matrix.ndim} dimensions.")
+        n_rows, n_samples = matrix.shape
+
+        out = {}
+        # (level, mins, maxs) of the finest envelope computed so far
+        finer = (n_samples, matrix, matrix)
+        for level in sorted(set(levels), reverse=True):
+            if level < 1 or n_samples % level != 0:
+                raise ValueError(f"Envelope level {level} must evenly divide the {n_samples} samples.")
+            if finer[0] % level != 0:
+                finer = (n_samples, matrix, matrix)
+            width = finer[0] // level
+            mins = finer[1].reshape(n_rows, level, width).min(axis=2)
+            maxs = finer[2].reshape(n_rows, level, width).max(axis=2)
+            out[Scan.envelope_name(level)] = np.stack([mins, maxs], axis=2).reshape(n_rows, 2 * level)
+            finer = (level, mins, maxs)
+
+        return out
+
     @staticmethod
     def row_to_scan(row: Dict[str, Any]) -> 'Scan':
         """Take a singe database row result and generates a Scan object from it.  Expects rows as dictionaries.
@@ -279,6 +411,7 @@ class Scan:
         return Scan(start=row['scan_start_utc'].astimezone(), end=row['scan_end_utc'], sid=row['sid'])
 
 
+# pylint: disable=too-many-instance-attributes
 class Query:
     """This class is responsible for running queries of waveform data against the database.
 
@@ -291,10 +424,16 @@ class Query:
     scan_meta: None | pd.DataFrame
     wf_data: None | pd.DataFrame
     wf_meta: None | pd.DataFrame
+    wf_matrices: None | Dict[str, np.ndarray]
+    wf_matrix_meta: None | Dict[str, pd.DataFrame]
+    frequency_axes: Dict[float, np.ndarray]
 
+    # pylint: disable=too-many-arguments
     def __init__(self, db: WaveformDB, signal_names: List[str], *, array_names: Optional[List[str]] = None,
                  begin: Optional[datetime] = None, end: Optional[datetime] = None, scan_filter: QueryFilter = None,
-                 wf_metric_names: Optional[List[str]] = None):
+                 wf_metric_names: Optional[List[str]] = None, cache: Optional[QueryCache] = None,
+                 columns: Optional[Sequence[str]] = None, pixel_width: Optional[int] = None,
+                 cavities: Optional[Sequence[str]] = None, metric_filter: Optional[WaveformMetricFilter] = None):
         """Construct a query object with the information needed to query scan and waveform data.
 
         Args:
@@ -310,58 +449,364 @@ class Query:
              scan_filter: An object used to filter out scans based on metadata criteria.
              wf_metric_names: A list of scalar metrics related to a waveform that will be included if they exist in the
                               database.
+             cache: A local cache of query results.  If given, run() only queries the database for scans that are not
+                    already cached.
+             columns: The waveform-level fields (see db.WAVEFORM_FIELDS) to include in wf_data, wf_meta and the
+                      matrix metadata.  wid and sid are always included.  If None, all are included.  The frequency
+                      axes require sample_rate_hz.  The Arrow and Parquet exports always include every field.
+             pixel_width: The width in pixels of the plot the waveforms are for.  If given, stage() replaces the raw
+                          arrays with the coarsest stored min/max envelope (see Scan.compute_envelopes) that has at
+                          least this many buckets for every waveform, or keeps raw if there is none.
+             cavities: The cavity names or glob patterns (e.g. "2L22*" for every cavity in zone 2L22) to include.  Other
+                       cavities are filtered out by the database instead of being transferred.  If None, all cavities
+                       are included.
+             metric_filter: An object used to filter out scans based on the scalar metrics of their waveforms, e.g.,
+                            only scans whose 1L10-3 GMES rms is above 0.2.  Evaluated by the database during stage().
             """
+        if columns is not None:
+            unknown = [column for column in columns if column not in WAVEFORM_FIELDS]
+            if len(unknown) > 0:
+                raise ValueError(f"Unknown waveform columns {unknown}.  Supported columns are {WAVEFORM_FIELDS}.")
+            # The cache groups rows by sid
+            columns = tuple(column for column in WAVEFORM_FIELDS if column == "sid" or column in columns)
+
+        if pixel_width is not None and pixel_width < 1:
+            raise ValueError("pixel_width must be positive.")
 
         self.db = db
         self.signal_names = signal_names
         self.array_names = array_names
+        self.requested_array_names = array_names
+        self.pixel_width = pixel_width
+        self.cavities = None if cavities is None else list(cavities)
         self.begin = begin
         self.end = end
         self.scan_filter = scan_filter
+        self.metric_filter = metric_filter
         self.wf_metric_names = wf_metric_names
+        self.cache = cache
+        self.columns = columns
 
         self.staged = False
         self.scan_meta = None
         self.wf_data = None
         self.wf_meta = None
+        self.wf_matrices = None
+        self.wf_matrix_meta = None
+        self.frequency_axes = {}
 
     def stage(self):
         """Perform the initial query to determine which scans meet the requested criteria."""
 
-        scan_rows = self.db.query_scan_rows(begin=self.begin, end=self.end, q_filter=self.scan_filter)
-        self.scan_meta = pd.DataFrame(scan_rows, index=None)
+        self.scan_meta = self.db.query_scan_frame(begin=self.begin, end=self.end, q_filter=self.scan_filter,
+                                                  metric_filter=self.metric_filter)
+        self.array_names = self.requested_array_names
+        if self.pixel_width is not None and len(self.scan_meta) > 0:
+            self.array_names = self._resolve_envelope(self.scan_meta.sid.values.tolist())
         self.staged = True
 
+    def _resolve_envelope(self, sids: List[int]) -> Optional[List[str]]:
+        """Replace raw in the requested array names with the coarsest envelope that is wide enough for pixel_width.
+
+        Args:
+            sids: The staged scans.  Every matching waveform must have the envelope for it to be used.
+
+        Returns:
+            The array names to query
+        """
+        requested = self.requested_array_names
+        if requested is not None and "raw" not in requested:
+            return requested
+
+        counts = self.db.count_waveform_data(sids, signal_names=self.signal_names, array_names=None,
+                                             cavities=self.cavities)
+        prefix = Scan.envelope_prefix
+        levels = sorted(int(name[len(prefix):]) for name in counts
+                        if name.startswith(prefix) and name[len(prefix):].isdigit())
+        chosen = "raw"
+        for level in levels:
+            if level >= self.pixel_width and counts[Scan.envelope_name(level)] >= counts.get("raw", 0):
+                chosen = Scan.envelope_name(level)
+                break
+
+        if requested is None:
+            # Everything but the raw arrays and the other envelopes
+            return [name for name in counts if name != "raw" and not name.startswith(prefix)] + [chosen]
+        return [chosen if name == "raw" else name for name in requested]
+
+    def iter_scan_pages(self, page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[pd.DataFrame]:
+        """Stream the scans that meet the requested criteria one page at a time, in order of scan start time.
+
+        Each page is a single indexed query, so the first page arrives quickly no matter how many scans match.  The
+        pages are not stored in scan_meta and do not stage the query.
+
+        Args:
+            page_size: The maximum number of scans in each page
+
+        Yields:
+            DataFrames in the same format as scan_meta, sorted by scan_start_utc and sid
+        """
+        token = None
+        while True:
+            page, token = self.db.query_scan_frame_page(begin=self.begin, end=self.end, q_filter=self.scan_filter,
+                                                        after=token, limit=page_size, metric_filter=self.metric_filter)
+            if len(page) > 0:
+                yield page
+            if token is None:
+                return
+
     def get_scan_count(self):
         """Get the number of scans that meet the requested criteria."""
         return len(self.scan_meta)
 
-    def run(self):
-        """Run the full query that will return the full waveform data and metadata.  Must run stage() first."""
+    def estimate(self, warn_bytes: Optional[int] = DEFAULT_WARN_BYTES) -> Dict[str, Any]:
+        """Estimate the size of the query using aggregate queries, without staging or running it.
+
+        This is much cheaper than stage() for deciding whether a query is worth running since no scan metadata or
+        arrays are transferred.
+
+        Args:
+            warn_bytes: Issue a QuerySizeWarning if run() would transfer more than this many bytes of arrays.  If None,
+                        never warn.
+
+        Returns:
+            A dictionary with the number of matching scans (n_scans) and waveforms (n_waveforms), dictionaries keyed on
+            array name with the number of arrays (n_arrays) and their stored size in bytes (n_bytes), and the total
+            stored size of the arrays (total_bytes).  Compressed arrays take more memory than this once decoded.
+        """
+        estimate = self.db.estimate_query(begin=self.begin, end=self.end, q_filter=self.scan_filter,
+                                          signal_names=self.signal_names, array_names=self.array_names,
+                                          cavities=self.cavities, metric_filter=self.metric_filter)
+        estimate['total_bytes'] = sum(estimate['n_bytes'].values())
+
+        if warn_bytes is not None and estimate['total_bytes'] > warn_bytes:
+            warnings.warn(f"Query would transfer {estimate['total_bytes'] / 1024 ** 2:.1f} MiB of arrays from "
+                          f"{estimate['n_scans']} scans, more than the {warn_bytes / 1024 ** 2:.1f} MiB limit.",
+                          QuerySizeWarning, stacklevel=2)
+        return estimate
+
+    def run(self, output_format: str = "dataframe", chunk_size: int = 1000):
+        """Run the full query that will return the full waveform data and metadata.  Must run stage() first.
+
+        With output_format 'dataframe', the arrays are stored in wf_data with one ndarray object per row.  With
+        output_format 'matrix', the arrays are stored in wf_matrices, a dictionary keyed on array name (raw,
+        power_spectrum, etc.) holding one C-contiguous (n_waveforms x n_samples) array per name.  The matching entry of
+        wf_matrix_meta is a DataFrame whose row i describes row i of the matrix.  The frequency axis of the power
+        spectra for each distinct sample_rate_hz is stored in frequency_axes.  These arrays are shared, so labeling a
+        spectrum only requires a dictionary lookup.
+
+        Args:
+            output_format: Either 'dataframe' or 'matrix'
+            chunk_size: The number of arrays transferred at a time when building matrices
+        """
         if not self.staged:
             raise RuntimeError("Query not staged.")
+        if output_format not in ("dataframe", "matrix"):
+            raise ValueError(f"Unsupported output_format {output_format}")
+
+        if output_format == "dataframe":
+            # Note that in the database, array names are specified by the "process" that generated them.
+            rows = self._query_waveform_data()
+            self.wf_data = pd.DataFrame(rows)
+            self.wf_matrices = None
+            self.wf_matrix_meta = None
+            self.frequency_axes = self._get_frequency_axes(self.wf_data)
+        else:
+            self.wf_data = None
+            self.wf_matrices, self.wf_matrix_meta = self._get_matrices(chunk_size)
+            self.frequency_axes = {}
+            if "power_spectrum" in self.wf_matrices and "sample_rate_hz" in self.wf_matrix_meta["power_spectrum"]:
+                n_samples = 2 * (self.wf_matrices["power_spectrum"].shape[1] - 1)
+                for fs in self.wf_matrix_meta["power_spectrum"].sample_rate_hz.unique():
+                    self.frequency_axes[fs] = self.get_frequency_range(fs, n_samples)
+
+        rows = self._query_waveform_metadata()
+        self.wf_meta = pd.DataFrame(rows)
 
-        # Note that in the database, array names are specified by the "process" that generated them.
-        rows = self.db.query_waveform_data(self.scan_meta.sid.values.tolist(), signal_names=self.signal_names,
-                                           array_names=self.array_names)
-        self.wf_data = pd.DataFrame(rows)
+    def iter_run(self, chunk_size: int = 1000, output_format: str = "dataframe"
+                 ) -> Iterator[pd.DataFrame | Tuple[pd.DataFrame, np.ndarray]]:
+        """Stream the waveform array data in chunks instead of loading it all at once.  Must run stage() first.
 
-        rows = self.db.query_waveform_metadata(self.scan_meta.sid.values.tolist(), signal_names=self.signal_names,
-                                               metric_names=self.wf_metric_names)
-        self.wf_meta = pd.DataFrame(rows)
+        Peak memory depends on chunk_size rather than on the size of the query.  The results are not stored in wf_data.
+
+        Args:
+            chunk_size: The maximum number of arrays in each chunk
+            output_format: Either 'dataframe' to yield DataFrames in the same format as wf_data, or 'matrix' to yield
+                           (metadata, 2D ndarray) pairs where row i of the matrix is the array described by row i of the
+                           metadata.  In 'matrix' format, each chunk is split by array name so all rows of a matrix
+                           have the same length.
+
+        Yields:
+            DataFrames or (DataFrame, ndarray) pairs depending on output_format.
+        """
+        if not self.staged:
+            raise RuntimeError("Query not staged.")
+        if output_format not in ("dataframe", "matrix"):
+            raise ValueError(f"Unsupported output_format {output_format}")
+        if len(self.scan_meta) == 0:
+            return
+
+        for rows in self.db.iter_waveform_data(self.scan_meta.sid.values.tolist(), signal_names=self.signal_names,
+                                               array_names=self.array_names, chunk_size=chunk_size,
+                                               columns=self.columns, cavities=self.cavities):
+            if output_format == "dataframe":
+                yield pd.DataFrame(rows)
+                continue
+
+            by_name = {}
+            for row in rows:
+                by_name.setdefault(row['name'], []).append(row)
+            for name_rows in by_name.values():
+                matrix = np.vstack([row.pop('data') for row in name_rows])
+                yield pd.DataFrame(name_rows), matrix
+
+    def iter_arrow(self, scans_per_chunk: int = 100) -> Iterator['pa.RecordBatch']:
+        """Stream the query results as Apache Arrow record batches with one row per waveform.  Must run stage() first.
+
+        Each array becomes a list column and each scalar metric becomes a float64 column.  The lists may differ in
+        length, e.g., between sample rates or record lengths.  The array and metric columns are the requested
+        array_names and wf_metric_names, or those of the first chunk that has waveforms if all were requested.
+        Requires the optional pyarrow package.
+
+        Args:
+            scans_per_chunk: The number of scans queried and converted at a time
+
+        Yields:
+            Record batches that all share the same schema.  Chunks without waveforms are skipped.
+
+        Raises:
+            ValueError: If a later chunk has an array or metric that is not in the schema
+        """
+        export.require_pyarrow()
+        if not self.staged:
+            raise RuntimeError("Query not staged.")
+
+        schema = None
+        sids = self.scan_meta.sid.values.tolist()
+        for idx in range(0, len(sids), scans_per_chunk):
+            chunk = sids[idx:idx + scans_per_chunk]
+            array_rows = self.db.query_waveform_data(chunk, signal_names=self.signal_names,
+                                                     array_names=self.array_names, cavities=self.cavities)
+            metric_rows = self.db.query_waveform_metadata(chunk, signal_names=self.signal_names,
+                                                          metric_names=self.wf_metric_names, cavities=self.cavities)
+            if len(array_rows) == 0 and len(metric_rows) == 0:
+                continue
+            batch = export.build_record_batch(self.scan_meta, array_rows, metric_rows, schema=schema,
+                                              array_names=self.array_names, metric_names=self.wf_metric_names)
+            schema = batch.schema
+            yield batch
+
+    def to_arrow(self, scans_per_chunk: int = 100) -> 'pa.Table':
+        """Get the query results as an Apache Arrow table with one row per waveform.  See iter_arrow.
+
+        Args:
+            scans_per_chunk: The number of scans queried and converted at a time
+
+        Returns:
+            The results as an Arrow table.  None if no scans matched the query.
+        """
+        return export.to_table(self.iter_arrow(scans_per_chunk=scans_per_chunk))
+
+    def to_parquet(self, path: str, partition_by: Tuple[str, ...] = ("date", "cavity"), scans_per_chunk: int = 100):
+        """Write the query results to a hive partitioned Parquet dataset one chunk of scans at a time.
+
+        The dataset can be re-read with pyarrow.dataset or pandas.read_parquet, including only the columns needed.
+
+        Args:
+            path: The directory of the dataset.  It must not exist or be empty.
+            partition_by: The columns used to partition the dataset into directories, e.g., date=2024-01-01/cavity=R123
+            scans_per_chunk: The number of scans queried and written at a time
+        """
+        export.write_parquet(self.iter_arrow(scans_per_chunk=scans_per_chunk), path, partition_by=partition_by)
+
+    def _query_waveform_data(self) -> List[Dict[str, Any]]:
+        """Query the waveform arrays of the staged scans, using the cache if there is one."""
+        sids = self.scan_meta.sid.values.tolist()
+        if self.cache is None:
+            return self.db.query_waveform_data(sids, signal_names=self.signal_names, array_names=self.array_names,
+                                               columns=self.columns, cavities=self.cavities)
+
+        def fetch(missing):
+            return self.db.query_waveform_data(missing, signal_names=self.signal_names, array_names=self.array_names,
+                                               columns=self.columns, cavities=self.cavities)
+
+        return self.cache.get_rows("waveform_data", sids, fetch, database=self.db.identity,
+                                   signal_names=self.signal_names, array_names=self.array_names, columns=self.columns,
+                                   cavities=self.cavities)
+
+    def _query_waveform_metadata(self) -> List[Dict[str, Any]]:
+        """Query the waveform metadata of the staged scans, using the cache if there is one."""
+        sids = self.scan_meta.sid.values.tolist()
+        if self.cache is None:
+            return self.db.query_waveform_metadata(sids, signal_names=self.signal_names,
+                                                   metric_names=self.wf_metric_names, columns=self.columns,
+                                                   cavities=self.cavities)
+
+        def fetch(missing):
+            return self.db.query_waveform_metadata(missing, signal_names=self.signal_names,
+                                                   metric_names=self.wf_metric_names, columns=self.columns,
+                                                   cavities=self.cavities)
+
+        return self.cache.get_rows("waveform_metadata", sids, fetch, database=self.db.identity,
+                                   signal_names=self.signal_names, metric_names=self.wf_metric_names,
+                                   columns=self.columns, cavities=self.cavities)
+
+    def _get_matrices(self, chunk_size: int) -> Tuple[Dict[str, np.ndarray], Dict[str, pd.DataFrame]]:
+        """Stream the waveform arrays into one preallocated matrix per array name.
+
+        The number of rows of each matrix is counted in the database first so the matrices can be filled in place
+        without holding more than one chunk of decoded arrays.  With a cache, the cached rows are used instead.
+        """
+        sids = self.scan_meta.sid.values.tolist()
+        if self.cache is None:
+            counts = self.db.count_waveform_data(sids, signal_names=self.signal_names, array_names=self.array_names,
+                                                 cavities=self.cavities)
+            chunks = self.db.iter_waveform_data(sids, signal_names=self.signal_names, array_names=self.array_names,
+                                                chunk_size=chunk_size, columns=self.columns, cavities=self.cavities)
+        else:
+            rows = self._query_waveform_data()
+            counts = {}
+            for row in rows:
+                counts[row['name']] = counts.get(row['name'], 0) + 1
+            chunks = [rows]
+
+        matrices = {}
+        meta = {name: [] for name in counts}
+        for rows in chunks:
+            for row in rows:
+                name = row['name']
+                data = row.pop('data')
+                if name not in matrices:
+                    matrices[name] = np.empty((counts[name], len(data)), dtype=data.dtype)
+                idx = len(meta[name])
+                # Raises a ValueError if arrays of the same name have different lengths
+                matrices[name][idx] = data
+                meta[name].append(row)
+
+        return matrices, {name: pd.DataFrame(rows) for name, rows in meta.items() if name in matrices}
 
     @staticmethod
-    def get_frequency_range(fs: float, n_samples: int):
+    def _get_frequency_axes(wf_data: pd.DataFrame) -> Dict[float, np.ndarray]:
+        """Get the shared frequency axis of the power spectra in wf_data keyed on sample_rate_hz."""
+        if len(wf_data) == 0 or "sample_rate_hz" not in wf_data:
+            return {}
+
+        out = {}
+        psd = wf_data.loc[wf_data['name'] == "power_spectrum", ["sample_rate_hz", "data"]]
+        for fs, data in psd.drop_duplicates("sample_rate_hz").itertuples(index=False):
+            # Spectra have n_samples/2 + 1 points.  Waveforms always have an even number of samples (8192).
+            out[fs] = Query.get_frequency_range(fs, 2 * (len(data) - 1))
+        return out
+
+    @staticmethod
+    def get_frequency_range(fs: float, n_samples: int) -> np.ndarray:
         """Construct the frequency distribution of a periodogram or FFT given parameters of the initial signal.
 
         This distribution includes the nyquist frequency so is of length n_samples/2 + 1 to match scipy's periodogram
-        method.
+        method.  The result is cached and read-only.
 
         Args:
             fs: The sampling frequency in Hertz
             n_samples: The number of samples in the original signal
         """
-
-        # It is up to n_samples/2 + 1 since the frequency distribution includes zero, and scipy returns the nyquist
-        # frequency fs/2 (many libraries seem to not).
-        return np.array([i * float(fs) / n_samples for i in range(int(n_samples/2) + 1)])
+        return get_frequency_range(float(fs), int(n_samples))
@@ -2,25 +2,62 @@
 
 New data that is to be written to the database should be handled by the objects containing that data.
 """
+# pylint: disable=too-many-lines
 
-import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, Tuple, List, Any, Optional
+from typing import Dict, Tuple, List, Any, Optional, Sequence, Iterator, Callable, Union, TYPE_CHECKING
 
-import numpy as np
 import mysql.connector
+import pandas as pd
+from mysql.connector import pooling
+from mysql.connector.cursor import MySQLCursor
 
+from .cache import ArrayCache
+from .codec import ArrayCodec, decode_array, is_binary, read_header, HEADER, MAGIC
+from .partition import is_partitioned
 from .utils import get_datetime_as_utc
 
+if TYPE_CHECKING:
+    from .data_model import Scan
+    from .planner import FilterPlanner
+
+# Multi-row INSERT statements are capped by row count and by an approximate payload size so that a single statement
+# stays well below the MariaDB default max_allowed_packet (16 MiB).  Waveform arrays are large, so the byte cap is
+# usually what limits the waveform_adata batches.
+DEFAULT_INSERT_BATCH_SIZE = 1000
+DEFAULT_INSERT_BATCH_BYTES = 8 * 1024 * 1024
+
+# Waveform queries over more sids than this are split into multiple statements to keep them a manageable size.
+DEFAULT_SID_CHUNK_SIZE = 1000
+
+# The number of scans returned per page by the paginated scan queries
+DEFAULT_PAGE_SIZE = 1000
+
+# The waveform-level fields that can be included in the results of the waveform queries.  The wid is always included.
+WAVEFORM_FIELDS = ("sid", "cavity", "signal_name", "sample_rate_hz", "comment")
+
+# The columns of one array of a waveform.  The waveform-level fields are queried once per waveform and added to each
+# array row client-side.
+_ARRAY_COLUMNS = "waveform_adata.wid, waveform_adata.wadid, waveform_adata.name"
+
 
 class QueryFilter:
     """This class is used to construct multipart where clauses.
 
     This is intended for use filtering scans, but it could potentially be used in other scenarios.
+
+    Besides the binary comparisons, these ops are supported:
+        IN: The value is a non-empty list of values, e.g., ("mode", "IN", ["CW", "pulsed"])
+        BETWEEN: The value is an inclusive (low, high) pair, e.g., ("R1XXITOT", "BETWEEN", (10.0, 20.0))
+        PREFIX: The value is the string the metadata starts with, e.g., ("comment", "PREFIX", "trip")
+    Each is compiled to a single predicate on value that can use the (name, value, sid) metadata indexes.
     """
-    valid_ops = (">", "<", "=", "!=", ">=", "<=")
+    valid_ops = (">", "<", "=", "!=", ">=", "<=", "IN", "BETWEEN", "PREFIX")
 
-    def __init__(self, filter_params, filter_ops, filter_values):
+    def __init__(self, filter_params, filter_ops, filter_values, groups: Optional[Sequence['FilterGroup']] = None):
         """An object that contains the filter rules to be applied to a database query.
 
         The three filter_* parameters work in conjunction.  The must be list-like objects of the same length.  At
@@ -37,6 +74,7 @@ class QueryFilter:
             filter_values: The value to be compared against.  The comparisons are sanitized, but essentially follow
                            the <filter_param> <filter_op> <filter_value> pattern, e.g., R123GMES >= 2.0.  If None, no
                            filtering is applied
+            groups: Groups of terms combined with OR or AND (see FilterGroup).  Each group must also match.
         """
 
         if (filter_params is not None) or (filter_ops is not None) or (filter_values is not None):
@@ -46,7 +84,11 @@ class QueryFilter:
         self.params = filter_params
         self.ops = filter_ops
         self.values = filter_values
+        self.groups = [] if groups is None else list(groups)
         self.validate_ops()
+        for group in self.groups:
+            if not isinstance(group, FilterGroup):
+                raise ValueError(f"Invalid filter group {group!r}")
 
     def validate_ops(self):
         """Validate the selected database comparison operations against a pre-approved list.
@@ -56,49 +98,359 @@ class QueryFilter:
         """
         # Validate the op clause.  The others can be part of standard prepared statement sanitization
         if self.ops is not None and len(self.ops) > 0:
-            for op in self.ops:
-                if op not in self.valid_ops:
-                    raise ValueError(f"Invalid operation {op}")
+            for op, value in zip(self.ops, self.values):
+                self.validate_term(op, value)
+
+    def __len__(self) -> int:
+        """Return the number of conditional clauses that will be generated."""
+        n_terms = 0 if self.params is None else len(self.params)
+        return n_terms + len(self.groups)
+
+    def get_items(self) -> List[Union[Tuple[str, str, Any], 'FilterGroup']]:
+        """Get the (name, op, value) terms followed by the groups.  A scan must match every item."""
+        terms = [] if self.params is None else list(zip(self.params, self.ops, self.values))
+        return terms + self.groups
+
+    @classmethod
+    def validate_term(cls, op: str, value: Any):
+        """Validate a comparison operation and the shape of its value.
+
+        Raises:
+            ValueError: If op is unsupported or value does not fit it.
+        """
+        if op not in cls.valid_ops:
+            raise ValueError(f"Invalid operation {op}")
+        if op == "IN":
+            if isinstance(value, str) or not isinstance(value, (list, tuple, set)) or len(value) == 0:
+                raise ValueError(f"IN requires a non-empty list of values.  Got {value!r}.")
+            if len({isinstance(item, str) for item in value}) != 1:
+                raise ValueError(f"IN values must all be strings or all be numbers.  Got {value!r}.")
+        elif op == "BETWEEN":
+            if isinstance(value, str) or not isinstance(value, (list, tuple)) or len(value) != 2:
+                raise ValueError(f"BETWEEN requires a (low, high) pair.  Got {value!r}.")
+            if isinstance(value[0], str) != isinstance(value[1], str):
+                raise ValueError(f"BETWEEN values must both be strings or both be numbers.  Got {value!r}.")
+        elif op == "PREFIX":
+            if not isinstance(value, str) or len(value) == 0:
+                raise ValueError(f"PREFIX requires a non-empty string.  Got {value!r}.")
+        elif isinstance(value, (list, tuple, set)):
+            raise ValueError(f"{op} requires a single value.  Got {value!r}.")
+
+    @staticmethod
+    def get_table(op: str, value: Any) -> str:
+        """Get the metadata table of a term.  String values are in scan_sdata and other values in scan_fdata."""
+        if op in ("IN", "BETWEEN"):
+            value = next(iter(value))
+        return "scan_sdata" if isinstance(value, str) else "scan_fdata"
+
+    @staticmethod
+    def gen_value_test(op: str, value: Any, column: str = "value") -> Tuple[str, List[Any]]:
+        """Generate the predicate comparing a value column to a term's value and the data for its placeholders.
+
+        Args:
+            op: One of valid_ops
+            value: The comparison value
+            column: The column being compared
+
+        Returns:
+            The predicate, e.g., "value BETWEEN %s AND %s", and its data
+        """
+        if op == "IN":
+            return f"{column} IN ({', '.join(['%s'] * len(value))})", list(value)
+        if op == "BETWEEN":
+            return f"{column} BETWEEN %s AND %s", list(value)
+        if op == "PREFIX":
+            # A LIKE pattern with a literal prefix is a range scan on the index
+            return f"{column} LIKE %s", [_escape_like(value) + "%"]
+        return f"{column} {op} %s", [value]
+
+    @classmethod
+    def gen_term_select(cls, name: str, op: str, value: Any) -> Tuple[str, List[Any]]:
+        """Generate a SELECT of the sids matching a single term and the data for its placeholders."""
+        table = cls.get_table(op, value)
+        test, data = cls.gen_value_test(op, value)
+        return f"SELECT {table}.sid FROM {table} WHERE name = %s and {test}", [name] + data
+
+
+class FilterGroup:
+    """A group of scan filter terms combined with AND or OR that matches a single set of scans.
+
+    Items are (name, op, value) terms as in QueryFilter or nested groups.  The group is compiled to one subquery in
+    which each term is an indexed lookup of the metadata tables, OR is a UNION and AND is an INTERSECT, so the database
+    does the set algebra in a single round trip.
+
+    Example:
+        # mode is CW or pulsed, or the current is between 10 and 20 while c is on
+        FilterGroup("OR", [("mode", "IN", ["CW", "pulsed"]),
+                           FilterGroup("AND", [("R1XXITOT", "BETWEEN", (10.0, 20.0)), ("c", "=", "on")])])
+    """
+    valid_kinds = ("AND", "OR")
+
+    def __init__(self, kind: str, items: Sequence[Union[Tuple[str, str, Any], 'FilterGroup']]):
+        """Create a group of filter terms.
+
+        Args:
+            kind: How the items are combined, AND or OR
+            items: The (name, op, value) terms and nested FilterGroups of the group
+        """
+        if kind not in self.valid_kinds:
+            raise ValueError(f"Invalid filter group kind {kind}.  Supported kinds are {self.valid_kinds}.")
+        if len(items) == 0:
+            raise ValueError("A filter group needs at least one item.")
+        for item in items:
+            if not isinstance(item, FilterGroup):
+                if not isinstance(item, (list, tuple)) or len(item) != 3:
+                    raise ValueError(f"Invalid filter term {item!r}.  Expected (name, op, value).")
+                QueryFilter.validate_term(item[1], item[2])
+
+        self.kind = kind
+        self.items = [item if isinstance(item, FilterGroup) else tuple(item) for item in items]
+
+    def gen_subquery(self) -> Tuple[str, List[Any]]:
+        """Generate a parenthesized subquery selecting the sids that match this group and its placeholder data."""
+        selects = []
+        data = []
+        for item in self.items:
+            if isinstance(item, FilterGroup):
+                subquery, item_data = item.gen_subquery()
+                select = f"SELECT g.sid FROM {subquery} AS g"
+            else:
+                select, item_data = QueryFilter.gen_term_select(*item)
+            selects.append(select)
+            data += item_data
+
+        operator = " UNION " if self.kind == "OR" else " INTERSECT "
+        return f"({operator.join(selects)})", data
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Get the group as a JSON serializable dictionary, e.g., for logging a query."""
+        return {'kind': self.kind,
+                'items': [item.as_dict() if isinstance(item, FilterGroup) else list(item) for item in self.items]}
+
+    def __repr__(self) -> str:
+        return f"FilterGroup({self.kind!r}, {self.items!r})"
+
+
+class WaveformMetricFilter:
+    """This class is used to filter scans by the scalar metrics of their waveforms (rms, mean, etc.).
+
+    Each term is matched by a scan if any of its waveforms of the term's cavity and signal has a metric meeting the
+    comparison.  A scan must match every term.  The terms are evaluated by the database against waveform_sdata, so
+    finding anomalous waveforms does not require transferring them.
+    """
+    valid_ops = QueryFilter.valid_ops
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, cavities: Sequence[Optional[str]], signal_names: Sequence[str], metric_names: Sequence[str],
+                 ops: Sequence[str], values: Sequence[float]):
+        """An object that contains the waveform metric rules to be applied to a scan query.
+
+        The parameters work in conjunction and must be list-like objects of the same length.  For example, if
+        cavities = ['1L10-3'], signal_names = ['GMES'], metric_names = ['rms'], ops = ['>'] and values = [0.2], then
+        each scan included in the query must have a 1L10-3 GMES waveform with an rms greater than 0.2.
+
+        Args:
+            cavities: The cavity name or glob pattern (e.g. "1L10*") of each term.  None matches any cavity.
+            signal_names: The signal name (GMES, PMES, etc.) of each term
+            metric_names: The name of the waveform metric of each term (see Scan.scalar_names)
+            ops: The type of comparison to be made.  Supported ops are {self.valid_ops}.
+            values: The numeric value each metric is compared against
+        """
+        if len({len(cavities), len(signal_names), len(metric_names), len(ops), len(values)}) != 1:
+            raise ValueError("All waveform metric filter parameters must have the same length.")
+        for op, value in zip(ops, values):
+            QueryFilter.validate_term(op, value)
+            if QueryFilter.get_table(op, value) != "scan_fdata":
+                raise ValueError(f"Waveform metrics are numeric.  Cannot compare them to {value!r}.")
+
+        self.cavities = list(cavities)
+        self.signal_names = list(signal_names)
+        self.metric_names = list(metric_names)
+        self.ops = list(ops)
+        self.values = list(values)
 
     def __len__(self) -> int:
         """Return the number of conditional clauses that will be generated."""
-        if self.params is None:
-            return 0
-        return len(self.params)
+        return len(self.metric_names)
+
+    # pylint: disable=too-many-locals
+    def gen_conditions(self, begin: Optional[datetime], end: Optional[datetime],
+                       partitioned: bool = False) -> Tuple[List[str], List[Any]]:
+        """Generate a WHERE condition on scan.sid for each term.
 
+        Each condition is an IN subquery, so the database can either probe the waveforms of each candidate scan by sid
+        or look up the matching metric values by (name, value) first, whichever it estimates is cheaper.
 
+        Args:
+            begin: The earliest scan start time.  Only used to prune partitions.
+            end: The latest scan start time.  Only used to prune partitions.
+            partitioned: Whether the tables are partitioned by month
+
+        Returns:
+            The conditions to be combined with AND, and the data for their placeholders
+        """
+        conditions = []
+        data = []
+        for cavity, signal_name, metric_name, op, value in zip(self.cavities, self.signal_names, self.metric_names,
+                                                                self.ops, self.values):
+            tests = ["waveform.signal_name = %s"]
+            data.append(signal_name)
+            cavity_test, cavity_data = WaveformDB.get_cavity_clause(None if cavity is None else [cavity])
+            if cavity_test != "":
+                tests.append(cavity_test)
+                data += cavity_data
+            value_test, value_data = QueryFilter.gen_value_test(op, value, column="waveform_sdata.value")
+            tests += ["waveform_sdata.name = %s", value_test]
+            data += [metric_name] + value_data
+            if partitioned:
+                for table in ("waveform", "waveform_sdata"):
+                    time_tests, time_data = WaveformDB.get_scan_time_clauses(begin, end, table=table)
+                    tests += time_tests
+                    data += time_data
+
+            conditions.append("scan.sid IN (SELECT waveform.sid FROM waveform JOIN waveform_sdata "
+                              f"ON waveform.wid = waveform_sdata.wid WHERE {' AND '.join(tests)})")
+        return conditions, data
+
+
+# pylint: disable=too-many-instance-attributes
 class WaveformDB:
     """A class that handles operations on data that already exists within the database.
 
     This class will manage the connection lifecycle.
     """
 
-    def __init__(self, host: str, user: str, password: str, *, port: int = 3306, database="scope_waveforms"):
+    # pylint: disable=too-many-arguments
+    def __init__(self, host: str, user: str, password: str, *, port: int = 3306, database="scope_waveforms",
+                 array_codec: Optional[ArrayCodec] = None, pool_size: Optional[int] = None, lazy: bool = False,
+                 sid_chunk_size: int = DEFAULT_SID_CHUNK_SIZE, array_cache: Optional[ArrayCache] = None,
+                 filter_planner: Optional['FilterPlanner'] = None):
+        """Connect to the database.
+
+        By default, a single connection is shared by every operation and is only used by one thread at a time.  With
+        pool_size set, connections are checked out of a pool for each operation so that multiple threads can share one
+        WaveformDB and run queries concurrently.
+
+        Args:
+            host: The database host
+            user: The database user
+            password: The database user's password
+            port: The database port
+            database: The database (schema) name
+            array_codec: The codec used to store waveform arrays when inserting scans, including the optional
+                         compression.  If None, the legacy JSON text format is used.  Arrays in any format are read
+                         transparently.
+            pool_size: The number of pooled connections.  If None, a single connection is used.
+            lazy: If True, wait to connect until the first database operation.
+            sid_chunk_size: The maximum number of sids included in a single waveform query.  Larger sets of sids are
+                            split into chunks that run concurrently in pooled mode.
+            array_cache: An in-memory cache of decoded arrays used by query_waveform_data.  If given, only arrays that
+                         are not cached are transferred from the database.  If None, arrays are not cached.
+            filter_planner: Plans the scan filter queries based on metadata statistics.  If None, each filter term is
+                            joined in the order given.
+        """
+        # Prevents error on del if creating connection fails.
+        self.conn = None
+        self._pool = None
+
         self.host = host
         self.user = user
         self.port = port
         self.database = database
-
-        # Prevents error on del if creating connection fails.
-        self.conn = None
-        # Will throw exception if it cannot connect
-        self.conn = mysql.connector.connect(
-            host=self.host,
-            port=self.port,
-            user=self.user,
-            password=password,
-            database=self.database,
-            autocommit=False
-        )
-        self.conn.autocommit = False
+        # Identifies the server and schema so that cached results of different databases are kept apart
+        self.identity = f"{host}:{port}/{database}"
+        self.array_codec = array_codec
+        self.pool_size = pool_size
+        if sid_chunk_size < 1:
+            raise ValueError("sid_chunk_size must be at least one.")
+        self.sid_chunk_size = sid_chunk_size
+        self.array_cache = array_cache
+        self.filter_planner = filter_planner
+        # Whether the tables are partitioned by month.  Checked on first use.
+        self._partitioned = None
+
+        self._connect_args = {'host': host, 'port': port, 'user': user, 'password': password, 'database': database,
+                              'autocommit': False}
+        self._lock = threading.RLock()
+        self._pool_slots = None
+        if pool_size is not None:
+            if pool_size < 1 or pool_size > pooling.CNX_POOL_MAXSIZE:
+                raise ValueError(f"pool_size must be between 1 and {pooling.CNX_POOL_MAXSIZE}.")
+            # get_connection() fails instead of waiting when the pool is exhausted.  This makes callers wait instead.
+            self._pool_slots = threading.BoundedSemaphore(pool_size)
+
+        if not lazy:
+            # Will throw exception if it cannot connect
+            self._connect()
 
     def __del__(self):
+        self.close()
+
+    def _connect(self):
+        """Create the connection or connection pool if it does not exist yet."""
+        with self._lock:
+            if self.pool_size is not None:
+                if self._pool is None:
+                    self._pool = pooling.MySQLConnectionPool(pool_name=f"rfscopedb-{id(self)}",
+                                                             pool_size=self.pool_size, **self._connect_args)
+            elif self.conn is None:
+                self.conn = mysql.connector.connect(**self._connect_args)
+                self.conn.autocommit = False
+
+    @contextmanager
+    def connection(self) -> Iterator[mysql.connector.MySQLConnection]:
+        """Get a database connection for the duration of a with block.
+
+        In pooled mode, a connection is checked out of the pool (waiting for one if needed) and returned to it at the
+        end of the block, which also resets its session.  Otherwise, the shared connection is locked for the duration
+        of the block.  Cursors should be created per use and not shared between threads.
+
+        Yields:
+            A database connection
+        """
+        self._connect()
+        if self._pool is not None:
+            with self._pool_slots:
+                conn = self._pool.get_connection()
+                try:
+                    yield conn
+                finally:
+                    # Returns the connection to the pool
+                    conn.close()
+        else:
+            with self._lock:
+                yield self.conn
+
+    def close(self):
+        """Close the database connection(s).  Safe to call more than once."""
         if self.conn is not None:
             self.conn.close()
+            self.conn = None
+        if self._pool is not None:
+            # pylint: disable=protected-access
+            self._pool._remove_connections()
+            self._pool = None
+
+    def is_partitioned(self) -> bool:
+        """Check whether the scan-keyed tables are partitioned by month.  See the partition module.
+
+        The result is cached, so create a new WaveformDB after the tables are partitioned.
+        """
+        if self._partitioned is None:
+            cursor = None
+            with self.connection() as conn:
+                try:
+                    cursor = conn.cursor()
+                    self._partitioned = is_partitioned(cursor)
+                finally:
+                    if cursor is not None:
+                        cursor.close()
+                    conn.rollback()
+        return self._partitioned
 
     # noinspection PyTypeChecker
-    def query_scan_rows(self, begin: datetime = None, end: datetime = None, q_filter: QueryFilter = None
-                        ) -> List[Dict[str, Any]]:
+    def query_scan_rows(self, begin: datetime = None, end: datetime = None, q_filter: QueryFilter = None, *,
+                        metric_filter: Optional[WaveformMetricFilter] = None) -> List[Dict[str, Any]]:
         """Query scan data (sans waveforms) from the database and return it in an easy to process format.
         
         Note all filter_* parameters must be of the same length.
@@ -107,65 +459,215 @@ class WaveformDB:
             begin: The earliest scan start time for scans to be returned.  If None, there is no earliest cutoff.
             end: The latest scan start time for scans to be returned.  If None, there is no latest cutoff.
             q_filter: The filter to apply to the scan data.
+            metric_filter: The filter to apply to the scalar metrics of the scan's waveforms.
 
                            
         Returns:
             A list of dictionaries containing the data for a single scan including metadata.
         """
 
-        filters, data = self.get_scan_join_clauses(begin, end, q_filter)
+        # Convert the row-per-metadata to row-per-scan.  Keep a single row as a dictionary for easy consumption.
+        scan_meta = {}
+        rows = self._query_scan_metadata(begin, end, q_filter, metric_filter=metric_filter)
+        for sid, scan_start_utc, kind, name, s_value, f_value in rows:
+            if sid not in scan_meta:
+                scan_meta[sid] = {'sid': sid, 'scan_start_utc': scan_start_utc}
+            scan_meta[sid][f"{kind}_{name}"] = s_value if kind == "s" else f_value
 
-        sub_sql = f"SELECT scan.* FROM scan \n{filters}"
-        s_sql = f"""
-        SELECT t1.sid, t1.scan_start_utc, scan_sdata.ssid, scan_sdata.name as s_name, scan_sdata.value as s_value 
-        FROM scan_sdata 
-        JOIN ({sub_sql}) AS t1
-            ON t1.sid = scan_sdata.sid"""
+        return list(scan_meta.values())
 
-        f_sql = f"""
-        SELECT t1.sid, t1.scan_start_utc, scan_fdata.sfid, scan_fdata.name as f_name, scan_fdata.value as f_value 
-        FROM scan_fdata 
-        JOIN ({sub_sql}) AS t1
-            ON t1.sid = scan_fdata.sid"""
+    def query_scan_frame(self, begin: datetime = None, end: datetime = None, q_filter: QueryFilter = None, *,
+                         metric_filter: Optional[WaveformMetricFilter] = None) -> pd.DataFrame:
+        """Query scan data (sans waveforms) from the database as a DataFrame with one row per scan.
 
-        out = []
-        cursor = None
-        try:
-            cursor = self.conn.cursor(dictionary=True)
-            cursor.execute(s_sql, data)
-            for row in cursor:
-                out.append(row)
+        This has the same content as query_scan_rows, but the metadata is pivoted with pandas instead of row by row,
+        which is much faster for large numbers of scans.  Metadata that a scan does not have is NaN.
 
-            cursor.execute(f_sql, data)
-            for row in cursor:
-                out.append(row)
+        Args:
+            begin: The earliest scan start time for scans to be returned.  If None, there is no earliest cutoff.
+            end: The latest scan start time for scans to be returned.  If None, there is no latest cutoff.
+            q_filter: The filter to apply to the scan data.
+            metric_filter: The filter to apply to the scalar metrics of the scan's waveforms.
 
-        finally:
-            if cursor is not None:
-                cursor.close()
+        Returns:
+            A DataFrame with sid and scan_start_utc columns followed by the s_<name> string metadata columns and the
+            f_<name> float metadata columns, sorted by sid.
+        """
+        return self._pivot_scan_metadata(self._query_scan_metadata(begin, end, q_filter, metric_filter=metric_filter))
+
+    # pylint: disable=too-many-locals
+    def query_scan_rows_page(self, begin: datetime = None, end: datetime = None, q_filter: QueryFilter = None, *,
+                             after: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                             metric_filter: Optional[WaveformMetricFilter] = None
+                             ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Query one page of scan data (sans waveforms) in order of scan start time, then sid.
+
+        Pages use keyset pagination on (scan_start_utc, sid), so each page is found with an index seek no matter how
+        many scans come before it, and scans inserted during paging never shift the pages.  Unlike query_scan_rows,
+        scans without any metadata are included.
+
+        Args:
+            begin: The earliest scan start time for scans to be returned.  If None, there is no earliest cutoff.
+            end: The latest scan start time for scans to be returned.  If None, there is no latest cutoff.
+            q_filter: The filter to apply to the scan data.
+            after: The continuation token of the previous page.  If None, the first page is returned.
+            limit: The maximum number of scans in the page
+            metric_filter: The filter to apply to the scalar metrics of the scan's waveforms.
+
+        Returns:
+            The scans of the page in the format of query_scan_rows, and the continuation token for the next page, or
+            None if this is the last page.
+        """
+        rows, token = self._query_scan_metadata_page(begin, end, q_filter, after=after, limit=limit,
+                                                     metric_filter=metric_filter)
 
-        # Convert the row-per-metadata to row-per-scan.  Keep a single row as a dictionary for easy consumption.
         scan_meta = {}
-        for row in out:
-            sid = row['sid']
+        for sid, scan_start_utc, kind, name, s_value, f_value in rows:
             if sid not in scan_meta:
-                scan_meta[sid] = {}
+                scan_meta[sid] = {'sid': sid, 'scan_start_utc': scan_start_utc}
+            if kind is not None:
+                scan_meta[sid][f"{kind}_{name}"] = s_value if kind == "s" else f_value
 
-            scan_meta[sid]['sid'] = sid
-            scan_meta[sid]['scan_start_utc'] = row['scan_start_utc']
-            if 's_name' in row:
-                scan_meta[sid][f"s_{row['s_name']}"] = row['s_value']
-            elif 'f_name' in row:
-                scan_meta[sid][f"f_{row['f_name']}"] = row['f_value']
+        return list(scan_meta.values()), token
 
-        return list(scan_meta.values())
+    def query_scan_frame_page(self, begin: datetime = None, end: datetime = None, q_filter: QueryFilter = None, *,
+                              after: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                              metric_filter: Optional[WaveformMetricFilter] = None
+                              ) -> Tuple[pd.DataFrame, Optional[str]]:
+        """Query one page of scan data (sans waveforms) as a DataFrame.  See query_scan_rows_page.
+
+        Returns:
+            The scans of the page in the format of query_scan_frame but sorted by scan_start_utc and sid, and the
+            continuation token for the next page, or None if this is the last page.
+        """
+        rows, token = self._query_scan_metadata_page(begin, end, q_filter, after=after, limit=limit,
+                                                     metric_filter=metric_filter)
+        df = self._pivot_scan_metadata(rows).sort_values(["scan_start_utc", "sid"], kind="stable")
+        return df.reset_index(drop=True), token
+
+    def _query_scan_metadata_page(self, begin: datetime, end: datetime, q_filter: QueryFilter, *,
+                                  after: Optional[str], limit: int,
+                                  metric_filter: Optional[WaveformMetricFilter] = None
+                                  ) -> Tuple[List[Tuple[Any, ...]], Optional[str]]:
+        """Query the metadata rows of one page of scans.  See query_scan_rows_page.
+
+        One scan more than the limit is queried to find out whether there is another page.  Its rows are dropped.
+        """
+        if limit < 1:
+            raise ValueError("limit must be at least one.")
+
+        rows = self._query_scan_metadata(begin, end, q_filter, after=_decode_page_token(after), limit=limit + 1,
+                                         metric_filter=metric_filter)
+
+        keys = []
+        for sid, scan_start_utc, *_ in rows:
+            if len(keys) == 0 or keys[-1] != (scan_start_utc, sid):
+                keys.append((scan_start_utc, sid))
+        if len(keys) <= limit:
+            return rows, None
+
+        last = keys[limit - 1]
+        rows = [row for row in rows if (row[1], row[0]) <= last]
+        return rows, _encode_page_token(*last)
+
+    @staticmethod
+    def _pivot_scan_metadata(rows: List[Tuple[Any, ...]]) -> pd.DataFrame:
+        """Pivot the rows of _query_scan_metadata into one row per scan.  See query_scan_frame."""
+        df = pd.DataFrame.from_records(rows, columns=["sid", "scan_start_utc", "kind", "name", "s_value", "f_value"])
+
+        out = df.groupby("sid", sort=True)[["scan_start_utc"]].first()
+        for kind in ("s", "f"):
+            part = df.loc[df.kind == kind].drop_duplicates(["sid", "name"], keep="last")
+            wide = part.pivot(index="sid", columns="name", values=f"{kind}_value")
+            if kind == "f":
+                wide = wide.astype(float)
+            wide.columns = [f"{kind}_{name}" for name in wide.columns]
+            out = out.join(wide)
+
+        return out.reset_index()
+
+    # pylint: disable=too-many-locals
+    # noinspection PyTypeChecker
+    def _query_scan_metadata(self, begin: datetime, end: datetime, q_filter: QueryFilter, *,
+                             after: Optional[Tuple[datetime, int]] = None, limit: Optional[int] = None,
+                             metric_filter: Optional[WaveformMetricFilter] = None) -> List[Tuple[Any, ...]]:
+        """Query the string and float metadata of the matching scans in a single round trip.
+
+        The scan filter is evaluated once in a common table expression and joined to both metadata tables.  If the
+        tables are partitioned, the metadata tables are also limited to the time range so that only its partitions are
+        read.
+
+        Args:
+            begin: The earliest scan start time.  If None, there is no earliest cutoff.
+            end: The latest scan start time.  If None, there is no latest cutoff.
+            q_filter: The filter to apply to the scan data.
+            after: Only include scans whose (scan_start_utc, sid) comes after this key.  Requires limit.
+            limit: If given, only the first limit scans in order of (scan_start_utc, sid) are included, and each scan
+                   also gets one row with a kind of None so that scans without metadata are not lost.
+            metric_filter: The filter to apply to the scalar metrics of the scan's waveforms.
+
+        Returns:
+            A list of (sid, scan_start_utc, kind, name, s_value, f_value) tuples ordered by sid (or by scan_start_utc
+            and sid if limit is given), where kind is 's' for string metadata (s_value is set) and 'f' for float
+            metadata (f_value is set).
+        """
+        from_clause, data = self._get_scan_from_clause(begin, end, q_filter, metric_filter)
+        scans = f"SELECT scan.sid, scan.scan_start_utc \n            {from_clause}"
+        ctes = f"t1 AS ({scans})"
+        order = "sid"
+        keys = ""
+        if limit is not None:
+            # Seek past the previous page.  The >= lets the scan_start_utc index bound the range.
+            seek = ""
+            if after is not None:
+                seek = "WHERE t0.scan_start_utc >= %s AND (t0.scan_start_utc > %s OR t0.sid > %s)"
+                data = data + [after[0], after[0], after[1]]
+            ctes = (f"t0 AS ({scans}),\n"
+                    f"        t1 AS (SELECT * FROM t0 {seek} ORDER BY t0.scan_start_utc, t0.sid LIMIT %s)")
+            data = data + [limit]
+            order = "scan_start_utc, sid"
+            keys = "UNION ALL\n        SELECT t1.sid, t1.scan_start_utc, NULL, NULL, NULL, NULL FROM t1\n        "
+
+        # In the order they appear in the query
+        joins = {"scan_sdata": "", "scan_fdata": ""}
+        if self.is_partitioned():
+            for table in joins:
+                tests, time_data = self.get_scan_time_clauses(begin, end, table=table)
+                joins[table] = "".join(f" AND {test}" for test in tests)
+                data = data + time_data
+
+        sql = f"""
+        WITH {ctes}
+        SELECT t1.sid, t1.scan_start_utc, 's' AS kind, scan_sdata.name, scan_sdata.value AS s_value, NULL AS f_value
+        FROM t1 
+        JOIN scan_sdata 
+            ON t1.sid = scan_sdata.sid{joins['scan_sdata']}
+        UNION ALL
+        SELECT t1.sid, t1.scan_start_utc, 'f' AS kind, scan_fdata.name, NULL AS s_value, scan_fdata.value AS f_value
+        FROM t1 
+        JOIN scan_fdata 
+            ON t1.sid = scan_fdata.sid{joins['scan_fdata']}
+        {keys}ORDER BY {order}"""
+
+        cursor = None
+        with self.connection() as conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute(sql, data)
+                rows = cursor.fetchall()
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+        return rows
 
     # noinspection PyTypeChecker
     def query_waveform_data(self, sids: List[int], signal_names: Optional[List[str]],
-                            array_names: Optional[List[str]]) -> List[Dict[str, Any]]:
+                            array_names: Optional[List[str]], *, columns: Optional[Sequence[str]] = None,
+                            cavities: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
         """Queries the waveform array data for a given set of sids, signal_names, and array_names.
 
-        Results are stored internal to this object.
+        Results are stored internal to this object.  If this object has an array_cache, the cached arrays are read-only.
 
         Args:
             sids: A list of scan database identifiers to query waveform data
@@ -173,17 +675,388 @@ class WaveformDB:
                           queried.
             array_names: A list of the array names to include data from (names of array transforms, e.g. raw
                            or power_spectrum). If None, all array types are queried.
+            columns: The waveform-level fields (see WAVEFORM_FIELDS) to include in each row.  If None, all are included.
+                     These are queried once per waveform instead of once per array.
+            cavities: The cavity names or glob patterns (e.g. "2L22*" for a zone) to include.  If None, all cavities
+                      are queried.  See get_cavity_clause.
 
         Returns:
             A list of dictionaries each containing the data for a single array of raw or processed data from a waveform.
         """
+        if sids is None or len(sids) == 0:
+            raise ValueError("Must specify at least one sid")
+        return self._fan_out(self._query_waveform_data, sids, signal_names, array_names, self._get_columns(columns),
+                             cavities)
+
+    # pylint: disable=too-many-positional-arguments
+    # noinspection PyTypeChecker
+    def _query_waveform_data(self, sids: List[int], signal_names: Optional[List[str]],
+                             array_names: Optional[List[str]], columns: Tuple[str, ...],
+                             cavities: Optional[Sequence[str]]) -> List[Dict[str, Any]]:
+        """Queries the waveform array data for a single chunk of sids.  See query_waveform_data."""
+        if self.array_cache is not None and len(self.array_cache) > 0:
+            return self._query_waveform_data_cached(sids, signal_names, array_names, columns, cavities)
+
+        time_range = self._get_scan_time_range(sids)
+        sql, data = self._gen_waveform_data_sql(sids, signal_names, array_names, time_range=time_range,
+                                                cavities=cavities)
+
+        cursor = None
+        with self.connection() as conn:
+            try:
+                cursor = conn.cursor()
+                waveforms = self._fetch_waveforms(conn, sids, signal_names, columns, time_range, cavities=cavities)
+                cursor.execute(sql, data)
+
+                rows = []
+                for wid, wadid, name, value in cursor:
+                    value = decode_array(value)
+                    if self.array_cache is not None:
+                        # The cache was empty when the query started, but the lookup still counts the miss
+                        cached = self.array_cache.get(wid, name)
+                        if cached is None:
+                            cached = self.array_cache.put(wid, name, value)
+                        value = cached
+                    row = waveforms[wid].copy()
+                    row['wadid'] = wadid
+                    row['name'] = name
+                    row['data'] = value
+                    rows.append(row)
+
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+        return rows
+
+    # pylint: disable=too-many-positional-arguments
+    # noinspection PyTypeChecker
+    def _query_waveform_data_cached(self, sids: List[int], signal_names: Optional[List[str]],
+                                    array_names: Optional[List[str]], columns: Tuple[str, ...],
+                                    cavities: Optional[Sequence[str]]) -> List[Dict[str, Any]]:
+        """Queries the waveform array data for a single chunk of sids, only transferring the arrays that are not cached.
+
+        The matching arrays are queried first without the data column.  The arrays that are not in the cache are then
+        queried by primary key.
+        """
+        time_range = self._get_scan_time_range(sids)
+        sql, data = self._gen_waveform_data_sql(sids, signal_names, array_names, select=_ARRAY_COLUMNS,
+                                                time_range=time_range, cavities=cavities)
+
+        cursor = None
+        with self.connection() as conn:
+            try:
+                cursor = conn.cursor(dictionary=True)
+                waveforms = self._fetch_waveforms(conn, sids, signal_names, columns, time_range, cavities=cavities)
+                cursor.execute(sql, data)
+
+                rows = []
+                missing = []
+                for key in cursor.fetchall():
+                    row = waveforms[key['wid']].copy()
+                    row['wadid'] = key['wadid']
+                    row['name'] = key['name']
+                    row['data'] = self.array_cache.get(key['wid'], key['name'])
+                    if row['data'] is None:
+                        missing.append(key['wadid'])
+                    rows.append(row)
+
+                arrays = {}
+                if len(missing) > 0:
+                    wadid_params = ", ".join(["%s" for _ in range(len(missing))])
+                    sql = f"SELECT wadid, wid, name, data FROM waveform_adata WHERE wadid IN ({wadid_params})"
+                    if time_range is not None:
+                        sql += " AND scan_start_utc BETWEEN %s AND %s"
+                        missing = missing + list(time_range)
+                    cursor.execute(sql, missing)
+                    for row in cursor:
+                        arrays[row['wadid']] = self.array_cache.put(row['wid'], row['name'], decode_array(row['data']))
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+        for row in rows:
+            if row['data'] is None:
+                row['data'] = arrays[row['wadid']]
+        return rows
+
+    # noinspection PyTypeChecker
+    def iter_waveform_data(self, sids: List[int], signal_names: Optional[List[str]],
+                           array_names: Optional[List[str]], chunk_size: int = 1000, *,
+                           columns: Optional[Sequence[str]] = None,
+                           cavities: Optional[Sequence[str]] = None) -> Iterator[List[Dict[str, Any]]]:
+        """Stream the waveform array data for a given set of sids, signal_names, and array_names in chunks.
+
+        An unbuffered cursor is used so that only one chunk of rows is held in memory at a time.  The rows are streamed
+        over a dedicated connection that is opened for the lifetime of the generator, so this WaveformDB can be used
+        for other queries while the chunks are consumed.  If the generator is closed early, the connection is dropped
+        so that the remaining rows are never transferred.
+
+        Args:
+            sids: A list of scan database identifiers to query waveform data
+            signal_names: A list of the signal names to include data from  (GMES, PMES, etc.).  If None, all signals are
+                          queried.
+            array_names: A list of the array names to include data from (names of array transforms, e.g. raw
+                           or power_spectrum). If None, all array types are queried.
+            chunk_size: The maximum number of rows in each chunk
+            columns: The waveform-level fields (see WAVEFORM_FIELDS) to include in each row.  If None, all are included.
+            cavities: The cavity names or glob patterns to include.  If None, all cavities are queried.
+
+        Yields:
+            Lists of at most chunk_size dictionaries in the same format as query_waveform_data.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least one.")
+        if sids is None or len(sids) == 0:
+            raise ValueError("Must specify at least one sid")
+        columns = self._get_columns(columns)
+
+        # Large sid sets are queried one sid chunk at a time.  Rows are carried over between sid chunks so that every
+        # yielded chunk except the last has exactly chunk_size rows.
+        pending = []
+        conn = self._open_stream_connection()
+        try:
+            for sid_chunk in self._chunk_sids(sids):
+                time_range = self._get_scan_time_range(sid_chunk)
+                sql, data = self._gen_waveform_data_sql(sid_chunk, signal_names, array_names, time_range=time_range,
+                                                        cavities=cavities)
+
+                cursor = None
+                try:
+                    waveforms = self._fetch_waveforms(conn, sid_chunk, signal_names, columns, time_range,
+                                                      cavities=cavities)
+                    cursor = conn.cursor(buffered=False)
+                    cursor.execute(sql, data)
+                    while True:
+                        rows = cursor.fetchmany(chunk_size - len(pending))
+                        if len(rows) == 0:
+                            break
+                        for wid, wadid, name, value in rows:
+                            row = waveforms[wid].copy()
+                            row['wadid'] = wadid
+                            row['name'] = name
+                            row['data'] = decode_array(value)
+                            pending.append(row)
+                        if len(pending) == chunk_size:
+                            yield pending
+                            pending = []
+
+                finally:
+                    # If the generator was closed early, closing the cursor would download the rest of the results
+                    if cursor is not None and not conn.unread_result:
+                        cursor.close()
+        finally:
+            self._close_stream_connection(conn)
+
+        if len(pending) > 0:
+            yield pending
+
+    def _open_stream_connection(self) -> mysql.connector.MySQLConnection:
+        """Open a new connection that is not shared with other queries for streaming results."""
+        return mysql.connector.connect(**self._connect_args)
+
+    @staticmethod
+    def _close_stream_connection(conn: mysql.connector.MySQLConnection):
+        """Close a streaming connection.  If results are pending, drop it instead of downloading them."""
+        if conn.unread_result:
+            # Closes the socket without reading the pending results or sending a QUIT command
+            conn.shutdown()
+        else:
+            conn.close()
+
+    def _get_scan_from_clause(self, begin: datetime, end: datetime, q_filter: QueryFilter,
+                              metric_filter: Optional[WaveformMetricFilter] = None) -> Tuple[str, List[Any]]:
+        """Generate the FROM clause that selects the matching rows of the scan table, planned if there is a planner."""
+        if self.filter_planner is not None:
+            return self.filter_planner.gen_from_clause(self, begin, end, q_filter, metric_filter=metric_filter)
+        filters, data = self.get_scan_join_clauses(begin, end, q_filter, metric_filter,
+                                                   partitioned=metric_filter is not None and self.is_partitioned())
+        return f"FROM scan \n{filters}", data
+
+    # noinspection PyTypeChecker
+    def estimate_query(self, begin: datetime = None, end: datetime = None, q_filter: QueryFilter = None, *,
+                       signal_names: Optional[List[str]] = None, array_names: Optional[List[str]] = None,
+                       cavities: Optional[Sequence[str]] = None,
+                       metric_filter: Optional[WaveformMetricFilter] = None) -> Dict[str, Any]:
+        """Count the scans, waveforms and arrays a query would return using aggregate queries.
+
+        Only the counts are transferred.  The database still reads the matching arrays to measure them, so this takes
+        time on large queries, but far less than transferring and decoding them.
+
+        Args:
+            begin: The earliest scan start time.  If None, there is no earliest cutoff.
+            end: The latest scan start time.  If None, there is no latest cutoff.
+            q_filter: The filter to apply to the scan data.
+            signal_names: The signal names to include.  If None, all signals are included.
+            array_names: The array names to include.  If None, all arrays are included.
+            cavities: The cavity names or glob patterns to include.  If None, all cavities are included.
+            metric_filter: The filter to apply to the scalar metrics of the scan's waveforms.
+
+        Returns:
+            A dictionary with the number of matching scans (n_scans), the number of matching waveforms with at least one
+            matching array (n_waveforms), and dictionaries keyed on array name with the number of arrays (n_arrays)
+            and their stored size in bytes (n_bytes).
+        """
+        from_clause, scan_data = self._get_scan_from_clause(begin, end, q_filter, metric_filter)
+        scans = f"WITH t1 AS (SELECT scan.sid \n            {from_clause})\n        "
+
+        sql = f"""{scans}SELECT waveform_adata.name, COUNT(DISTINCT waveform.wid) AS n_waveforms, COUNT(*) AS n_arrays,
+                SUM(LENGTH(waveform_adata.data)) AS n_bytes
+        FROM t1 
+        JOIN waveform 
+            ON t1.sid = waveform.sid
+        JOIN waveform_adata 
+            ON waveform.wid = waveform_adata.wid
+        WHERE TRUE
+        """
+        data = list(scan_data)
+        if signal_names is not None and len(signal_names) > 0:
+            sql += f"AND waveform.signal_name IN ({', '.join(['%s'] * len(signal_names))})\n"
+            data += signal_names
+        if array_names is not None and len(array_names) > 0:
+            sql += f"AND waveform_adata.name IN ({', '.join(['%s'] * len(array_names))})\n"
+            data += array_names
+        cavity_test, cavity_data = self.get_cavity_clause(cavities)
+        if cavity_test != "":
+            sql += f"AND {cavity_test}\n"
+            data += cavity_data
+        if self.is_partitioned():
+            for table in ("waveform", "waveform_adata"):
+                tests, time_data = self.get_scan_time_clauses(begin, end, table=table)
+                sql += "".join(f"AND {test}\n" for test in tests)
+                data += time_data
+        # The rollup row with a NULL name has the totals across array names
+        sql += "GROUP BY waveform_adata.name WITH ROLLUP"
+
+        cursor = None
+        with self.connection() as conn:
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(f"{scans}SELECT COUNT(*) AS n_scans FROM t1", scan_data)
+                n_scans = cursor.fetchone()['n_scans']
+                cursor.execute(sql, data)
+                rows = cursor.fetchall()
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+        estimate = {'n_scans': int(n_scans), 'n_waveforms': 0, 'n_arrays': {}, 'n_bytes': {}}
+        for row in rows:
+            if row['name'] is None:
+                estimate['n_waveforms'] = int(row['n_waveforms'])
+            else:
+                estimate['n_arrays'][row['name']] = int(row['n_arrays'])
+                estimate['n_bytes'][row['name']] = int(row['n_bytes'])
+        return estimate
+
+    def count_waveform_data(self, sids: List[int], signal_names: Optional[List[str]],
+                            array_names: Optional[List[str]], *,
+                            cavities: Optional[Sequence[str]] = None) -> Dict[str, int]:
+        """Count the waveform arrays that query_waveform_data would return, without transferring them.
+
+        Args:
+            sids: A list of scan database identifiers to query waveform data
+            signal_names: A list of the signal names to include data from  (GMES, PMES, etc.).  If None, all signals are
+                          queried.
+            array_names: A list of the array names to include data from (names of array transforms, e.g. raw
+                           or power_spectrum). If None, all array types are queried.
+            cavities: The cavity names or glob patterns to include.  If None, all cavities are queried.
+
+        Returns:
+            A dictionary keyed on array name with the number of matching arrays.
+        """
+        if sids is None or len(sids) == 0:
+            raise ValueError("Must specify at least one sid")
+
+        counts = {}
+        for row in self._fan_out(self._count_waveform_data, sids, signal_names, array_names, cavities):
+            counts[row['name']] = counts.get(row['name'], 0) + row['n_arrays']
+        return counts
+
+    # noinspection PyTypeChecker
+    def _count_waveform_data(self, sids: List[int], signal_names: Optional[List[str]],
+                             array_names: Optional[List[str]],
+                             cavities: Optional[Sequence[str]]) -> List[Dict[str, Any]]:
+        """Count the waveform arrays for a single chunk of sids.  See count_waveform_data."""
+        sql, data = self._gen_waveform_data_sql(sids, signal_names, array_names,
+                                                select="waveform_adata.name, COUNT(*) AS n_arrays",
+                                                time_range=self._get_scan_time_range(sids), cavities=cavities)
+        sql += "GROUP BY waveform_adata.name"
+
+        cursor = None
+        with self.connection() as conn:
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(sql, data)
+                rows = cursor.fetchall()
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+        return rows
+
+    @staticmethod
+    def _get_columns(columns: Optional[Sequence[str]]) -> Tuple[str, ...]:
+        """Check the requested waveform-level fields.  None selects all of them."""
+        if columns is None:
+            return WAVEFORM_FIELDS
+        unknown = [column for column in columns if column not in WAVEFORM_FIELDS]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown waveform columns {unknown}.  Supported columns are {WAVEFORM_FIELDS}.")
+        # Keep the canonical column order
+        return tuple(column for column in WAVEFORM_FIELDS if column in columns)
+
+    # noinspection PyTypeChecker
+    @staticmethod
+    def _fetch_waveforms(conn: mysql.connector.MySQLConnection, sids: List[int], signal_names: Optional[List[str]],
+                         columns: Tuple[str, ...], time_range: Optional[Tuple[datetime, datetime]], *,
+                         cavities: Optional[Sequence[str]] = None) -> Dict[int, Dict[str, Any]]:
+        """Query the waveform-level fields once per waveform so that they are not repeated in every array row.
+
+        Returns:
+            A dictionary keyed on wid of dictionaries holding the wid and the requested columns
+        """
+        sid_params = ", ".join(["%s" for _ in range(len(sids))])
+        sql = f"SELECT {', '.join(('wid',) + columns)} FROM waveform WHERE sid IN ({sid_params})"
+        data = list(sids)
+        if signal_names is not None and len(signal_names) > 0:
+            sql += f" AND signal_name IN ({', '.join(['%s'] * len(signal_names))})"
+            data += signal_names
+        cavity_test, cavity_data = WaveformDB.get_cavity_clause(cavities)
+        if cavity_test != "":
+            sql += f" AND {cavity_test}"
+            data += cavity_data
+        if time_range is not None:
+            sql += " AND scan_start_utc BETWEEN %s AND %s"
+            data += list(time_range)
+
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, data)
+            waveforms = {row[0]: dict(zip(('wid',) + columns, row)) for row in cursor}
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return waveforms
+
+    @staticmethod
+    def _gen_waveform_data_sql(sids: List[int], signal_names: Optional[List[str]], array_names: Optional[List[str]], *,
+                               select: str = f"{_ARRAY_COLUMNS}, waveform_adata.data",
+                               time_range: Optional[Tuple[datetime, datetime]] = None,
+                               cavities: Optional[Sequence[str]] = None) -> Tuple[str, List[Any]]:
+        """Generate the SQL statement and data used to query waveform array data.
+
+        If time_range is given, both tables are limited to that range of scan start times so that only the partitions
+        holding the scans are read.  See _get_scan_time_range.
+        """
         if sids is None or len(sids) == 0:
             raise ValueError("Must specify at least one sid")
 
-        data = sids
+        data = list(sids)
         sid_params = ", ".join(["%s" for _ in range(len(sids))])
         sql = f"""
-        SELECT * FROM waveform 
+        SELECT {select} FROM waveform 
             JOIN waveform_adata 
                 ON waveform.wid = waveform_adata.wid
                 WHERE waveform.sid in ({sid_params})
@@ -198,25 +1071,48 @@ class WaveformDB:
             array_name_params = ", ".join(["%s" for _ in range(len(array_names))])
             sql += f"AND waveform_adata.name IN ({array_name_params})\n"
 
-        cursor = None
-        try:
-            cursor = self.conn.cursor(dictionary=True)
-            cursor.execute(sql, data)
+        cavity_test, cavity_data = WaveformDB.get_cavity_clause(cavities)
+        if cavity_test != "":
+            data += cavity_data
+            sql += f"AND {cavity_test}\n"
 
-            rows = []
-            for row in cursor:
-                row['data'] = np.array(json.loads(row['data']))
-                rows.append(row)
+        if time_range is not None:
+            data += list(time_range) * 2
+            sql += "AND waveform.scan_start_utc BETWEEN %s AND %s AND waveform_adata.scan_start_utc BETWEEN %s AND %s\n"
 
-        finally:
-            if cursor is not None:
-                cursor.close()
+        return sql, data
 
-        return rows
+    # noinspection PyTypeChecker
+    def _get_scan_time_range(self, sids: List[int]) -> Optional[Tuple[datetime, datetime]]:
+        """Get the earliest and latest start times of a set of scans if the tables are partitioned.
+
+        The partitioned tables are not keyed on sid, so waveform queries also compare scan_start_utc to this range to
+        let the database prune the partitions that cannot hold the scans.
+
+        Returns:
+            The (earliest, latest) scan start times, or None if the tables are not partitioned.
+        """
+        if not self.is_partitioned():
+            return None
+
+        sid_params = ", ".join(["%s" for _ in range(len(sids))])
+        cursor = None
+        with self.connection() as conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f"SELECT MIN(scan_start_utc), MAX(scan_start_utc) FROM scan WHERE sid IN ({sid_params})",
+                               list(sids))
+                time_range = tuple(cursor.fetchone())
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+        return time_range
 
     # noinspection PyTypeChecker
     def query_waveform_metadata(self, sids: List[int], signal_names: List[str],
-                                metric_names: List[str]) -> List[Dict[str, Any]]:
+                                metric_names: List[str], *, columns: Optional[Sequence[str]] = None,
+                                cavities: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
         """Queries the waveform scalar metadata for a given set of sids, signal_names, and metric names.
 
         Results are stored internal to this object.
@@ -225,15 +1121,26 @@ class WaveformDB:
             sids: A list of scan database identifiers to query waveform data
             signal_names: A list of the signal names to include data from  (GMES, PMES, etc.)
             metric_names: A list of the scalar metad to include in the output (mean, median, etc.).  If None, get all.
+            columns: The waveform-level fields (see WAVEFORM_FIELDS) to include in each row.  If None, all are included.
+            cavities: The cavity names or glob patterns (e.g. "2L22*" for a zone) to include.  If None, all cavities
+                      are queried.  See get_cavity_clause.
 
         Returns:
             A list of dictionaries each containing the scalar metadata for a single waveform.
         """
+        return self._fan_out(self._query_waveform_metadata, sids, signal_names, metric_names,
+                             self._get_columns(columns), cavities)
+
+    # pylint: disable=too-many-locals,too-many-positional-arguments
+    # noinspection PyTypeChecker
+    def _query_waveform_metadata(self, sids: List[int], signal_names: List[str], metric_names: List[str],
+                                 columns: Tuple[str, ...], cavities: Optional[Sequence[str]]) -> List[Dict[str, Any]]:
+        """Queries the waveform scalar metadata for a single chunk of sids.  See query_waveform_metadata."""
         sid_params = ", ".join(["%s" for _ in range(len(sids))])
         signal_params = ", ".join(["%s" for _ in range(len(signal_names))])
 
         sql = f"""
-        SELECT * FROM waveform 
+        SELECT waveform_sdata.wid, waveform_sdata.name, waveform_sdata.value FROM waveform 
             JOIN waveform_sdata 
                 ON waveform.wid = waveform_sdata.wid
                 WHERE waveform.sid in ({sid_params}) 
@@ -246,38 +1153,134 @@ class WaveformDB:
             sql += f" AND waveform_sdata.name IN ({meta_params})"
             data += metric_names
 
-        cursor = None
-        try:
-            cursor = self.conn.cursor(dictionary=True)
-            cursor.execute(sql, data)
-            rows = []
-            for row in cursor:
-                rows.append(row)
+        cavity_test, cavity_data = self.get_cavity_clause(cavities)
+        if cavity_test != "":
+            sql += f" AND {cavity_test}"
+            data += cavity_data
 
-        finally:
-            if cursor is not None:
-                cursor.close()
+        time_range = self._get_scan_time_range(sids)
+        if time_range is not None:
+            sql += " AND waveform.scan_start_utc BETWEEN %s AND %s AND waveform_sdata.scan_start_utc BETWEEN %s AND %s"
+            data += list(time_range) * 2
+
+        cursor = None
+        with self.connection() as conn:
+            try:
+                waveforms = self._fetch_waveforms(conn, sids, signal_names, columns, time_range, cavities=cavities)
+                cursor = conn.cursor()
+                cursor.execute(sql, data)
+                rows = cursor.fetchall()
+            finally:
+                if cursor is not None:
+                    cursor.close()
 
         # Convert the row-per-metadata to row-per-waveform.  Keep a single row as a dictionary for easy consumption.
         meta = {}
-        for row in rows:
-            wid = row['wid']
+        for wid, name, value in rows:
             if wid not in meta:
-                meta[wid] = {}
-
-            # one sid maps to many wids, but each wids maps to one sid
-            meta[wid]['wid'] = wid
-            meta[wid]['sid'] = row['sid']
-            meta[wid]['cavity'] = row['cavity']
-            meta[wid]['signal_name'] = row['signal_name']
-            meta[wid]['comment'] = row['comment']
-            meta[wid]['sample_rate_hz'] = row['sample_rate_hz']
-            meta[wid][row['name']] = row['value']
+                meta[wid] = waveforms[wid].copy()
+            meta[wid][name] = value
 
         return list(meta.values())
 
+    def _chunk_sids(self, sids: List[int]) -> List[List[int]]:
+        """Split a list of sids into sorted, non-overlapping chunks of at most sid_chunk_size sids."""
+        sids = sorted(set(sids))
+        return [sids[idx:idx + self.sid_chunk_size] for idx in range(0, len(sids), self.sid_chunk_size)]
+
+    def _fan_out(self, func: Callable[..., List[Dict[str, Any]]], sids: List[int], *args) -> List[Dict[str, Any]]:
+        """Run a per-sid query on chunks of sids and merge the results in sid order.
+
+        Chunks run concurrently on the pooled connections when the pool has more than one connection.  Otherwise, they
+        run one after another on the shared connection.
+
+        Args:
+            func: A function taking a list of sids followed by args and returning a list of rows
+            sids: The scan database identifiers to query
+            args: Additional arguments passed to func
+
+        Returns:
+            The concatenated rows of each chunk, in sid chunk order.
+        """
+        chunks = self._chunk_sids(sids)
+        if len(chunks) == 1:
+            return func(chunks[0], *args)
+
+        if self.pool_size is None or self.pool_size < 2:
+            results = [func(chunk, *args) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.pool_size, len(chunks))) as executor:
+                results = list(executor.map(lambda chunk: func(chunk, *args), chunks))
+
+        return [row for result in results for row in result]
+
+    # noinspection PyTypeChecker
+    def query_compression_report(self, sids: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+        """Report the storage size and compression ratio of the waveform arrays for each signal and array name.
+
+        The arrays are aggregated in the database by signal name, array name and header, so only one row per distinct
+        header is transferred.  The compression ratio compares the stored size of binary arrays against their
+        uncompressed size.  Legacy JSON arrays are counted separately since their uncompressed size is not recorded.
+
+        Args:
+            sids: A list of scan database identifiers to include in the report.  If None, all scans are included.
+
+        Returns:
+            A list of dictionaries, one per (signal_name, array name), with the keys signal_name, name, n_arrays,
+            n_legacy_arrays, legacy_bytes, stored_bytes, uncompressed_bytes, and compression_ratio.
+        """
+        # Legacy JSON arrays all share the NULL header so that they form a single group
+        sql = f"""
+        SELECT waveform.signal_name, waveform_adata.name,
+               CASE WHEN LEFT(waveform_adata.data, {len(MAGIC)}) = %s THEN LEFT(waveform_adata.data, {HEADER.size})
+                    ELSE NULL END AS header,
+               COUNT(*) AS n_arrays, SUM(LENGTH(waveform_adata.data)) AS n_bytes
+        FROM waveform
+            JOIN waveform_adata
+                ON waveform.wid = waveform_adata.wid
+        """
+        data = [MAGIC]
+        if sids is not None and len(sids) > 0:
+            sql += f"WHERE waveform.sid IN ({', '.join(['%s' for _ in range(len(sids))])})\n"
+            data += sids
+        sql += "GROUP BY waveform.signal_name, waveform_adata.name, header"
+
+        report = {}
+        cursor = None
+        with self.connection() as conn:
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(sql, data)
+                for row in cursor:
+                    key = (row['signal_name'], row['name'])
+                    if key not in report:
+                        report[key] = {'signal_name': row['signal_name'], 'name': row['name'], 'n_arrays': 0,
+                                       'n_legacy_arrays': 0, 'legacy_bytes': 0, 'stored_bytes': 0,
+                                       'uncompressed_bytes': 0}
+                    entry = report[key]
+                    n_arrays = int(row['n_arrays'])
+                    n_bytes = int(row['n_bytes'])
+                    if row['header'] is not None and is_binary(row['header']):
+                        _, dtype, _, length = read_header(row['header'])
+                        entry['n_arrays'] += n_arrays
+                        entry['stored_bytes'] += n_bytes
+                        entry['uncompressed_bytes'] += n_arrays * (HEADER.size + length * dtype.itemsize)
+                    else:
+                        entry['n_legacy_arrays'] += n_arrays
+                        entry['legacy_bytes'] += n_bytes
+            finally:
+                if cursor is not None:
+                    cursor.close()
+
+        for entry in report.values():
+            entry['compression_ratio'] = None
+            if entry['stored_bytes'] > 0:
+                entry['compression_ratio'] = entry['uncompressed_bytes'] / entry['stored_bytes']
+
+        return list(report.values())
+
     @staticmethod
-    def gen_scan_join_statements(tests: List[Tuple[str, str, Any]]) -> Tuple[str, List[Any]]:
+    def gen_scan_join_statements(tests: List[Union[Tuple[str, str, Any], FilterGroup]]) -> Tuple[str, List[Any]]:
         """Generate a JOIN/WHERE statement that will filter out scan IDs that don't match the given test.
 
         Note: this method checks the type of the comparison target and builds the SQL statement around the table for
@@ -285,30 +1288,34 @@ class WaveformDB:
 
         Args:
             tests: A List of 3-tuples of format (metadata_name, comparison, comparison_target), e.g.
-                   ("R2XXITOT", ">=", "10.0")
+                   ("R2XXITOT", ">=", "10.0"), or FilterGroups that each become a single JOIN
         Returns:
              Two items, the compound JOIN statement and a list of data values to be used in the prepared statement query
         """
         sql = ""
         data = []
         for idx, item in enumerate(tests):
-            data.append(item[0])
-            data.append(item[2])
-            table = "scan_fdata"
-            if isinstance(item[2], str):
-                table = "scan_sdata"
-            sql += f" JOIN (SELECT {table}.sid FROM {table} WHERE name = "
-            sql += f"%s and value {item[1]} %s) as s{idx} ON scan.sid = s{idx}.sid\n"
+            if isinstance(item, FilterGroup):
+                subquery, item_data = item.gen_subquery()
+            else:
+                select, item_data = QueryFilter.gen_term_select(*item)
+                subquery = f"({select})"
+            sql += f" JOIN {subquery} as s{idx} ON scan.sid = s{idx}.sid\n"
+            data += item_data
         return sql, data
 
     @classmethod
-    def get_scan_join_clauses(cls, begin: datetime, end: datetime, q_filter: QueryFilter) -> tuple[str, List[str]]:
+    def get_scan_join_clauses(cls, begin: datetime, end: datetime, q_filter: QueryFilter,
+                              metric_filter: Optional[WaveformMetricFilter] = None, *,
+                              partitioned: bool = False) -> tuple[str, List[str]]:
         """Generates JOIN/WHERE clauses for efficiently filtering scans by its metadata.
 
         Args:
             begin: The earliest scan start time
             end: The latest scan end time
             q_filter: The filter to apply to the query
+            metric_filter: The filter to apply to the scalar metrics of the scan's waveforms
+            partitioned: Whether the tables are partitioned by month.  Only needed with a metric_filter.
 
         Returns:
             A string of JOIN/WHERE statements 
@@ -318,49 +1325,319 @@ class WaveformDB:
         # Process the other filters on scan metadata.  Split up the string based values from the numeric values since
         # they are in different tables.
         if q_filter is not None and len(q_filter) > 0:
-            for item in zip(q_filter.params, q_filter.ops, q_filter.values):
-                meta_tests.append((item[0], item[1], item[2]))
+            meta_tests = q_filter.get_items()
 
         sql, data = WaveformDB.gen_scan_join_statements(meta_tests)
 
+        scan_tests, scan_data = cls.get_scan_time_clauses(begin, end)
+        if metric_filter is not None and len(metric_filter) > 0:
+            metric_tests, metric_data = metric_filter.gen_conditions(begin, end, partitioned=partitioned)
+            scan_tests += metric_tests
+            scan_data += metric_data
+        if len(scan_tests) != 0:
+            sql += " WHERE " + " AND ".join(scan_tests)
+            data += scan_data
+
+        return sql, data
+
+    @staticmethod
+    def get_scan_time_clauses(begin: datetime, end: datetime, table: str = "scan") -> Tuple[List[str], List[str]]:
+        """Generate the WHERE conditions that limit scans to a range of start times.
+
+        The conditions compare scan_start_utc to constants so that the database can prune the partitions of a
+        partitioned table.
+
+        Args:
+            begin: The earliest scan start time.  If None, there is no earliest cutoff.
+            end: The latest scan start time.  If None, there is no latest cutoff.
+            table: The table whose scan_start_utc column is compared.  Only the scan table has this column unless the
+                   tables are partitioned.
+
+        Returns:
+            A list of conditions to be combined with AND, and the data for their placeholders
+        """
         scan_tests = []
+        data = []
         if begin is not None:
-            scan_tests.append(("scan.scan_start_utc", ">=",
-                               get_datetime_as_utc(begin).strftime("%Y-%m-%d %H:%M:%S.%f")))
+            scan_tests.append(f"{table}.scan_start_utc >= %s")
+            data.append(get_datetime_as_utc(begin).strftime("%Y-%m-%d %H:%M:%S.%f"))
         if end is not None:
-            scan_tests.append(("scan.scan_start_utc", "<=",
-                               get_datetime_as_utc(end).strftime("%Y-%m-%d %H:%M:%S.%f")))
+            scan_tests.append(f"{table}.scan_start_utc <= %s")
+            data.append(get_datetime_as_utc(end).strftime("%Y-%m-%d %H:%M:%S.%f"))
+        return scan_tests, data
 
-        if len(scan_tests) != 0:
-            sql += f" WHERE {scan_tests[0][0]} {scan_tests[0][1]} %s"
-            data.append(scan_tests[0][2])
-            for i in range(1, len(scan_tests)):
-                sql += f" AND {scan_tests[i][0]} {scan_tests[i][1]} %s"
-                data.append(scan_tests[i][2])
+    @staticmethod
+    def get_cavity_clause(cavities: Optional[Sequence[str]], table: str = "waveform") -> Tuple[str, List[str]]:
+        """Generate the WHERE condition that limits waveforms to a set of cavities.
 
-        return sql, data
+        Plain names are compared with IN.  Glob patterns using * and ?, e.g. "2L22*" for every cavity in zone 2L22, are
+        compared with LIKE.  Both can use the cavity column of the (sid, signal_name, cavity) waveform index when the
+        pattern starts with a literal prefix.
 
-    def delete_scans(self, sid: int) -> int:
-        """Delete a single scan and all associated data (including waveforms) from the database.
+        Args:
+            cavities: The cavity names and glob patterns to match.  If None or empty, every cavity matches.
+            table: The table whose cavity column is compared
+
+        Returns:
+            The condition, or an empty string if every cavity matches, and the data for its placeholders
+        """
+        if cavities is None or len(cavities) == 0:
+            return "", []
+
+        names = [cavity for cavity in cavities if not _is_glob(cavity)]
+        patterns = [_glob_to_like(cavity) for cavity in cavities if _is_glob(cavity)]
+        tests = []
+        if len(names) > 0:
+            tests.append(f"{table}.cavity IN ({', '.join(['%s'] * len(names))})")
+        tests += [f"{table}.cavity LIKE %s"] * len(patterns)
+        return f"({' OR '.join(tests)})", names + patterns
 
-        Note: this requires DELETE permissions which may not be available on standard usage.
+    def insert_scans(self, scans: Sequence['Scan'], batch_size: int = DEFAULT_INSERT_BATCH_SIZE) -> List[int]:
+        """Insert many scans into the database in a single transaction using multi-row INSERT statements.
 
         Args:
-            sid: The scan ID of the scan to be deleted
+            scans: The Scan objects to be inserted
+            batch_size: The maximum number of rows to include in a single INSERT statement
 
         Returns:
-            The number of deleted scans.
+            The database scan IDs assigned to the scans, in the same order as scans.
+        """
+        partitioned = self.is_partitioned()
+        with self.connection() as conn:
+            return self.write_scans(conn, scans, batch_size=batch_size, array_codec=self.array_codec,
+                                    partitioned=partitioned)
+
+    # pylint: disable=too-many-locals,too-many-statements
+    @staticmethod
+    def write_scans(conn: mysql.connector.MySQLConnection, scans: Sequence['Scan'],
+                    batch_size: int = DEFAULT_INSERT_BATCH_SIZE, array_codec: Optional[ArrayCodec] = None,
+                    partitioned: Optional[bool] = None) -> List[int]:
+        """Insert many scans into the database in a single transaction using multi-row INSERT statements.
+
+        Generated IDs are not fetched with SELECT LAST_INSERT_ID() after every row.  Instead, each multi-row INSERT
+        reports the first auto-increment ID it generated and the remaining IDs are derived from it using the server's
+        auto_increment_increment.  This relies on InnoDB allocating consecutive IDs to a multi-row INSERT, which is
+        only guaranteed for innodb_autoinc_lock_mode 0 and 1 (see get_id_allocation).  In mode 2, concurrent inserts
+        may interleave their IDs, so the scan and waveform rows are inserted one at a time and each reads its own
+        LAST_INSERT_ID().  The other tables are still batched.
+
+        The transaction is rolled back and the exception re-raised if any part of the insert fails.  The sid of each
+        Scan object is updated on success.
+
+        Args:
+            conn: Connection to the database
+            scans: The Scan objects to be inserted
+            batch_size: The maximum number of rows to include in a single INSERT statement
+            array_codec: The codec used to store waveform arrays.  If None, the legacy JSON text format is used.
+            partitioned: Whether the tables are partitioned by month, in which case every row also gets its scan's
+                         start time.  If None, the database is checked.
+
+        Returns:
+            The database scan IDs assigned to the scans, in the same order as scans.
         """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least one.")
+        if len(scans) == 0:
+            return []
 
         cursor = None
-        sql = "DELETE FROM scan WHERE sid = %s"
         try:
-            # First command begins a transaction when autocommit == False
-            cursor = self.conn.cursor()
-            cursor.execute(sql, (sid,))
-            count = cursor.rowcount
-            self.conn.commit()
+            # Transaction started by default since autocommit is off.
+            cursor = conn.cursor()
+            id_step, consecutive = get_id_allocation(cursor)
+            # Rows whose generated IDs are needed can only be batched if the IDs of a batch are consecutive
+            id_batch_size = batch_size if consecutive else 1
+            if partitioned is None:
+                partitioned = is_partitioned(cursor)
+
+            scan_rows = [scan.get_scan_row() for scan in scans]
+            sids = _insert_rows(cursor, "scan", ("scan_start_utc", "scan_end_utc"), scan_rows, id_batch_size,
+                                id_step=id_step)
+
+            # Track which (scan, cavity, signal) each waveform row belongs to so the generated wids can be matched up
+            # The child rows of partitioned tables carry a copy of their scan's start time
+            extra = ("scan_start_utc",) if partitioned else ()
+
+            def _with_start(rows: List[Tuple[Any, ...]], start: str) -> List[Tuple[Any, ...]]:
+                return [tuple(row) + (start,) for row in rows] if partitioned else rows
+
+            wf_keys = []
+            wf_rows = []
+            fdata_rows = []
+            sdata_rows = []
+            for scan, sid, (start, _) in zip(scans, sids, scan_rows):
+                for cav, signal_name in scan.get_waveform_keys():
+                    wf_keys.append((scan, cav, signal_name, start))
+                    wf_rows += _with_start([scan.get_waveform_row(sid, cav, signal_name)], start)
+                fdata_rows += _with_start(scan.get_scan_fdata_rows(sid), start)
+                sdata_rows += _with_start(scan.get_scan_sdata_rows(sid), start)
+
+            wids = _insert_rows(cursor, "waveform", ("sid", "cavity", "signal_name", "sample_rate_hz") + extra,
+                                wf_rows, id_batch_size, id_step=id_step)
+
+            adata_rows = []
+            wsdata_rows = []
+            for (scan, cav, signal_name, start), wid in zip(wf_keys, wids):
+                adata_rows += _with_start(scan.get_waveform_adata_rows(wid, cav, signal_name, array_codec=array_codec),
+                                          start)
+                wsdata_rows += _with_start(scan.get_waveform_sdata_rows(wid, cav, signal_name), start)
+
+            _insert_rows(cursor, "waveform_adata", ("wid", "name", "data") + extra, adata_rows, batch_size)
+            _insert_rows(cursor, "waveform_sdata", ("wid", "name", "value") + extra, wsdata_rows, batch_size)
+            _insert_rows(cursor, "scan_fdata", ("sid", "name", "value") + extra, fdata_rows, batch_size)
+            _insert_rows(cursor, "scan_sdata", ("sid", "name", "value") + extra, sdata_rows, batch_size)
+
+            # Commit the transaction if we were able to successfully insert all the data.  Otherwise, an exception
+            # should have been raised that was caught to roll back the transaction.
+            conn.commit()
+        except (mysql.connector.Error, Exception) as e:
+            if conn is not None:
+                # There was a problem so this should roll back the entire transaction across all the tables.
+                conn.rollback()
+            raise e
         finally:
             if cursor is not None:
                 cursor.close()
+
+        for scan, sid in zip(scans, sids):
+            scan.id = sid
+
+        return sids
+
+    def delete_scans(self, sid: int) -> int:
+        """Delete a single scan and all associated data (including waveforms) from the database.
+
+        Note: this requires DELETE permissions which may not be available on standard usage.  Partitioned tables have
+        no foreign keys to cascade the delete, so the child rows are deleted explicitly.  Use
+        partition.drop_partitions_before to remove whole months of scans.
+
+        Args:
+            sid: The scan ID of the scan to be deleted
+
+        Returns:
+            The number of deleted scans.
+        """
+        child_sql = []
+        if self.is_partitioned():
+            child_sql = [
+                "DELETE waveform_adata FROM waveform JOIN waveform_adata ON waveform.wid = waveform_adata.wid "
+                "WHERE waveform.sid = %s",
+                "DELETE waveform_sdata FROM waveform JOIN waveform_sdata ON waveform.wid = waveform_sdata.wid "
+                "WHERE waveform.sid = %s",
+                "DELETE FROM waveform WHERE sid = %s",
+                "DELETE FROM scan_fdata WHERE sid = %s",
+                "DELETE FROM scan_sdata WHERE sid = %s",
+            ]
+
+        cursor = None
+        with self.connection() as conn:
+            sql = "DELETE FROM scan WHERE sid = %s"
+            try:
+                # First command begins a transaction when autocommit == False
+                cursor = conn.cursor()
+                for statement in child_sql:
+                    cursor.execute(statement, (sid,))
+                cursor.execute(sql, (sid,))
+                count = cursor.rowcount
+                conn.commit()
+            finally:
+                if cursor is not None:
+                    cursor.close()
         return count
+
+
+def get_id_allocation(cursor: MySQLCursor) -> Tuple[int, bool]:
+    """Get how the server allocates auto-increment IDs to multi-row INSERT statements.
+
+    InnoDB allocates consecutive IDs to the rows of a multi-row INSERT only when innodb_autoinc_lock_mode is 0
+    (traditional) or 1 (consecutive).  In mode 2 (interleaved), the default of MySQL 8, the IDs of concurrent INSERTs
+    may interleave.
+
+    Args:
+        cursor: A database cursor
+
+    Returns:
+        The auto_increment_increment of the session and whether a multi-row INSERT gets consecutive IDs
+    """
+    cursor.execute("SELECT @@SESSION.auto_increment_increment, @@GLOBAL.innodb_autoinc_lock_mode")
+    id_step, lock_mode = cursor.fetchone()
+    return int(id_step), int(lock_mode) in (0, 1)
+
+
+def _encode_page_token(scan_start_utc: datetime, sid: int) -> str:
+    """Encode the (scan_start_utc, sid) key of the last scan of a page as a continuation token."""
+    return f"{scan_start_utc:%Y-%m-%d %H:%M:%S.%f}|{sid}"
+
+
+def _decode_page_token(token: Optional[str]) -> Optional[Tuple[datetime, int]]:
+    """Decode a continuation token into a (scan_start_utc, sid) key.  None decodes to None."""
+    if token is None:
+        return None
+    try:
+        scan_start_utc, sid = token.split("|")
+        return datetime.strptime(scan_start_utc, "%Y-%m-%d %H:%M:%S.%f"), int(sid)
+    except ValueError as e:
+        raise ValueError(f"Invalid page token {token!r}") from e
+
+
+def _escape_like(value: str) -> str:
+    """Escape the LIKE wildcards % and _ and the escape character of a literal string."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _is_glob(pattern: str) -> bool:
+    """Check whether a cavity name is a glob pattern."""
+    return "*" in pattern or "?" in pattern
+
+
+def _glob_to_like(pattern: str) -> str:
+    """Convert a glob pattern using * and ? to a LIKE pattern, escaping the LIKE wildcards % and _."""
+    return _escape_like(pattern).replace("*", "%").replace("?", "_")
+
+
+def _insert_rows(cursor: MySQLCursor, table: str, columns: Sequence[str], rows: Sequence[Sequence[Any]],
+                 batch_size: int, *, max_bytes: int = DEFAULT_INSERT_BATCH_BYTES,
+                 id_step: Optional[int] = None) -> List[int]:
+    """Insert rows into a table using as few multi-row INSERT statements as the batch limits allow.
+
+    Args:
+        cursor: A database cursor
+        table: The name of the table to insert into
+        columns: The names of the columns being inserted
+        rows: The values to insert.  Each row must have one value per column.
+        batch_size: The maximum number of rows in a single INSERT statement
+        max_bytes: The approximate maximum number of bytes of str/bytes values in a single INSERT statement.  A single
+                   row larger than this is still inserted on its own.
+        id_step: The auto_increment_increment of the server.  If None, generated IDs are not computed.
+
+    Returns:
+        The auto-increment IDs generated for each row if id_step is given, otherwise an empty list.
+    """
+    row_sql = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    prefix = f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+
+    ids = []
+
+    def _flush(batch: List[Sequence[Any]]):
+        cursor.execute(prefix + ", ".join([row_sql] * len(batch)), [value for row in batch for value in row])
+        if cursor.rowcount != len(batch):
+            raise RuntimeError(f"Expected to insert {len(batch)} rows into {table}, but inserted {cursor.rowcount}")
+        if id_step is not None:
+            first_id = cursor.lastrowid
+            ids.extend(first_id + i * id_step for i in range(len(batch)))
+
+    batch = []
+    batch_bytes = 0
+    for row in rows:
+        row_bytes = sum(len(value) for value in row if isinstance(value, (str, bytes)))
+        if len(batch) > 0 and (len(batch) >= batch_size or batch_bytes + row_bytes > max_bytes):
+            _flush(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(row)
+        batch_bytes += row_bytes
+
+    if len(batch) > 0:
+        _flush(batch)
+
+    return ids
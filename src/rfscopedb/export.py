@@ -0,0 +1,192 @@
+"""This module contains functions for converting query results to Apache Arrow tables and Parquet datasets.
+
+The exported tables have one row per waveform.  Each array (raw, power_spectrum, etc.) becomes a list column and each
+scalar metric becomes a float64 column, so that a dataset pulled from the database once can be re-read locally with
+column pruning.  The list columns have a variable length since the length of an array can differ between waveforms
+(e.g., different record lengths), and a dataset is written one batch at a time before every length is known.
+
+pyarrow is an optional dependency that can be installed with `pip install rfscopedb[parquet]`.
+"""
+
+import os
+from datetime import timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .db import WAVEFORM_FIELDS
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:  # pragma: no cover - depends on the environment
+    pa = None
+    ds = None
+
+
+def require_pyarrow():
+    """Raise an ImportError with installation instructions if pyarrow is not available."""
+    if pa is None:
+        raise ImportError("Arrow and Parquet export requires the pyarrow package (pip install rfscopedb[parquet]).")
+
+
+def build_schema(array_names: Sequence[str], metric_names: Sequence[str]) -> 'pa.Schema':
+    """Build the schema of an exported table.
+
+    Args:
+        array_names: The names of the array columns
+        metric_names: The names of the scalar metric columns
+
+    Returns:
+        The Arrow schema
+    """
+    require_pyarrow()
+    fields = [
+        pa.field("date", pa.string()),
+        pa.field("cavity", pa.string()),
+        pa.field("sid", pa.int64()),
+        pa.field("wid", pa.int64()),
+        pa.field("signal_name", pa.string()),
+        pa.field("sample_rate_hz", pa.float64()),
+        pa.field("scan_start_utc", pa.timestamp("us", tz="UTC")),
+    ]
+    fields += [pa.field(name, pa.float64()) for name in metric_names]
+    fields += [pa.field(name, pa.large_list(pa.float64())) for name in array_names]
+    return pa.schema(fields)
+
+
+# pylint: disable=too-many-locals
+def build_record_batch(scan_meta: pd.DataFrame, array_rows: List[Dict[str, Any]], metric_rows: List[Dict[str, Any]],
+                       schema: Optional['pa.Schema'] = None, *, array_names: Optional[Sequence[str]] = None,
+                       metric_names: Optional[Sequence[str]] = None) -> 'pa.RecordBatch':
+    """Convert waveform query results to a record batch with one row per waveform.
+
+    Args:
+        scan_meta: The scan metadata with at least the sid and scan_start_utc columns (see Query.scan_meta)
+        array_rows: Results of WaveformDB.query_waveform_data
+        metric_rows: Results of WaveformDB.query_waveform_metadata
+        schema: The schema to conform to.  If None, the schema is inferred from the data.
+        array_names: The array columns of an inferred schema.  If None, the arrays found in array_rows are used.
+        metric_names: The metric columns of an inferred schema.  If None, the metrics found in metric_rows are used.
+
+    Returns:
+        The record batch
+
+    Raises:
+        ValueError: If the data has an array or metric that is not in the schema
+    """
+    require_pyarrow()
+
+    waveforms = {}
+    arrays = {}
+    metrics = {}
+    for row in array_rows:
+        waveforms.setdefault(row['wid'], row)
+        arrays.setdefault(row['name'], {})[row['wid']] = row['data']
+    for row in metric_rows:
+        waveforms.setdefault(row['wid'], row)
+        for key, value in row.items():
+            if key != 'wid' and key not in WAVEFORM_FIELDS:
+                metrics.setdefault(key, {})[row['wid']] = value
+
+    if schema is None:
+        schema = build_schema(list(arrays.keys()) if array_names is None else list(array_names),
+                              list(metrics.keys()) if metric_names is None else list(metric_names))
+    _check_schema(schema, arrays, metrics)
+
+    wids = sorted(waveforms.keys())
+    starts = dict(zip(scan_meta.sid.values.tolist(), scan_meta.scan_start_utc))
+    start_utc = [_as_utc(starts[waveforms[wid]['sid']]) for wid in wids]
+
+    columns = {
+        "date": pa.array([start.strftime("%Y-%m-%d") for start in start_utc], pa.string()),
+        "cavity": pa.array([waveforms[wid]['cavity'] for wid in wids], pa.string()),
+        "sid": pa.array([waveforms[wid]['sid'] for wid in wids], pa.int64()),
+        "wid": pa.array(wids, pa.int64()),
+        "signal_name": pa.array([waveforms[wid]['signal_name'] for wid in wids], pa.string()),
+        "sample_rate_hz": pa.array([waveforms[wid]['sample_rate_hz'] for wid in wids], pa.float64()),
+        "scan_start_utc": pa.array(start_utc, pa.timestamp("us", tz="UTC")),
+    }
+    for field in schema:
+        if field.name in columns:
+            continue
+        if pa.types.is_large_list(field.type):
+            columns[field.name] = _build_list(arrays.get(field.name, {}), wids)
+        else:
+            values = metrics.get(field.name, {})
+            columns[field.name] = pa.array([values.get(wid) for wid in wids], field.type)
+
+    return pa.RecordBatch.from_arrays([columns[field.name] for field in schema], schema=schema)
+
+
+def to_table(batches: Iterable['pa.RecordBatch']) -> Optional['pa.Table']:
+    """Combine record batches into a single table.  Returns None if there are no batches."""
+    require_pyarrow()
+    batches = list(batches)
+    if len(batches) == 0:
+        return None
+    return pa.Table.from_batches(batches)
+
+
+def write_parquet(batches: Iterable['pa.RecordBatch'], path: str, partition_by: Sequence[str] = ("date", "cavity")):
+    """Write record batches to a hive partitioned Parquet dataset one batch at a time.
+
+    Args:
+        batches: The record batches to write.  All must share the same schema.
+        path: The directory of the dataset.  It must not exist or be empty so that exports are never mixed.
+        partition_by: The columns used to partition the dataset into directories
+
+    Raises:
+        FileExistsError: If path is a directory that is not empty
+    """
+    require_pyarrow()
+    if os.path.isdir(path) and len(os.listdir(path)) > 0:
+        raise FileExistsError(f"Cannot write a Parquet dataset to '{path}' since it is not empty.")
+    batches = iter(batches)
+    first = next(batches, None)
+    if first is None:
+        return
+
+    ds.write_dataset(_chain(first, batches), path, schema=first.schema, format="parquet",
+                     partitioning=list(partition_by), partitioning_flavor="hive",
+                     existing_data_behavior="error")
+
+
+def _chain(first: 'pa.RecordBatch', rest: Iterator['pa.RecordBatch']) -> Iterator['pa.RecordBatch']:
+    """Yield the first batch followed by the rest."""
+    yield first
+    yield from rest
+
+
+def _check_schema(schema: 'pa.Schema', arrays: Dict[str, Dict[int, np.ndarray]], metrics: Dict[str, Dict[int, Any]]):
+    """Raise a ValueError if the arrays or metrics do not fit the schema so that no data is silently dropped."""
+    for name in arrays:
+        index = schema.get_field_index(name)
+        if index < 0 or not pa.types.is_large_list(schema.field(index).type):
+            raise ValueError(f"Array '{name}' is not in the schema {schema.names}.")
+    unknown = [name for name in metrics if schema.get_field_index(name) < 0]
+    if len(unknown) > 0:
+        raise ValueError(f"Metrics {unknown} are not in the schema {schema.names}.")
+
+
+def _as_utc(dt):
+    """Database datetimes are naive UTC values.  Make them timezone aware."""
+    dt = pd.Timestamp(dt).to_pydatetime()
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def _build_list(values: Dict[int, np.ndarray], wids: List[int]) -> 'pa.LargeListArray':
+    """Build a list column from one array per wid.  Missing arrays are null.  The arrays may differ in length."""
+    lengths = np.array([len(values[wid]) if wid in values else 0 for wid in wids], dtype=np.int64)
+    offsets = np.zeros(len(wids) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.zeros(offsets[-1], dtype=np.float64)
+    mask = np.ones(len(wids), dtype=bool)
+    for idx, wid in enumerate(wids):
+        if wid in values:
+            flat[offsets[idx]:offsets[idx + 1]] = values[wid]
+            mask[idx] = False
+    return pa.LargeListArray.from_arrays(pa.array(offsets), pa.array(flat), mask=pa.array(mask))
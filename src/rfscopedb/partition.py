@@ -0,0 +1,281 @@
+"""This module contains tools for monthly range partitioning of the scan-keyed tables.
+
+Every scan-keyed table is partitioned on the start time of its scan with one partition per month.  Queries that are
+bounded in time only read the matching months, and old data is removed by dropping whole partitions instead of deleting
+rows one scan at a time.
+
+MariaDB does not allow foreign keys on partitioned tables and requires the partitioning column to be part of every
+unique key.  partition_tables() therefore makes these changes to the schema:
+    - The child tables get a scan_start_utc column that is a copy of their scan's start time.
+    - The primary keys become (id, scan_start_utc).
+    - The foreign keys are dropped.  WaveformDB.delete_scans deletes the child rows itself instead of relying on
+      ON DELETE CASCADE, and WaveformDB.write_scans fills in the scan_start_utc columns.
+
+Partitions are named p<YYYYMM> after the month they hold.  The first partition, pold, holds everything before the first
+partitioned month and the last partition, pmax, holds anything after the last one.  Run ensure_partitions() regularly
+(e.g., from a daily cron job) so that new months get their own partitions before any data arrives for them.
+
+These are schema changes that require a user with ALTER privileges (e.g., scope_owner).  partition_tables() copies every
+table, so run it during a maintenance window and after a backup.
+
+Example:
+    db = WaveformDB(host='localhost', user='scope_owner', password='password')
+    partition_tables(db, first_month=datetime(2024, 1, 1))
+    ensure_partitions(db, months_ahead=3)
+    drop_partitions_before(db, datetime(2025, 1, 1))
+"""
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from mysql.connector.cursor import MySQLCursor
+
+if TYPE_CHECKING:
+    from .db import WaveformDB
+
+# Parent table first.  Child rows are copied from their parent's row when backfilling scan_start_utc.
+PARTITIONED_TABLES = ("scan", "scan_fdata", "scan_sdata", "waveform", "waveform_adata", "waveform_sdata")
+
+# The auto-increment primary key of each table and the (parent table, parent key) of each child table
+_PRIMARY_KEYS = {"scan": "sid", "scan_fdata": "sfid", "scan_sdata": "ssid", "waveform": "wid",
+                 "waveform_adata": "wadid", "waveform_sdata": "wsdid"}
+_PARENTS = {"scan_fdata": ("scan", "sid"), "scan_sdata": ("scan", "sid"), "waveform": ("scan", "sid"),
+            "waveform_adata": ("waveform", "wid"), "waveform_sdata": ("waveform", "wid")}
+
+OLD_PARTITION = "pold"
+MAX_PARTITION = "pmax"
+DEFAULT_MONTHS_AHEAD = 3
+
+_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+def month_start(value: datetime, months: int = 0) -> datetime:
+    """Get the start of the month of a UTC time, optionally shifted by a number of months.
+
+    Args:
+        value: The time.  Timezone aware times are converted to UTC and naive times are assumed to be UTC.
+        months: The number of months to add
+
+    Returns:
+        The first instant of the month as a naive UTC datetime
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    idx = value.year * 12 + value.month - 1 + months
+    return datetime(idx // 12, idx % 12 + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    """Get the name of the partition that holds the data of a month."""
+    return f"p{month_start(month):%Y%m}"
+
+
+def gen_partition_definitions(first_month: datetime, last_month: datetime, *, include_old: bool = True) -> List[str]:
+    """Generate the definitions of the monthly partitions from first_month through last_month followed by pmax.
+
+    Args:
+        first_month: The first month to get its own partition
+        last_month: The last month to get its own partition
+        include_old: If True, start with the pold partition holding everything before first_month.
+
+    Returns:
+        The PARTITION clauses in order
+    """
+    month = month_start(first_month)
+    defs = [f"PARTITION {OLD_PARTITION} VALUES LESS THAN ('{month:{_FMT}}')"] if include_old else []
+    while month <= month_start(last_month):
+        defs.append(f"PARTITION {partition_name(month)} VALUES LESS THAN ('{month_start(month, 1):{_FMT}}')")
+        month = month_start(month, 1)
+    defs.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN (MAXVALUE)")
+    return defs
+
+
+def gen_partition_statements(foreign_keys: Sequence[Tuple[str, str]], first_month: datetime,
+                             last_month: datetime) -> List[str]:
+    """Generate the DDL that converts the unpartitioned tables to monthly partitioned tables.
+
+    Args:
+        foreign_keys: The (table, constraint name) of every foreign key on the scan-keyed tables
+        first_month: The first month to get its own partition
+        last_month: The last month to get its own partition
+
+    Returns:
+        The statements to run in order
+    """
+    statements = [f"ALTER TABLE {table} DROP FOREIGN KEY {name}" for table, name in foreign_keys]
+
+    # Copy the scan start time down to the children before any table is partitioned
+    for table, (parent, key) in _PARENTS.items():
+        statements.append(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS scan_start_utc DATETIME(6) NULL")
+        statements.append(f"UPDATE {table} JOIN {parent} ON {table}.{key} = {parent}.{key} "
+                          f"SET {table}.scan_start_utc = {parent}.scan_start_utc")
+
+    definitions = ",\n    ".join(gen_partition_definitions(first_month, last_month))
+    for table in PARTITIONED_TABLES:
+        change_key = f"DROP PRIMARY KEY, ADD PRIMARY KEY ({_PRIMARY_KEYS[table]}, scan_start_utc)"
+        if table in _PARENTS:
+            # No default so that clients that do not know about partitioning fail instead of writing to pold
+            change_key = f"MODIFY scan_start_utc DATETIME(6) NOT NULL, {change_key}"
+        statements.append(f"ALTER TABLE {table} {change_key}")
+        statements.append(f"ALTER TABLE {table} PARTITION BY RANGE COLUMNS (scan_start_utc) (\n    {definitions}\n)")
+
+    return statements
+
+
+def is_partitioned(cursor: MySQLCursor) -> bool:
+    """Check whether the scan table of the current database is partitioned.
+
+    Args:
+        cursor: A cursor on the database to check
+
+    Returns:
+        True if the scan table has partitions
+    """
+    cursor.execute("SELECT COUNT(*) FROM information_schema.partitions WHERE table_schema = DATABASE() "
+                   "AND table_name = 'scan' AND partition_name IS NOT NULL")
+    return cursor.fetchone()[0] > 0
+
+
+def _execute_ddl(db: 'WaveformDB', statements: Sequence[str]):
+    """Run DDL statements in order, committing after each one."""
+    cursor = None
+    with db.connection() as conn:
+        try:
+            cursor = conn.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+                # DDL commits implicitly, but the backfill UPDATEs of partition_tables do not
+                conn.commit()
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+
+# noinspection PyTypeChecker
+def list_partitions(db: 'WaveformDB', table: str = "scan") -> List[Dict[str, Any]]:
+    """List the partitions of a table in order.
+
+    Args:
+        db: The database to check
+        table: The partitioned table
+
+    Returns:
+        A dictionary per partition with its name, the exclusive upper bound of its scan start times (None for pmax) and
+        the approximate number of rows.  Empty if the table is not partitioned.
+    """
+    cursor = None
+    with db.connection() as conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT partition_name, partition_description, table_rows "
+                           "FROM information_schema.partitions "
+                           "WHERE table_schema = DATABASE() AND table_name = %s AND partition_name IS NOT NULL "
+                           "ORDER BY partition_ordinal_position", (table,))
+            rows = cursor.fetchall()
+        finally:
+            if cursor is not None:
+                cursor.close()
+            conn.rollback()
+
+    partitions = []
+    for name, description, n_rows in rows:
+        bound = None
+        if description != "MAXVALUE":
+            bound = datetime.strptime(description.strip("'")[:19], _FMT)
+        partitions.append({'name': name, 'bound': bound, 'n_rows': int(n_rows or 0)})
+    return partitions
+
+
+def partition_tables(db: 'WaveformDB', first_month: datetime, months_ahead: int = DEFAULT_MONTHS_AHEAD,
+                     dry_run: bool = False) -> List[str]:
+    """Convert the scan-keyed tables to monthly partitioned tables.  This is a one time change.
+
+    Args:
+        db: The database to partition.  The user needs privileges to alter tables.
+        first_month: The first month to get its own partition.  Older data is kept in the pold partition.
+        months_ahead: The number of months after the current one to create partitions for
+        dry_run: If True, return the statements without running them.
+
+    Returns:
+        The statements that were (or in a dry run would be) executed
+    """
+    cursor = None
+    with db.connection() as conn:
+        try:
+            cursor = conn.cursor()
+            if is_partitioned(cursor):
+                raise ValueError("The scan tables are already partitioned.")
+
+            table_params = ", ".join(["%s"] * len(PARTITIONED_TABLES))
+            cursor.execute("SELECT table_name, constraint_name FROM information_schema.referential_constraints "
+                           f"WHERE constraint_schema = DATABASE() AND table_name IN ({table_params}) "
+                           "ORDER BY table_name, constraint_name", PARTITIONED_TABLES)
+            foreign_keys = cursor.fetchall()
+
+        finally:
+            if cursor is not None:
+                cursor.close()
+            conn.rollback()
+
+    statements = gen_partition_statements(foreign_keys, first_month, month_start(datetime.now(timezone.utc),
+                                                                                 months_ahead))
+    if not dry_run:
+        _execute_ddl(db, statements)
+    return statements
+
+
+def ensure_partitions(db: 'WaveformDB', months_ahead: int = DEFAULT_MONTHS_AHEAD, now: Optional[datetime] = None,
+                      dry_run: bool = False) -> List[str]:
+    """Create the monthly partitions through months_ahead months after the current month.  Safe to run repeatedly.
+
+    New partitions are split off of pmax, which is normally empty so this is fast.
+
+    Args:
+        db: The partitioned database.  The user needs privileges to alter tables.
+        months_ahead: The number of months after the current one that should have their own partition
+        now: The current time.  If None, the current UTC time.
+        dry_run: If True, return the statements without running them.
+
+    Returns:
+        The statements that were (or in a dry run would be) executed.  Empty if no partitions were needed.
+    """
+    bounds = [item['bound'] for item in list_partitions(db) if item['bound'] is not None]
+    if len(bounds) == 0:
+        raise ValueError("The scan tables are not partitioned.  See partition_tables.")
+
+    last_month = month_start(datetime.now(timezone.utc) if now is None else now, months_ahead)
+    first_month = max(bounds)
+    if first_month > last_month:
+        return []
+
+    definitions = ",\n    ".join(gen_partition_definitions(first_month, last_month, include_old=False))
+    statements = [f"ALTER TABLE {table} REORGANIZE PARTITION {MAX_PARTITION} INTO (\n    {definitions}\n)"
+                  for table in PARTITIONED_TABLES]
+    if not dry_run:
+        _execute_ddl(db, statements)
+    return statements
+
+
+def drop_partitions_before(db: 'WaveformDB', month: datetime, dry_run: bool = False) -> List[str]:
+    """Remove all scans that started before a month by dropping their partitions.
+
+    Only whole partitions are dropped, so scans in a partition that extends past month are kept.
+
+    Args:
+        db: The partitioned database.  The user needs privileges to alter tables.
+        month: Partitions holding only data from before the start of this month are dropped.
+        dry_run: If True, return the statements without running them.
+
+    Returns:
+        The statements that were (or in a dry run would be) executed.  Empty if no partitions were old enough.
+    """
+    cutoff = month_start(month)
+    names = [item['name'] for item in list_partitions(db) if item['bound'] is not None and item['bound'] <= cutoff]
+    if len(names) == 0:
+        return []
+
+    # Children first so that an interrupted run never leaves rows without their scan
+    statements = [f"ALTER TABLE {table} DROP PARTITION {', '.join(names)}" for table in reversed(PARTITIONED_TABLES)]
+    if not dry_run:
+        _execute_ddl(db, statements)
+    return statements
@@ -0,0 +1,394 @@
+"""This module contains a cost-based planner for the scan metadata filters of WaveformDB.query_scan_rows.
+
+Without a planner, each filter term becomes a derived-table JOIN in the order given by the user.  The planner keeps
+statistics about each metadata name and uses them to estimate how many scans each term matches.  The most selective
+access path (a filter term or the scan time range) drives the query, and the remaining terms are checked with EXISTS
+semi-joins when probing them per candidate scan is cheaper than materializing their matching sids.
+
+The statistics are only used for ordering and strategy, never to drop terms, so stale statistics can make a query slower
+but never change its results.
+"""
+
+import bisect
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from .db import FilterGroup, QueryFilter
+from .utils import get_datetime_as_utc
+
+if TYPE_CHECKING:
+    from .db import WaveformDB, WaveformMetricFilter
+
+# Metadata with at most this many distinct string values have the count of each value recorded
+MAX_STRING_VALUES = 64
+
+# The assumed selectivity of a range comparison on string metadata without per-value counts
+DEFAULT_RANGE_SELECTIVITY = 1 / 3
+
+
+# pylint: disable=too-few-public-methods
+class MetadataStats:
+    """Statistics about the values of a single scan metadata name in scan_fdata or scan_sdata."""
+
+    def __init__(self, name: str, table: str, *, n_rows: int, n_distinct: int, min_value: Any, max_value: Any):
+        """Create the statistics without a histogram or value counts.
+
+        Args:
+            name: The metadata name
+            table: scan_fdata or scan_sdata
+            n_rows: The number of rows with this name (about the number of scans that have it)
+            n_distinct: The number of distinct values
+            min_value: The smallest value
+            max_value: The largest value
+        """
+        self.name = name
+        self.table = table
+        self.n_rows = n_rows
+        self.n_distinct = n_distinct
+        self.min_value = min_value
+        self.max_value = max_value
+        # Equal width histogram for float metadata.  bucket_edges has one more item than bucket_counts.  Empty if the
+        # histogram was not collected.
+        self.bucket_edges: List[float] = []
+        self.bucket_counts: List[int] = []
+        # The number of rows with each value for low cardinality string metadata.  Empty if not collected.
+        self.value_counts: Dict[str, int] = {}
+
+    # pylint: disable=too-many-return-statements
+    def estimate_rows(self, op: str, value: Any) -> float:
+        """Estimate the number of rows matching "value <op> <value>".
+
+        Args:
+            op: One of QueryFilter.valid_ops
+            value: The comparison value
+
+        Returns:
+            The estimated number of matching rows
+        """
+        if self.n_rows == 0:
+            return 0.0
+
+        if op == "IN":
+            return min(float(self.n_rows), sum(self.estimate_rows("=", item) for item in set(value)))
+        if op == "BETWEEN":
+            return max(0.0, self.estimate_rows("<=", value[1]) - self.estimate_rows("<", value[0]))
+
+        if len(self.value_counts) > 0:
+            return float(sum(count for val, count in self.value_counts.items() if _compare(val, op, value)))
+
+        if op in ("=", "!="):
+            in_range = self.min_value <= value <= self.max_value
+            n_equal = self.n_rows / max(self.n_distinct, 1) if in_range else 0.0
+            return n_equal if op == "=" else self.n_rows - n_equal
+
+        if len(self.bucket_counts) > 0:
+            # Rows with a value less than the comparison value.  Assume uniform values within a bucket.
+            idx = bisect.bisect_right(self.bucket_edges, value) - 1
+            if idx < 0:
+                n_below = 0.0
+            elif idx >= len(self.bucket_counts):
+                n_below = float(self.n_rows)
+            else:
+                lo, hi = self.bucket_edges[idx], self.bucket_edges[idx + 1]
+                frac = (value - lo) / (hi - lo) if hi > lo else 1.0
+                n_below = sum(self.bucket_counts[:idx]) + frac * self.bucket_counts[idx]
+            return n_below if op in ("<", "<=") else self.n_rows - n_below
+
+        # String range comparison without value counts.  Every value with a prefix sorts at or after the prefix.
+        if (op in ("<", "<=") and value < self.min_value) or (op in (">", ">=", "PREFIX") and value > self.max_value):
+            return 0.0
+        return self.n_rows * DEFAULT_RANGE_SELECTIVITY
+
+
+class PlannedTerm:
+    """A single filter term and the strategy the planner chose for it."""
+
+    def __init__(self, name: str, op: str, value: Any, est_rows: float):
+        self.name = name
+        self.op = op
+        self.value = value
+        self.est_rows = est_rows
+        self.table = QueryFilter.get_table(op, value)
+        # One of 'drive', 'join', or 'exists'
+        self.strategy = "join"
+
+    def gen_subquery(self) -> Tuple[str, List[Any]]:
+        """Generate a subquery selecting the sids that match this term and the data for its placeholders."""
+        select, data = QueryFilter.gen_term_select(self.name, self.op, self.value)
+        return f"({select})", data
+
+    def gen_exists(self) -> Tuple[str, List[Any]]:
+        """Generate an EXISTS condition on scan.sid for this term and the data for its placeholders."""
+        test, data = QueryFilter.gen_value_test(self.op, self.value)
+        return (f"EXISTS (SELECT 1 FROM {self.table} WHERE {self.table}.sid = scan.sid "
+                f"AND name = %s AND {test})", [self.name] + data)
+
+    def __repr__(self) -> str:
+        return f"PlannedTerm({self.name} {self.op} {self.value!r}, est_rows={self.est_rows:.1f}, {self.strategy})"
+
+
+class PlannedGroup(PlannedTerm):
+    """A FilterGroup and the strategy the planner chose for it.  The group is planned as a whole."""
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, group: FilterGroup, est_rows: float):
+        self.group = group
+        self.name = None
+        self.op = group.kind
+        self.value = None
+        self.est_rows = est_rows
+        self.table = None
+        self.strategy = "join"
+
+    def gen_subquery(self) -> Tuple[str, List[Any]]:
+        """Generate a subquery selecting the sids that match this group and the data for its placeholders."""
+        return self.group.gen_subquery()
+
+    def gen_exists(self) -> Tuple[str, List[Any]]:
+        """Generate a semi-join condition on scan.sid for this group and the data for its placeholders."""
+        subquery, data = self.group.gen_subquery()
+        return f"scan.sid IN {subquery}", data
+
+    def __repr__(self) -> str:
+        return f"PlannedGroup({self.group!r}, est_rows={self.est_rows:.1f}, {self.strategy})"
+
+
+class FilterPlanner:
+    """Plans the scan filter SQL of WaveformDB based on statistics of the scan metadata.
+
+    Pass a planner to WaveformDB(filter_planner=...).  The statistics are loaded on first use and reloaded once they
+    are older than max_age seconds.  A planner may be shared by multiple WaveformDB objects for the same database.
+    """
+
+    def __init__(self, max_age: float = 3600.0, n_buckets: int = 32):
+        """Create a planner with no statistics.
+
+        Args:
+            max_age: The number of seconds before the statistics are reloaded
+            n_buckets: The number of histogram buckets for float metadata
+        """
+        if n_buckets < 1:
+            raise ValueError("n_buckets must be at least one.")
+
+        self.max_age = max_age
+        self.n_buckets = n_buckets
+        self.stats: Dict[Tuple[str, str], MetadataStats] = {}
+        self.n_scans = 0
+        self.scan_start_range: Optional[Tuple[datetime, datetime]] = None
+        self.loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    # pylint: disable=too-many-locals
+    def refresh(self, db: 'WaveformDB'):
+        """Reload the statistics from the database.
+
+        Args:
+            db: The database to collect statistics from
+        """
+        stats = {}
+        cursor = None
+        with db.connection() as conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*), MIN(scan_start_utc), MAX(scan_start_utc) FROM scan")
+                n_scans, start_min, start_max = cursor.fetchone()
+
+                for table in ("scan_fdata", "scan_sdata"):
+                    cursor.execute(f"SELECT name, COUNT(*), COUNT(DISTINCT value), MIN(value), MAX(value) "
+                                   f"FROM {table} GROUP BY name")
+                    for name, n_rows, n_distinct, min_value, max_value in cursor.fetchall():
+                        stats[(table, name)] = MetadataStats(name, table, n_rows=n_rows, n_distinct=n_distinct,
+                                                             min_value=min_value, max_value=max_value)
+
+                cursor.execute("""
+                SELECT f.name, LEAST(FLOOR((f.value - s.lo) / s.width), %s) AS bucket, COUNT(*)
+                FROM scan_fdata AS f
+                JOIN (SELECT name, MIN(value) AS lo, NULLIF(MAX(value) - MIN(value), 0) / %s AS width
+                      FROM scan_fdata GROUP BY name) AS s
+                    ON f.name = s.name
+                GROUP BY f.name, bucket""", (self.n_buckets - 1, self.n_buckets))
+                histograms = cursor.fetchall()
+
+                cursor.execute("""
+                SELECT d.name, d.value, COUNT(*)
+                FROM scan_sdata AS d
+                JOIN (SELECT name FROM scan_sdata GROUP BY name HAVING COUNT(DISTINCT value) <= %s) AS low
+                    ON d.name = low.name
+                GROUP BY d.name, d.value""", (MAX_STRING_VALUES,))
+                value_counts = cursor.fetchall()
+            finally:
+                if cursor is not None:
+                    cursor.close()
+                # Don't leave a read transaction open on a shared connection
+                conn.rollback()
+
+        for name, bucket, count in histograms:
+            item = stats[("scan_fdata", name)]
+            if len(item.bucket_counts) == 0:
+                width = (item.max_value - item.min_value) / self.n_buckets
+                item.bucket_edges = [item.min_value + i * width for i in range(self.n_buckets)] + [item.max_value]
+                item.bucket_counts = [0] * self.n_buckets
+            # All values are in the first bucket when min == max
+            item.bucket_counts[0 if bucket is None else int(bucket)] += count
+
+        for name, value, count in value_counts:
+            stats[("scan_sdata", name)].value_counts[value] = count
+
+        with self._lock:
+            self.stats = stats
+            self.n_scans = n_scans
+            self.scan_start_range = None if start_min is None else (start_min, start_max)
+            self.loaded_at = time.monotonic()
+
+    def is_stale(self) -> bool:
+        """Check if the statistics need to be (re)loaded."""
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age
+
+    def estimate_rows(self, name: str, op: str, value: Any) -> float:
+        """Estimate the number of scans matching a single filter term.  Metadata names that do not exist match none.
+
+        Args:
+            name: The metadata name
+            op: One of QueryFilter.valid_ops
+            value: The comparison value.  Strings are compared against scan_sdata and other values against scan_fdata.
+        """
+        item = self.stats.get((QueryFilter.get_table(op, value), name))
+        if item is None:
+            return 0.0
+        return item.estimate_rows(op, value)
+
+    def estimate_group(self, group: FilterGroup) -> float:
+        """Estimate the number of scans matching a FilterGroup.
+
+        The terms of an OR group are assumed to match different scans and those of an AND group to match the same
+        scans, so these are upper bounds.
+        """
+        estimates = [self.estimate_group(item) if isinstance(item, FilterGroup) else self.estimate_rows(*item)
+                     for item in group.items]
+        if group.kind == "OR":
+            return min(float(self.n_scans), sum(estimates))
+        return min(estimates)
+
+    def estimate_time_range(self, begin: Optional[datetime], end: Optional[datetime]) -> float:
+        """Estimate the number of scans that start within a time range, assuming scans are spread evenly over time."""
+        if self.scan_start_range is None:
+            return 0.0
+        lo, hi = self.scan_start_range
+        total = (hi - lo).total_seconds()
+        if total <= 0:
+            return float(self.n_scans)
+
+        # Scan times are stored as naive UTC
+        begin = lo if begin is None else max(lo, get_datetime_as_utc(begin).replace(tzinfo=None))
+        end = hi if end is None else min(hi, get_datetime_as_utc(end).replace(tzinfo=None))
+        return max(0.0, (end - begin).total_seconds() / total) * self.n_scans
+
+    def plan_terms(self, begin: Optional[datetime], end: Optional[datetime],
+                   q_filter: Optional['QueryFilter']) -> List[PlannedTerm]:
+        """Order the filter terms by estimated selectivity and choose a strategy for each.
+
+        The most selective term drives the query unless the time range is expected to match fewer scans.  The other
+        terms are probed with EXISTS when there are fewer candidate scans than rows matching the term, and are joined
+        as derived tables otherwise.
+
+        Returns:
+            The planned terms, most selective first
+        """
+        if q_filter is None or len(q_filter) == 0:
+            return []
+
+        terms = []
+        for item in q_filter.get_items():
+            if isinstance(item, FilterGroup):
+                terms.append(PlannedGroup(item, self.estimate_group(item)))
+            else:
+                terms.append(PlannedTerm(*item, self.estimate_rows(*item)))
+        # A stable sort keeps the given order of equally selective terms
+        terms.sort(key=lambda term: term.est_rows)
+
+        n_candidates = self.estimate_time_range(begin, end)
+        if (begin is None and end is None) or terms[0].est_rows < n_candidates:
+            terms[0].strategy = "drive"
+            n_candidates = min(n_candidates, terms[0].est_rows)
+        for term in terms:
+            if term.strategy != "drive":
+                term.strategy = "exists" if n_candidates < term.est_rows else "join"
+        return terms
+
+    def gen_from_clause(self, db: 'WaveformDB', begin: Optional[datetime], end: Optional[datetime],
+                        q_filter: Optional['QueryFilter'], *,
+                        metric_filter: Optional['WaveformMetricFilter'] = None) -> Tuple[str, List[Any]]:
+        """Generate the FROM/JOIN/WHERE clauses that select the scans matching a time range and filter.
+
+        Unlike WaveformDB.get_scan_join_clauses, the clauses start with FROM and can directly follow "SELECT scan.*".
+
+        Args:
+            db: The database the query will run against.  Used to reload stale statistics.
+            begin: The earliest scan start time.  If None, there is no earliest cutoff.
+            end: The latest scan start time.  If None, there is no latest cutoff.
+            q_filter: The filter to apply to the scan metadata
+            metric_filter: The filter to apply to the scalar metrics of the scan's waveforms.  Its conditions follow the
+                           planned terms and are left to the database to plan.
+
+        Returns:
+            The SQL clauses and the data for their placeholders
+        """
+        if self.is_stale():
+            self.refresh(db)
+
+        terms = self.plan_terms(begin, end, q_filter)
+
+        sql = ""
+        data = []
+        joins = [term for term in terms if term.strategy != "exists"]
+        exists = [term for term in terms if term.strategy == "exists"]
+
+        for idx, term in enumerate(joins):
+            subquery, subquery_data = term.gen_subquery()
+            if term.strategy == "drive":
+                # Read the driving term first, then look up each of its scans by primary key
+                sql = f"FROM {subquery} AS s{idx} \nSTRAIGHT_JOIN scan ON scan.sid = s{idx}.sid\n"
+            else:
+                sql += f" JOIN {subquery} as s{idx} ON scan.sid = s{idx}.sid\n"
+            data += subquery_data
+        if not sql.startswith("FROM"):
+            sql = "FROM scan \n" + sql
+
+        where, where_data = db.get_scan_time_clauses(begin, end)
+        for term in exists:
+            condition, condition_data = term.gen_exists()
+            where.append(condition)
+            where_data += condition_data
+        if metric_filter is not None and len(metric_filter) > 0:
+            conditions, condition_data = metric_filter.gen_conditions(begin, end, partitioned=db.is_partitioned())
+            where += conditions
+            where_data += condition_data
+        data += where_data
+
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+        return sql, data
+
+
+# pylint: disable=too-many-return-statements
+def _compare(left: Any, op: str, right: Any) -> bool:
+    """Evaluate "left <op> right" for one of QueryFilter.valid_ops."""
+    if op == "IN":
+        return left in right
+    if op == "BETWEEN":
+        return right[0] <= left <= right[1]
+    if op == "PREFIX":
+        return str(left).startswith(right)
+    if op == "=":
+        return left == right
+    if op == "!=":
+        return left != right
+    if op == "<":
+        return left < right
+    if op == "<=":
+        return left <= right
+    if op == ">":
+        return left > right
+    return left >= right
@@ -0,0 +1,256 @@
+"""This module contains versioned migrations of the database schema.
+
+Each migration is applied once, in order, and recorded in the schema_version table, so that index and storage changes
+ship together with the client code that depends on them.  Migrations change the schema and require a user with
+ALTER/CREATE/INDEX privileges (e.g., scope_owner).
+
+Example:
+    db = WaveformDB(host='localhost', user='scope_owner', password='password')
+    for statement in upgrade(db, dry_run=True):
+        print(statement)
+    upgrade(db)
+"""
+
+import re
+from typing import Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .db import WaveformDB
+
+
+# pylint: disable=too-few-public-methods
+class Migration:
+    """A numbered set of DDL statements that move the schema from version - 1 to version."""
+
+    def __init__(self, version: int, description: str, statements: Sequence[str]):
+        """Define a migration.
+
+        Args:
+            version: The schema version after the migration is applied
+            description: A short description that is recorded in the schema_version table
+            statements: The DDL statements to run in order.  These should be safe to re-run (e.g., IF NOT EXISTS) since
+                        DDL is not transactional and a migration may fail part way.
+        """
+        self.version = version
+        self.description = description
+        self.statements = tuple(statements)
+
+    def __repr__(self) -> str:
+        return f"Migration({self.version}, {self.description!r})"
+
+
+# The tables that existed before versioning was added.  Existing databases already have them, so these only matter for
+# a new, empty database.  These must match the tables created by the database container's init scripts, which is
+# checked by the schema integration tests.
+_BASELINE = Migration(1, "Baseline scan and waveform tables", (
+    """CREATE TABLE IF NOT EXISTS scan (
+        sid INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        scan_start_utc DATETIME(6) NOT NULL,
+        scan_end_utc DATETIME(6) NOT NULL,
+        INDEX i_scan_start (scan_start_utc)
+    )""",
+    """CREATE TABLE IF NOT EXISTS scan_fdata (
+        sfid INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        sid INT UNSIGNED NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        value DOUBLE NOT NULL,
+        FOREIGN KEY (sid) REFERENCES scan (sid) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS scan_sdata (
+        ssid INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        sid INT UNSIGNED NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        value VARCHAR(255) NOT NULL,
+        FOREIGN KEY (sid) REFERENCES scan (sid) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS waveform (
+        wid INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        sid INT UNSIGNED NOT NULL,
+        cavity VARCHAR(32) NOT NULL,
+        signal_name VARCHAR(32) NOT NULL,
+        sample_rate_hz DOUBLE NOT NULL,
+        comment VARCHAR(255) DEFAULT NULL,
+        FOREIGN KEY (sid) REFERENCES scan (sid) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS waveform_adata (
+        wadid INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        wid INT UNSIGNED NOT NULL,
+        name VARCHAR(64) NOT NULL,
+        data LONGTEXT NOT NULL,
+        FOREIGN KEY (wid) REFERENCES waveform (wid) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS waveform_sdata (
+        wsdid INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        wid INT UNSIGNED NOT NULL,
+        name VARCHAR(64) NOT NULL,
+        value DOUBLE NOT NULL,
+        FOREIGN KEY (wid) REFERENCES waveform (wid) ON DELETE CASCADE
+    )""",
+))
+
+# The ordered list of every migration.  Append new migrations to the end and never edit one that has been released.
+MIGRATIONS = (
+    _BASELINE,
+    Migration(2, "Covering indexes for scan filters and waveform lookups", (
+        # Filter terms look up sids by (name, value).  Including sid makes these covering indexes.
+        "CREATE INDEX IF NOT EXISTS i_scan_fdata_name_value ON scan_fdata (name, value, sid)",
+        "CREATE INDEX IF NOT EXISTS i_scan_sdata_name_value ON scan_sdata (name, value, sid)",
+        # EXISTS semi-joins and metadata queries probe by (sid, name)
+        "CREATE INDEX IF NOT EXISTS i_scan_fdata_sid_name ON scan_fdata (sid, name)",
+        "CREATE INDEX IF NOT EXISTS i_scan_sdata_sid_name ON scan_sdata (sid, name)",
+        "CREATE INDEX IF NOT EXISTS i_waveform_sid_signal ON waveform (sid, signal_name, cavity)",
+        "CREATE INDEX IF NOT EXISTS i_waveform_adata_wid_name ON waveform_adata (wid, name)",
+        "CREATE INDEX IF NOT EXISTS i_waveform_sdata_wid_name ON waveform_sdata (wid, name)",
+    )),
+    Migration(3, "Store waveform arrays as binary", (
+        # Legacy JSON text is kept byte for byte and is still decoded by codec.decode_array
+        "ALTER TABLE waveform_adata MODIFY data LONGBLOB NOT NULL",
+    )),
+    Migration(4, "Index waveform metrics for waveform metric filters", (
+        # WaveformMetricFilter terms look up wids by (name, value) when the metric is more selective than the scans
+        "CREATE INDEX IF NOT EXISTS i_waveform_sdata_name_value ON waveform_sdata (name, value, wid)",
+    )),
+)
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+_CREATE_INDEX = re.compile(r"CREATE\s+INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(\w+)\s*\(([^)]*)\)",
+                           re.IGNORECASE)
+
+_CREATE_VERSION_TABLE = """CREATE TABLE IF NOT EXISTS schema_version (
+        version INT UNSIGNED NOT NULL PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_utc DATETIME(6) NOT NULL
+    )"""
+
+
+def current_version(db: 'WaveformDB') -> int:
+    """Get the version of the database schema.
+
+    Args:
+        db: The database to check
+
+    Returns:
+        The highest applied migration version.  Zero if the database has never been migrated.
+    """
+    version = None
+    cursor = None
+    with db.connection() as conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM information_schema.tables "
+                           "WHERE table_schema = DATABASE() AND table_name = 'schema_version'")
+            if cursor.fetchone()[0] > 0:
+                cursor.execute("SELECT MAX(version) FROM schema_version")
+                version = cursor.fetchone()[0]
+        finally:
+            if cursor is not None:
+                cursor.close()
+            # Don't leave a read transaction open on a shared connection
+            conn.rollback()
+
+    return 0 if version is None else int(version)
+
+
+def pending_migrations(version: int, target: Optional[int] = None) -> List[Migration]:
+    """Get the migrations that take the schema from version to target.
+
+    Args:
+        version: The current schema version
+        target: The desired schema version.  If None, the latest version.
+
+    Returns:
+        The migrations to apply in order
+    """
+    target = LATEST_VERSION if target is None else target
+    if target < version:
+        raise ValueError(f"Cannot downgrade the schema from version {version} to {target}.")
+    if target > LATEST_VERSION:
+        raise ValueError(f"Unknown schema version {target}.  The latest version is {LATEST_VERSION}.")
+    return [migration for migration in MIGRATIONS if version < migration.version <= target]
+
+
+def upgrade(db: 'WaveformDB', target: Optional[int] = None, dry_run: bool = False) -> List[str]:
+    """Apply the pending migrations to the database.
+
+    Each migration is recorded in schema_version once all of its statements succeed.  Note that DDL statements commit
+    implicitly, so a failed migration may be partially applied.  Its statements are written to be safe to re-run.
+    CREATE INDEX statements are skipped if the table already has an index on the same leading columns under any name.
+
+    Args:
+        db: The database to migrate.  The user needs privileges to create and alter tables and indexes.
+        target: The schema version to migrate to.  If None, the latest version.
+        dry_run: If True, return the statements without running them.
+
+    Returns:
+        The DDL statements that were (or in a dry run would be) executed
+    """
+    migrations = pending_migrations(current_version(db), target)
+    if len(migrations) == 0:
+        return []
+
+    statements = [_CREATE_VERSION_TABLE]
+    cursor = None
+    with db.connection() as conn:
+        try:
+            cursor = conn.cursor()
+            if not dry_run:
+                cursor.execute(_CREATE_VERSION_TABLE)
+            for migration in migrations:
+                for statement in migration.statements:
+                    index = parse_create_index(statement)
+                    if index is not None and is_redundant_index(index[2], _get_indexes(cursor, index[1])):
+                        continue
+                    statements.append(statement)
+                    if not dry_run:
+                        cursor.execute(statement)
+                if not dry_run:
+                    cursor.execute("INSERT INTO schema_version (version, description, applied_utc) "
+                                   "VALUES (%s, %s, UTC_TIMESTAMP(6))", (migration.version, migration.description))
+                    conn.commit()
+        finally:
+            if cursor is not None:
+                cursor.close()
+            # Don't leave a read transaction open on a shared connection
+            conn.rollback()
+
+    return statements
+
+
+def parse_create_index(statement: str) -> Optional[Tuple[str, str, List[str]]]:
+    """Parse a CREATE INDEX statement.
+
+    Args:
+        statement: A DDL statement
+
+    Returns:
+        The index name, table name and column names.  None if the statement does not create an index.
+    """
+    match = _CREATE_INDEX.fullmatch(statement.strip())
+    if match is None:
+        return None
+    return match.group(1), match.group(2), [column.strip() for column in match.group(3).split(",")]
+
+
+def is_redundant_index(columns: Sequence[str], indexes: Dict[str, List[str]]) -> bool:
+    """Check if an existing index already covers a new index, i.e., the existing index starts with the same columns.
+
+    Args:
+        columns: The columns of the new index in order
+        indexes: The columns of each existing index keyed on index name
+
+    Returns:
+        True if the new index is not needed
+    """
+    columns = [column.lower() for column in columns]
+    return any([column.lower() for column in existing[:len(columns)]] == columns for existing in indexes.values())
+
+
+def _get_indexes(cursor, table: str) -> Dict[str, List[str]]:
+    """Get the columns of each index of a table in the current database keyed on index name."""
+    cursor.execute("SELECT index_name, column_name FROM information_schema.statistics "
+                   "WHERE table_schema = DATABASE() AND table_name = %s ORDER BY index_name, seq_in_index", (table,))
+    indexes = {}
+    for name, column in cursor.fetchall():
+        indexes.setdefault(name, []).append(column)
+    return indexes
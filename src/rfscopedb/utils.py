@@ -1,5 +1,8 @@
 """A module for commonly used utility functions throughout the package"""
 from datetime import datetime, timezone
+from functools import lru_cache
+
+import numpy as np
 
 
 def get_datetime_as_utc(dt: datetime):
@@ -7,3 +10,22 @@ def get_datetime_as_utc(dt: datetime):
     if dt.tzinfo is None:
         dt = dt.astimezone(timezone.utc)
     return dt.replace(tzinfo=timezone.utc)
+
+
+@lru_cache(maxsize=128)
+def get_frequency_range(fs: float, n_samples: int) -> np.ndarray:
+    """Construct the frequency distribution of a periodogram or FFT given parameters of the initial signal.
+
+    Results are cached by (fs, n_samples) and returned as read-only arrays so a single array can be shared by every
+    caller.  This distribution includes the nyquist frequency so is of length n_samples/2 + 1 to match scipy's
+    periodogram method.
+
+    Args:
+        fs: The sampling frequency in Hertz
+        n_samples: The number of samples in the original signal
+    """
+    # It is up to n_samples/2 + 1 since the frequency distribution includes zero, and scipy returns the nyquist
+    # frequency fs/2 (many libraries seem to not).
+    freqs = np.arange(n_samples // 2 + 1) * float(fs) / n_samples
+    freqs.flags.writeable = False
+    return freqs
@@ -0,0 +1,263 @@
+"""This module contains classes for writing scans to the database in the background.
+
+This is intended for acquisition loops where the time to commit a scan should not delay the capture of the next one.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, List, Optional, Tuple
+
+import mysql.connector
+
+from .data_model import Scan
+from .db import WaveformDB, DEFAULT_INSERT_BATCH_SIZE, get_id_allocation
+
+# Placed on the queue once per worker to signal shutdown
+_STOP = object()
+
+# How often a blocked put checks that the workers are still running, in seconds
+_POLL_INTERVAL = 0.5
+
+
+class AsyncScanWriter:
+    """A class that inserts scans into the database from one or more background worker threads.
+
+    Scans are handed off through a bounded queue.  Each worker owns its own WaveformDB connection and commits every
+    scan that is waiting in the queue (up to max_group_size) in a single transaction.  When the queue is full, submit()
+    blocks until a worker frees up space so that a slow database applies back-pressure instead of consuming unbounded
+    memory.
+
+    If a worker fails unexpectedly, the scans it was writing are failed with the error, and later calls to submit()
+    and close() raise a RuntimeError.
+    """
+
+    def __init__(self, host: str, user: str, password: str, *, workers: int = 1, max_queue_size: int = 64,
+                 max_group_size: int = 16, batch_size: int = DEFAULT_INSERT_BATCH_SIZE, **db_kwargs):
+        """Connect to the database and start the worker threads.
+
+        Args:
+            host: The database host
+            user: The database user
+            password: The database user's password
+            workers: The number of worker threads, each with its own database connection.  More than one requires
+                     the server's innodb_autoinc_lock_mode to be 0 or 1 so that concurrent inserts get consecutive IDs.
+            max_queue_size: The maximum number of scans waiting to be written before submit() blocks
+            max_group_size: The maximum number of scans committed in a single transaction
+            batch_size: The maximum number of rows to include in a single INSERT statement
+            db_kwargs: Additional keyword arguments passed to WaveformDB (port, database, array_codec, etc.)
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least one.")
+        if max_group_size < 1:
+            raise ValueError("max_group_size must be at least one.")
+        if max_queue_size < 1:
+            # A maxsize of zero would make the queue unbounded and remove the back-pressure
+            raise ValueError("max_queue_size must be at least one.")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least one.")
+
+        self.max_group_size = max_group_size
+        self.batch_size = batch_size
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        # The first unexpected error of a worker and the number of workers that have not exited
+        self._error: Optional[BaseException] = None
+        self._n_running = workers
+
+        # Connect up front so that connection problems are raised to the caller.
+        self._dbs = [WaveformDB(host, user, password, **db_kwargs) for _ in range(workers)]
+        if workers > 1:
+            self._check_id_allocation()
+        self._threads = [threading.Thread(target=self._run, args=(db,), name=f"AsyncScanWriter-{idx}", daemon=True)
+                         for idx, db in enumerate(self._dbs)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self) -> 'AsyncScanWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, scan: Scan, timeout: float = None) -> Future:
+        """Queue a scan to be written to the database.
+
+        Args:
+            scan: The scan to be written
+            timeout: The maximum number of seconds to wait for room in the queue.  If None, wait indefinitely.
+
+        Returns:
+            A Future that resolves to the database scan ID (sid) once the scan is committed.
+
+        Raises:
+            RuntimeError: If the writer has been closed or its workers have failed.
+            queue.Full: If there was no room in the queue before the timeout expired.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot submit scans to a closed writer.")
+            self._check_error()
+
+        # Not under the lock so that a full queue cannot block close()
+        self._put((scan, future), timeout=timeout)
+
+        with self._lock:
+            # Every worker may have exited after draining the queue but before the scan was put on it
+            if self._n_running == 0:
+                self._fail_queued(RuntimeError("The writer's workers stopped before the scan was written."))
+        return future
+
+    def qsize(self) -> int:
+        """Return the approximate number of scans waiting to be written."""
+        return self._queue.qsize()
+
+    def close(self, wait: bool = True):
+        """Stop accepting scans and shut down the workers once every queued scan has been written.
+
+        Args:
+            wait: If True, block until all queued scans have been written and the connections are closed.
+
+        Raises:
+            RuntimeError: If wait is True and a worker failed unexpectedly.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        for _ in self._threads:
+            try:
+                self._put(_STOP)
+            except RuntimeError:
+                # Every worker has exited, so there is no one left to stop
+                break
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+            with self._lock:
+                self._check_error()
+
+    def _check_id_allocation(self):
+        """Raise a ValueError if concurrent workers could be given interleaved auto-increment IDs."""
+        cursor = None
+        with self._dbs[0].connection() as conn:
+            try:
+                cursor = conn.cursor()
+                _, consecutive = get_id_allocation(cursor)
+            finally:
+                if cursor is not None:
+                    cursor.close()
+                conn.rollback()
+
+        if not consecutive:
+            for db in self._dbs:
+                db.close()
+            raise ValueError("Multiple workers require innodb_autoinc_lock_mode 0 or 1.  Use a single worker.")
+
+    def _check_error(self):
+        """Raise a RuntimeError if a worker has failed.  Must hold the lock."""
+        if self._error is not None:
+            raise RuntimeError("A writer worker failed unexpectedly.") from self._error
+
+    def _put(self, item: Any, timeout: Optional[float] = None):
+        """Put an item on the queue, giving up if every worker has exited since nothing would free up space.
+
+        Raises:
+            RuntimeError: If every worker has exited.
+            queue.Full: If there was no room in the queue before the timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._n_running == 0:
+                    self._check_error()
+                    raise RuntimeError("The writer's workers have stopped.")
+
+            wait = _POLL_INTERVAL if deadline is None else max(0.0, min(_POLL_INTERVAL, deadline - time.monotonic()))
+            try:
+                self._queue.put(item, timeout=wait)
+                return
+            except queue.Full:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def _fail_queued(self, error: BaseException):
+        """Remove every item from the queue and fail the futures of the scans.  Must hold the lock."""
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(error)
+
+    def _run(self, db: WaveformDB):
+        """Worker loop.  Group every waiting scan into a single transaction."""
+        group = []
+        try:
+            stop = False
+            while not stop:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+
+                group = [item]
+                while len(group) < self.max_group_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    group.append(item)
+
+                self._write_group(db, group)
+                group = []
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Record the error so that it is raised by submit() and close() instead of leaving them waiting
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            for _, future in group:
+                if not future.done() and (future.running() or future.set_running_or_notify_cancel()):
+                    future.set_exception(e)
+        finally:
+            db.close()
+            with self._lock:
+                self._n_running -= 1
+                if self._n_running == 0:
+                    # Scans submitted while the last workers were stopping would otherwise never resolve
+                    self._fail_queued(self._error if self._error is not None else
+                                      RuntimeError("The writer was closed before the scan was written."))
+
+    def _write_group(self, db: WaveformDB, group: List[Tuple[Scan, Future]]):
+        """Write a group of scans in one transaction and resolve their futures."""
+        group = [(scan, future) for scan, future in group if future.set_running_or_notify_cancel()]
+        if len(group) == 0:
+            return
+
+        try:
+            sids = db.insert_scans([scan for scan, _ in group], batch_size=self.batch_size)
+        except (mysql.connector.Error, Exception) as e:  # pylint: disable=broad-exception-caught
+            if len(group) == 1:
+                group[0][1].set_exception(e)
+                return
+
+            # The transaction was rolled back.  Retry the scans one at a time so a single bad scan does not fail
+            # the others.
+            for scan, future in group:
+                try:
+                    future.set_result(db.insert_scans([scan], batch_size=self.batch_size)[0])
+                except (mysql.connector.Error, Exception) as scan_e:  # pylint: disable=broad-exception-caught
+                    future.set_exception(scan_e)
+            return
+
+        for (_, future), sid in zip(group, sids):
+            future.set_result(sid)
@@ -1,12 +1,16 @@
 """Integration tests for the data_model module"""
+import tempfile
 import unittest
+import warnings
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
 
-from rfscopedb.data_model import Scan, Query
-from rfscopedb.db import WaveformDB
+from rfscopedb.cache import QueryCache
+from rfscopedb.data_model import Scan, Query, QuerySizeWarning
+from rfscopedb.db import FilterGroup, QueryFilter, WaveformDB, WaveformMetricFilter
+from rfscopedb.export import ds
 
 
 class TestQuery(unittest.TestCase):
@@ -136,3 +140,239 @@ class TestQuery(unittest.TestCase):
         self.assertTrue(np.allclose(self.x1.analysis_scalar['c1']['GMES']['dominant_frequency'], c1_gmes_dom_freq[0]))
         self.assertTrue(np.allclose(self.x2.analysis_scalar['c2']['GMES']['dominant_frequency'], c2_gmes_dom_freq[0]))
         self.assertTrue(np.allclose(self.x3.analysis_scalar['c3']['PMES']['dominant_frequency'], c3_pmes_dom_freq[0]))
+
+    def test_query_frequency_axes(self):
+        """Test that a shared frequency axis is attached for each sample rate"""
+        query = Query(db=TestQuery.db, signal_names=["GMES"], array_names=["power_spectrum"])
+        query.stage()
+        query.run()
+
+        self.assertListEqual([5000.0], list(query.frequency_axes.keys()))
+        freqs = query.frequency_axes[5000.0]
+        self.assertIs(freqs, query.get_frequency_range(5000.0, 8192))
+        self.assertEqual(len(query.wf_data.data.values[0]), len(freqs))
+
+    def test_iter_run(self):
+        """Test streaming query results as DataFrames and as matrices"""
+        query = Query(db=TestQuery.db, signal_names=["GMES", "PMES"], array_names=["raw", "power_spectrum"])
+        query.stage()
+
+        chunks = list(query.iter_run(chunk_size=3))
+        self.assertTrue(all(len(chunk) <= 3 for chunk in chunks))
+        wf_data = pd.concat(chunks, ignore_index=True)
+        self.assertEqual(8, len(wf_data))
+        self.assertIsNone(query.wf_data)
+
+        n_rows = 0
+        for meta, matrix in query.iter_run(chunk_size=3, output_format="matrix"):
+            self.assertEqual(len(meta), matrix.shape[0])
+            self.assertEqual(1, len(meta.name.unique()))
+            self.assertNotIn("data", meta.columns)
+            self.assertEqual(8192 if meta.name.values[0] == "raw" else 4097, matrix.shape[1])
+            n_rows += len(meta)
+        self.assertEqual(8, n_rows)
+
+    def test_run_matrix(self):
+        """Test that the matrix output format matches the DataFrame output format"""
+        query = Query(db=TestQuery.db, signal_names=["GMES", "PMES"], array_names=["raw", "power_spectrum"])
+        query.stage()
+        query.run()
+        exp = query.wf_data
+
+        query.run(output_format="matrix", chunk_size=3)
+        self.assertIsNone(query.wf_data)
+        self.assertSetEqual({"raw", "power_spectrum"}, set(query.wf_matrices.keys()))
+        self.assertListEqual([5000.0], list(query.frequency_axes.keys()))
+
+        for name, matrix in query.wf_matrices.items():
+            meta = query.wf_matrix_meta[name]
+            self.assertTrue(matrix.flags.c_contiguous)
+            self.assertEqual(len(meta), matrix.shape[0])
+            self.assertEqual((exp.name == name).sum(), matrix.shape[0])
+            for i, wid in enumerate(meta.wid.values):
+                exp_data = exp.loc[(exp.wid == wid) & (exp.name == name), "data"].values[0]
+                self.assertTrue(np.array_equal(exp_data, matrix[i]))
+
+        with self.assertRaises(ValueError):
+            query.run(output_format="list")
+
+    def test_estimate(self):
+        """Test that the estimate matches the staged and run query"""
+        query = Query(db=TestQuery.db, signal_names=["GMES", "PMES"], array_names=["raw", "power_spectrum"])
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            estimate = query.estimate()
+        query.stage()
+        query.run()
+
+        self.assertEqual(query.get_scan_count(), estimate['n_scans'])
+        self.assertEqual(query.wf_data.wid.nunique(), estimate['n_waveforms'])
+        self.assertDictEqual(query.wf_data.name.value_counts().to_dict(), estimate['n_arrays'])
+        self.assertEqual(sum(estimate['n_bytes'].values()), estimate['total_bytes'])
+
+        with self.assertWarns(QuerySizeWarning):
+            query.estimate(warn_bytes=0)
+
+    def test_columns(self):
+        """Test limiting the waveform-level fields of the results"""
+        query = Query(db=TestQuery.db, signal_names=["GMES"], array_names=["raw"], columns=["cavity"])
+        query.stage()
+        query.run()
+        self.assertListEqual(['wid', 'sid', 'cavity', 'wadid', 'name', 'data'], list(query.wf_data.columns))
+        self.assertNotIn('comment', query.wf_meta.columns)
+        self.assertDictEqual({}, query.frequency_axes)
+
+        with self.assertRaises(ValueError):
+            Query(db=TestQuery.db, signal_names=["GMES"], columns=["unknown"])
+
+    def test_cavities(self):
+        """Test that cavity names and patterns limit the waveforms returned by the database"""
+        query = Query(db=TestQuery.db, signal_names=["GMES", "PMES"], array_names=["raw"], wf_metric_names=["rms"],
+                      cavities=["c1", "c3*"])
+        query.stage()
+        query.run()
+        self.assertListEqual(["c1", "c3", "c3"], sorted(query.wf_data.cavity.tolist()))
+        self.assertListEqual(["c1", "c3", "c3"], sorted(query.wf_meta.cavity.tolist()))
+        self.assertEqual(3, sum(query.estimate()['n_arrays'].values()))
+
+        query = Query(db=TestQuery.db, signal_names=["GMES"], array_names=["raw"], cavities=["c?"])
+        query.stage()
+        query.run(output_format="matrix")
+        self.assertEqual(3, query.wf_matrices["raw"].shape[0])
+
+    def test_metric_filter(self):
+        """Test filtering scans by the scalar metrics of their waveforms"""
+        # Only the scan of c3 has a PMES waveform
+        query = Query(db=TestQuery.db, signal_names=["GMES"], wf_metric_names=["maximum"],
+                      metric_filter=WaveformMetricFilter([None], ["PMES"], ["maximum"], [">"], [0.0]))
+        query.stage()
+        query.run()
+        self.assertListEqual(["c3"], query.wf_meta.cavity.unique().tolist())
+
+        query = Query(db=TestQuery.db, signal_names=["GMES"],
+                      metric_filter=WaveformMetricFilter(["c*"], ["GMES"], ["maximum"], [">"], [100.0]))
+        query.stage()
+        self.assertEqual(0, query.get_scan_count())
+        self.assertEqual(0, query.estimate()['n_scans'])
+
+    def test_scan_filter_ops(self):
+        """Test that IN, BETWEEN, PREFIX and groups select the same scans as the equivalent client-side filters"""
+        query = Query(db=TestQuery.db, signal_names=["GMES"])
+        query.stage()
+        scans = query.scan_meta
+
+        def staged_sids(q_filter):
+            filtered = Query(db=TestQuery.db, signal_names=["GMES"], scan_filter=q_filter)
+            filtered.stage()
+            return sorted(filtered.scan_meta.sid.tolist())
+
+        expected = scans[scans.f_a.between(1.0, 1.5)].sid.tolist()
+        self.assertListEqual(sorted(expected), staged_sids(QueryFilter(["a"], ["BETWEEN"], [(1.0, 1.5)])))
+        expected = scans[scans.f_b.isin([2.0, 3.0])].sid.tolist()
+        self.assertListEqual(sorted(expected), staged_sids(QueryFilter(["b"], ["IN"], [[2.0, 3.0]])))
+        expected = scans[scans.s_c.str.startswith("of", na=False)].sid.tolist()
+        self.assertListEqual(sorted(expected), staged_sids(QueryFilter(["c"], ["PREFIX"], ["of"])))
+
+        # (c = off) OR (a > 1.05 AND b < 2.5)
+        group = FilterGroup("OR", [("c", "=", "off"), FilterGroup("AND", [("a", ">", 1.05), ("b", "<", 2.5)])])
+        expected = scans[(scans.s_c == "off") | ((scans.f_a > 1.05) & (scans.f_b < 2.5))].sid.tolist()
+        self.assertListEqual(sorted(expected), staged_sids(QueryFilter(None, None, None, groups=[group])))
+
+    def test_iter_scan_pages(self):
+        """Test that the pages of scans cover the staged scans"""
+        query = Query(db=TestQuery.db, signal_names=["GMES"])
+        query.stage()
+
+        pages = list(query.iter_scan_pages(page_size=1))
+        self.assertEqual(query.get_scan_count(), len(pages))
+        self.assertListEqual(sorted(query.scan_meta.sid.tolist()), sorted(pd.concat(pages).sid.tolist()))
+
+    def test_pixel_width(self):
+        """Test that the coarsest envelope wide enough for the plot replaces the raw arrays"""
+        # Pick dates that don't overlap with the other tests.
+        start = datetime.strptime("2005-01-01 01:23:45.123456", '%Y-%m-%d %H:%M:%S.%f')
+        end = datetime.strptime("2005-01-01 01:23:55.123456", '%Y-%m-%d %H:%M:%S.%f')
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        scan = Scan(start=start, end=end)
+        scan.add_cavity_data("c1", data={'Time': t, 'GMES': np.cos(t * 2 * np.pi * 6.103)}, sampling_rate=5000,
+                             envelope_levels=Scan.envelope_levels)
+        scan.insert_data(TestQuery.db.conn)
+
+        try:
+            query = Query(db=TestQuery.db, signal_names=["GMES"], array_names=["raw"], begin=start, end=end,
+                          pixel_width=200)
+            query.stage()
+            query.run()
+            self.assertListEqual(["envelope_256"], query.array_names)
+            self.assertListEqual(["envelope_256"], query.wf_data.name.tolist())
+            self.assertEqual(512, len(query.wf_data.data[0]))
+
+            # Nothing is coarse enough
+            query = Query(db=TestQuery.db, signal_names=["GMES"], array_names=["raw", "power_spectrum"],
+                          begin=start, end=end, pixel_width=2000)
+            query.stage()
+            self.assertListEqual(["raw", "power_spectrum"], query.array_names)
+
+            # The older scans have no envelopes
+            query = Query(db=TestQuery.db, signal_names=["GMES"], array_names=["raw"], pixel_width=200)
+            query.stage()
+            self.assertListEqual(["raw"], query.array_names)
+        finally:
+            # User the scope_owner connection to have permissions to delete
+            db = WaveformDB(host='localhost', user="scope_owner", password="password")
+            db.delete_scans(scan.id)
+            TestQuery.db.conn.cmd_reset_connection()
+
+    @unittest.skipIf(ds is None, "pyarrow is not installed")
+    def test_to_parquet(self):
+        """Test exporting the query results to Arrow and to a partitioned Parquet dataset"""
+        query = Query(db=TestQuery.db, signal_names=["GMES", "PMES"], array_names=["raw", "power_spectrum"])
+        query.stage()
+
+        table = query.to_arrow(scans_per_chunk=1)
+        self.assertEqual(4, table.num_rows)
+        self.assertSetEqual({8192}, set(table.column("raw").combine_chunks().value_lengths().to_pylist()))
+        self.assertSetEqual({4097}, set(table.column("power_spectrum").combine_chunks().value_lengths().to_pylist()))
+        self.assertIn("dominant_frequency", table.schema.names)
+
+        with tempfile.TemporaryDirectory() as path:
+            query.to_parquet(path, scans_per_chunk=1)
+            result = ds.dataset(path, format="parquet", partitioning="hive").to_table(columns=["wid", "cavity"])
+            # A second export must not be mixed into the first
+            with self.assertRaises(FileExistsError):
+                query.to_parquet(path, scans_per_chunk=1)
+        self.assertListEqual(sorted(table.column("wid").to_pylist()), sorted(result.column("wid").to_pylist()))
+
+    def test_run_cache(self):
+        """Test that cached query results match the database results and that overlapping queries reuse them"""
+        query = Query(db=TestQuery.db, signal_names=["GMES", "PMES"], array_names=["raw", "power_spectrum"])
+        query.stage()
+        query.run()
+        exp_data = query.wf_data.sort_values(["wid", "name"], ignore_index=True)
+        exp_meta = query.wf_meta.sort_values("wid", ignore_index=True)
+
+        with tempfile.TemporaryDirectory() as path:
+            partial = Query(db=TestQuery.db, signal_names=["PMES", "GMES"], array_names=["power_spectrum", "raw"],
+                            end=datetime(2021, 6, 1), cache=QueryCache(path))
+            partial.stage()
+            partial.run()
+
+            cache = QueryCache(path)
+            query = Query(db=TestQuery.db, signal_names=["GMES", "PMES"], array_names=["raw", "power_spectrum"],
+                          cache=cache)
+            query.stage()
+            query.run()
+            query.run(output_format="matrix")
+
+        # Each scan has a waveform_data and a waveform_metadata entry
+        n_scans = query.get_scan_count()
+        n_partial = partial.get_scan_count()
+        self.assertEqual(2 * n_partial + 2 * n_scans, cache.stats()["hits"])
+        self.assertEqual(2 * (n_scans - n_partial), cache.stats()["misses"])
+
+        wf_meta = query.wf_meta.sort_values("wid", ignore_index=True)
+        pd.testing.assert_frame_equal(exp_meta, wf_meta, check_like=True)
+        raw = query.wf_matrices["raw"]
+        for i, wid in enumerate(query.wf_matrix_meta["raw"].wid.values):
+            exp = exp_data.loc[(exp_data.wid == wid) & (exp_data.name == "raw"), "data"].values[0]
+            self.assertTrue(np.array_equal(exp, raw[i]))
@@ -1,14 +1,74 @@
 """Integration tests for the db module"""
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import numpy as np
+import pandas as pd
 
+from rfscopedb.cache import ArrayCache
+from rfscopedb.codec import HEADER, ArrayCodec, is_binary, zstandard
 from rfscopedb.db import WaveformDB
+from rfscopedb.planner import FilterPlanner
 from rfscopedb.data_model import Scan
 from rfscopedb.db import QueryFilter
+from rfscopedb.schema import upgrade
 
 
+class CountingCursor:
+    """Wraps a cursor to count the rows that are fetched from the server."""
+
+    def __init__(self, cursor, counts):
+        self._cursor = cursor
+        self._counts = counts
+
+    def fetchmany(self, size=1):
+        """Fetch and count at most size rows."""
+        rows = self._cursor.fetchmany(size)
+        self._counts['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        """Fetch and count every remaining row."""
+        rows = self._cursor.fetchall()
+        self._counts['rows'] += len(rows)
+        self._counts['fetchall'] += 1
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection:
+    """Wraps a connection so that the rows fetched by its unbuffered cursors are counted."""
+
+    def __init__(self, conn, counts):
+        self._conn = conn
+        self._counts = counts
+
+    def cursor(self, *args, **kwargs):
+        """Create a cursor that counts its rows if it is unbuffered."""
+        cursor = self._conn.cursor(*args, **kwargs)
+        if kwargs.get('buffered') is False:
+            return CountingCursor(cursor, self._counts)
+        return cursor
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class CountingWaveformDB(WaveformDB):
+    """A WaveformDB whose streaming connections count the rows they fetch."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counts = {'rows': 0, 'fetchall': 0}
+
+    def _open_stream_connection(self):
+        return CountingConnection(super()._open_stream_connection(), self.counts)
+
+
+# pylint: disable=too-many-public-methods
 class TestWaveformDB(unittest.TestCase):
     """Integration tests for the WaveformDB class"""
     db = WaveformDB(host='localhost', user='scope_rw', password='password')
@@ -123,6 +183,55 @@ class TestWaveformDB(unittest.TestCase):
                 }]
         self.assertListEqual(exp, out)
 
+    def test_query_scan_frame(self):
+        """Test that the pivoted DataFrame has the same content as the scan rows"""
+        q_filter = QueryFilter(["a", "b"], ["<", "<"], [3, 4])
+        exp = TestWaveformDB.db.query_scan_rows(q_filter=q_filter)
+        out = TestWaveformDB.db.query_scan_frame(q_filter=q_filter)
+
+        self.assertEqual(len(exp), len(out))
+        for exp_row, row in zip(exp, out.to_dict(orient="records")):
+            self.assertDictEqual(exp_row, {key: value for key, value in row.items() if not pd.isna(value)})
+
+    def test_query_scan_rows_page(self):
+        """Test that paging through the scans returns every scan once in order of start time"""
+        for q_filter in (None, QueryFilter(["a"], ["<"], [3])):
+            exp = TestWaveformDB.db.query_scan_rows(q_filter=q_filter)
+            exp.sort(key=lambda row: (row['scan_start_utc'], row['sid']))
+
+            rows = []
+            token = None
+            while True:
+                page, token = TestWaveformDB.db.query_scan_rows_page(q_filter=q_filter, after=token, limit=2)
+                self.assertLessEqual(len(page), 2)
+                rows += page
+                if token is None:
+                    break
+            self.assertListEqual(exp, rows)
+
+            frame, _ = TestWaveformDB.db.query_scan_frame_page(q_filter=q_filter, limit=len(exp) + 1)
+            self.assertListEqual([row['sid'] for row in exp], frame.sid.tolist())
+
+    def test_filter_planner(self):
+        """Test that planned scan filters match the unplanned results"""
+        planner = FilterPlanner()
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', filter_planner=planner)
+        filters = [
+            None,
+            QueryFilter(["c", ], ["=", ], ["off", ]),
+            QueryFilter(["a", "b", "c"], ["<", "<", "="], [2, 3, "on"]),
+            QueryFilter(["a", "b", "c", "c"], ["<", "<", "=", "="], [2, 3, 100, "on"]),
+            QueryFilter(["a", "missing"], ["<", "="], [2, 1.0]),
+        ]
+        for begin, end in ((None, None), (datetime(2019, 6, 1), datetime(2021, 6, 1))):
+            for q_filter in filters:
+                exp = TestWaveformDB.db.query_scan_rows(begin=begin, end=end, q_filter=q_filter)
+                self.assertListEqual(exp, db.query_scan_rows(begin=begin, end=end, q_filter=q_filter))
+
+        self.assertIn(("scan_fdata", "a"), planner.stats)
+        self.assertIn(("scan_sdata", "c"), planner.stats)
+        db.close()
+
     def test_query_scans_no_match1(self):
         """Test behavior when no matches are found"""
 
@@ -187,6 +296,153 @@ class TestWaveformDB(unittest.TestCase):
         # The long running TestDB.db.conn object doesn't see these updates unless it is reset.
         TestWaveformDB.db.conn.cmd_reset_connection()
 
+    def test_insert_scans(self):
+        """Test inserting multiple scans in a single batched transaction and deleting them."""
+        # Pick dates that don't overlap with the other tests.
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        scans = []
+        for year in (2002, 2003, 2004):
+            start = datetime.strptime(f"{year}-01-01 01:23:45.123456", '%Y-%m-%d %H:%M:%S.%f')
+            end = datetime.strptime(f"{year}-01-01 01:23:55.123456", '%Y-%m-%d %H:%M:%S.%f')
+            x = Scan(start=start, end=end)
+            for cav in ("c1", "c2"):
+                x.add_cavity_data(cav, data={
+                    'Time': t,
+                    'GMES': 0.5 * np.cos(t * 2 * np.pi * (year - 2000)) + 1,
+                    'PMES': np.cos(t * 2 * np.pi * 10.0 * (year - 2000)),
+                }, sampling_rate=5000)
+            x.add_scan_data(float_data={'a': float(year), "b": 2.0}, str_data={'c': 'on'})
+            scans.append(x)
+
+        # Use a small batch size so that multiple INSERT statements are needed for each table
+        sids = TestWaveformDB.db.insert_scans(scans, batch_size=2)
+        self.assertEqual(3, len(sids))
+        self.assertListEqual(sids, [x.id for x in scans])
+
+        rows = TestWaveformDB.db.query_scan_rows(begin=scans[0].start, end=scans[-1].start)
+        self.assertListEqual(sids, [row['sid'] for row in rows])
+        self.assertListEqual([2002.0, 2003.0, 2004.0], [row['f_a'] for row in rows])
+
+        result = TestWaveformDB.db.query_waveform_data(sids=[sids[1]], signal_names=['PMES'], array_names=['raw'])
+        self.assertEqual(2, len(result))
+        for row in result:
+            self.assertTrue(np.allclose(scans[1].waveform_data[row['cavity']]['PMES'], row['data']))
+
+        # User the scope_owner connection to have permissions to delete
+        db = WaveformDB(host='localhost', user="scope_owner", password="password")
+        for sid in sids:
+            db.delete_scans(sid)
+        self.assertEqual(0, len(db.query_scan_rows(begin=scans[0].start, end=scans[-1].start)))
+        # The long running TestDB.db.conn object doesn't see these updates unless it is reset.
+        TestWaveformDB.db.conn.cmd_reset_connection()
+
+    def test_array_codecs(self):  # pylint: disable=too-many-locals
+        """Test that arrays written with every codec, and legacy JSON arrays, read back from one table."""
+        # Binary arrays need the LONGBLOB column of schema version 3
+        owner = WaveformDB(host='localhost', user="scope_owner", password="password")
+        upgrade(owner)
+        with owner.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT data_type FROM information_schema.columns WHERE table_schema = DATABASE() "
+                           "AND table_name = 'waveform_adata' AND column_name = 'data'")
+            self.assertEqual('longblob', cursor.fetchone()[0].lower())
+            cursor.close()
+            conn.rollback()
+
+        codecs = [None, ArrayCodec(), ArrayCodec("float32"), ArrayCodec(compression="zlib"),
+                  ArrayCodec(compression="lzma", filters=("shuffle",)),
+                  ArrayCodec(compression="zlib", level=9, filters=("delta", "shuffle"))]
+        if zstandard is not None:
+            codecs += [ArrayCodec(compression="zstd"), ArrayCodec("float32", compression="zstd", filters=("delta",))]
+
+        # Pick dates that don't overlap with the other tests.
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        scans = []
+        for idx, codec in enumerate(codecs):
+            start = datetime.strptime(f"{2010 + idx}-01-01 01:23:45.123456", '%Y-%m-%d %H:%M:%S.%f')
+            x = Scan(start=start, end=start)
+            x.add_cavity_data("c1", data={'Time': t, 'GMES': 0.5 * np.cos(t * 2 * np.pi * (idx + 1)) + 1},
+                              sampling_rate=5000)
+            db = WaveformDB(host='localhost', user='scope_rw', password='password', array_codec=codec)
+            db.insert_scans([x])
+            db.close()
+            scans.append(x)
+
+        try:
+            # A single query reads the legacy JSON and binary rows together
+            TestWaveformDB.db.conn.cmd_reset_connection()
+            rows = TestWaveformDB.db.query_waveform_data(sids=[x.id for x in scans], signal_names=['GMES'],
+                                                         array_names=['raw'])
+            self.assertListEqual([x.id for x in scans], [row['sid'] for row in rows])
+            for codec, x, row in zip(codecs, scans, rows):
+                exp = x.waveform_data['c1']['GMES']
+                if codec is None:
+                    self.assertTrue(np.allclose(exp, row['data']), msg="json")
+                else:
+                    self.assertEqual(codec.dtype, row['data'].dtype, msg=repr(codec))
+                    self.assertTrue(np.array_equal(exp.astype(codec.dtype), row['data']), msg=repr(codec))
+
+            # The raw values are stored as written
+            with owner.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT waveform.sid, waveform_adata.data FROM waveform JOIN waveform_adata "
+                               "ON waveform.wid = waveform_adata.wid WHERE waveform_adata.name = 'raw' "
+                               f"AND waveform.sid IN ({', '.join(['%s'] * len(scans))}) ORDER BY waveform.sid",
+                               [x.id for x in scans])
+                stored = cursor.fetchall()
+                cursor.close()
+                conn.rollback()
+            self.assertListEqual([codec is not None for codec in codecs], [is_binary(data) for _, data in stored])
+            for codec, x, (_, data) in zip(codecs, scans, stored):
+                if codec is not None:
+                    self.assertEqual(codec.encode(x.waveform_data['c1']['GMES']), bytes(data), msg=repr(codec))
+        finally:
+            for x in scans:
+                owner.delete_scans(x.id)
+            owner.close()
+        # The long running TestDB.db.conn object doesn't see these updates unless it is reset.
+        TestWaveformDB.db.conn.cmd_reset_connection()
+
+    def test_query_compression_report(self):
+        """Test that the compression report counts legacy JSON and compressed arrays."""
+        # Pick dates that don't overlap with the other tests.
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        codec = ArrayCodec(compression="zlib", filters=("shuffle",))
+        scans = []
+        for year, array_codec in ((2006, None), (2007, codec)):
+            start = datetime.strptime(f"{year}-01-01 01:23:45.123456", '%Y-%m-%d %H:%M:%S.%f')
+            x = Scan(start=start, end=start)
+            x.add_cavity_data("c1", data={'Time': t, 'GMES': 0.5 * np.cos(t * 2 * np.pi * 6.103) + 1},
+                              sampling_rate=5000)
+            db = WaveformDB(host='localhost', user='scope_rw', password='password', array_codec=array_codec)
+            db.insert_scans([x])
+            db.close()
+            scans.append(x)
+
+        db = WaveformDB(host='localhost', user="scope_owner", password="password")
+        try:
+            report = db.query_compression_report(sids=[x.id for x in scans])
+            self.assertListEqual([('GMES', 'power_spectrum'), ('GMES', 'raw')],
+                                 sorted((row['signal_name'], row['name']) for row in report))
+            for row in report:
+                if row['name'] == 'raw':
+                    exp = scans[1].waveform_data['c1']['GMES']
+                else:
+                    exp = scans[1].analysis_array['c1']['GMES'][row['name']]
+                self.assertEqual(1, row['n_arrays'])
+                self.assertEqual(1, row['n_legacy_arrays'])
+                self.assertGreater(row['legacy_bytes'], 0)
+                self.assertEqual(len(codec.encode(exp)), row['stored_bytes'])
+                self.assertEqual(HEADER.size + len(exp) * 8, row['uncompressed_bytes'])
+                self.assertAlmostEqual(row['uncompressed_bytes'] / row['stored_bytes'], row['compression_ratio'])
+            self.assertGreater(next(row for row in report if row['name'] == 'raw')['compression_ratio'], 1.0)
+        finally:
+            for x in scans:
+                db.delete_scans(x.id)
+            db.close()
+        # The long running TestDB.db.conn object doesn't see these updates unless it is reset.
+        TestWaveformDB.db.conn.cmd_reset_connection()
+
     # pylint: disable=no-value-for-parameter
     # noinspection PyArgumentList
     def test_query_waveform_data1(self):
@@ -248,6 +504,21 @@ class TestWaveformDB(unittest.TestCase):
 
         self.assertDictEqual(exp[0], result[0])
 
+    def test_query_waveform_columns(self):
+        """Test that only the requested waveform-level fields are returned"""
+        rows = TestWaveformDB.db.query_waveform_data(sids=[1, ], signal_names=['GMES', ], array_names=['raw', ],
+                                                     columns=["cavity"])
+        self.assertListEqual(['wid', 'cavity', 'wadid', 'name', 'data'], list(rows[0].keys()))
+        self.assertEqual('c1', rows[0]['cavity'])
+
+        rows = TestWaveformDB.db.query_waveform_metadata(sids=[1, ], signal_names=['GMES', ], metric_names=['mean'],
+                                                         columns=[])
+        self.assertListEqual(['wid', 'mean'], list(rows[0].keys()))
+
+        chunks = list(TestWaveformDB.db.iter_waveform_data(sids=[1, ], signal_names=None, array_names=None,
+                                                           columns=["signal_name"]))
+        self.assertListEqual(['wid', 'signal_name', 'wadid', 'name', 'data'], list(chunks[0][0].keys()))
+
     def test_query_waveform_data5(self):
         """Test querying waveform data. multiple scans, multiple signals, multiple arrays"""
         # Test the case where we specify each parameter and verify the data matches
@@ -280,6 +551,138 @@ class TestWaveformDB(unittest.TestCase):
         for i in range(len(exp)):
             self.assertDictEqual(exp[i], result[i])
 
+    def test_iter_waveform_data(self):
+        """Test streaming waveform data in chunks matches the non-streaming query"""
+        exp = TestWaveformDB.db.query_waveform_data(sids=[1, 2, 3], signal_names=['GMES', 'PMES'],
+                                                    array_names=['raw', 'power_spectrum'])
+        chunks = list(TestWaveformDB.db.iter_waveform_data(sids=[1, 2, 3], signal_names=['GMES', 'PMES'],
+                                                           array_names=['raw', 'power_spectrum'], chunk_size=3))
+        self.assertListEqual([3, 3, 2], [len(chunk) for chunk in chunks])
+
+        result = [row for chunk in chunks for row in chunk]
+        self.assertListEqual([row['wadid'] for row in exp], [row['wadid'] for row in result])
+        for exp_row, row in zip(exp, result):
+            self.assertTrue(np.array_equal(exp_row['data'], row['data']))
+
+        # Closing the generator early must leave the connection usable
+        gen = TestWaveformDB.db.iter_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None, chunk_size=1)
+        self.assertEqual(1, len(next(gen)))
+        gen.close()
+        self.assertEqual(2, len(TestWaveformDB.db.query_waveform_data(sids=[1, ], signal_names=None,
+                                                                      array_names=None)))
+
+    def test_iter_waveform_data_closed_early(self):
+        """Test that closing the generator early does not download the remaining rows"""
+        db = CountingWaveformDB(host='localhost', user='scope_rw', password='password')
+        n_rows = len(db.query_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None))
+        self.assertGreater(n_rows, 2)
+
+        gen = db.iter_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None, chunk_size=1)
+        self.assertEqual(1, len(next(gen)))
+        gen.close()
+        self.assertEqual(1, db.counts['rows'])
+        self.assertEqual(0, db.counts['fetchall'])
+
+        # Streaming to the end still reads every row once
+        db.counts['rows'] = 0
+        self.assertEqual(n_rows, sum(len(chunk) for chunk in db.iter_waveform_data(
+            sids=[1, 2, 3], signal_names=None, array_names=None, chunk_size=2)))
+        self.assertEqual(n_rows, db.counts['rows'])
+        db.close()
+
+    def test_iter_waveform_data_interleaved(self):
+        """Test that other queries can run on the same WaveformDB while the chunks are consumed"""
+        exp_scans = TestWaveformDB.db.query_scan_rows()
+        exp = TestWaveformDB.db.query_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None)
+
+        result = []
+        for chunk in TestWaveformDB.db.iter_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None,
+                                                          chunk_size=1):
+            self.assertListEqual(exp_scans, TestWaveformDB.db.query_scan_rows())
+            result += chunk
+        self.assertListEqual([row['wadid'] for row in exp], [row['wadid'] for row in result])
+
+        # Also with a pooled WaveformDB whose only connection would otherwise be held by the generator
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', pool_size=1, lazy=True)
+        try:
+            gen = db.iter_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None, chunk_size=1)
+            self.assertEqual(1, len(next(gen)))
+            self.assertListEqual(exp_scans, db.query_scan_rows())
+            self.assertEqual(len(exp) - 1, sum(len(chunk) for chunk in gen))
+        finally:
+            db.close()
+
+    def test_pooled_queries(self):
+        """Test that a pooled WaveformDB can be shared by multiple threads"""
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', pool_size=3, lazy=True)
+        exp = TestWaveformDB.db.query_scan_rows()
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            futures = [executor.submit(db.query_scan_rows) for _ in range(12)]
+            for future in futures:
+                self.assertListEqual(exp, future.result())
+
+            futures = [executor.submit(db.query_waveform_data, [1, 2, 3], None, ['raw']) for _ in range(6)]
+            for future in futures:
+                self.assertEqual(4, len(future.result()))
+
+        db.close()
+
+    def test_chunked_queries(self):
+        """Test that queries split into sid chunks match the unchunked query"""
+        exp_data = TestWaveformDB.db.query_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None)
+        exp_meta = TestWaveformDB.db.query_waveform_metadata(sids=[1, 2, 3], signal_names=['GMES', 'PMES'],
+                                                             metric_names=None)
+
+        for pool_size in (None, 2):
+            db = WaveformDB(host='localhost', user='scope_rw', password='password', pool_size=pool_size,
+                            sid_chunk_size=1)
+            result = db.query_waveform_data(sids=[3, 2, 1], signal_names=None, array_names=None)
+            self.assertListEqual([row['wadid'] for row in exp_data], [row['wadid'] for row in result])
+
+            result = db.query_waveform_metadata(sids=[3, 2, 1], signal_names=['GMES', 'PMES'], metric_names=None)
+            self.assertListEqual(exp_meta, result)
+
+            chunks = list(db.iter_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None, chunk_size=3))
+            self.assertListEqual([3, 3, 2], [len(chunk) for chunk in chunks])
+            db.close()
+
+    def test_count_waveform_data(self):
+        """Test counting waveform arrays without querying them"""
+        result = TestWaveformDB.db.count_waveform_data(sids=[1, 2, 3], signal_names=['GMES', 'PMES'],
+                                                       array_names=None)
+        self.assertDictEqual({'raw': 4, 'power_spectrum': 4}, result)
+
+        result = TestWaveformDB.db.count_waveform_data(sids=[3, ], signal_names=['PMES'], array_names=['raw'])
+        self.assertDictEqual({'raw': 1}, result)
+
+    def test_array_cache(self):
+        """Test that cached arrays are reused and only the uncached arrays are queried"""
+        exp = TestWaveformDB.db.query_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None)
+
+        cache = ArrayCache()
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', array_cache=cache)
+        db.query_waveform_data(sids=[1, 2], signal_names=None, array_names=['raw'])
+        self.assertDictEqual({'hits': 0, 'misses': 2, 'n_entries': 2}, self.get_counts(cache))
+
+        result = db.query_waveform_data(sids=[1, 2, 3], signal_names=None, array_names=None)
+        self.assertDictEqual({'hits': 2, 'misses': 8, 'n_entries': 8}, self.get_counts(cache))
+        self.assertEqual(len(exp), len(result))
+        for exp_row, row in zip(exp, result):
+            self.assertTrue(np.array_equal(exp_row.pop('data'), row['data']))
+            self.assertFalse(row.pop('data').flags.writeable)
+            self.assertDictEqual(exp_row, row)
+
+        db.query_waveform_data(sids=[3], signal_names=['PMES'], array_names=None)
+        self.assertDictEqual({'hits': 4, 'misses': 8, 'n_entries': 8}, self.get_counts(cache))
+        db.close()
+
+    @staticmethod
+    def get_counts(cache):
+        """Get the hits, misses and number of entries of an ArrayCache"""
+        stats = cache.stats()
+        return {key: stats[key] for key in ('hits', 'misses', 'n_entries')}
+
     # def test_insert_lots(self):
     #     """Test inserting a lot of scans.
     #
@@ -0,0 +1,48 @@
+"""Integration tests for the partition module"""
+import unittest
+from datetime import datetime
+
+from rfscopedb.db import WaveformDB
+from rfscopedb.partition import (DEFAULT_MONTHS_AHEAD, MAX_PARTITION, OLD_PARTITION, drop_partitions_before,
+                                 ensure_partitions, list_partitions, month_start, partition_tables)
+
+
+class TestPartition(unittest.TestCase):
+    """Integration tests for partitioning the scan-keyed tables by month"""
+
+    def test_partition_tables(self):
+        """Test partitioning, adding future partitions, and dropping old partitions"""
+        # Use the scope_owner connection to have permissions to alter tables
+        db = WaveformDB(host='localhost', user="scope_owner", password="password")
+        before = db.query_waveform_data(sids=[1], signal_names=None, array_names=["raw"])
+
+        # The test data is newer than 2000, so pold stays empty
+        if not db.is_partitioned():
+            self.assertGreater(len(partition_tables(db, datetime(2000, 1, 1), dry_run=True)), 0)
+            self.assertEqual([], list_partitions(db))
+            partition_tables(db, datetime(2000, 1, 1))
+            with self.assertRaises(ValueError):
+                partition_tables(db, datetime(2000, 1, 1))
+        db.close()
+
+        db = WaveformDB(host='localhost', user="scope_owner", password="password")
+        self.assertTrue(db.is_partitioned())
+        partitions = list_partitions(db)
+        self.assertEqual(MAX_PARTITION, partitions[-1]['name'])
+        self.assertGreaterEqual(max(item['bound'] for item in partitions if item['bound'] is not None),
+                                month_start(datetime.now(), DEFAULT_MONTHS_AHEAD))
+        self.assertListEqual([], ensure_partitions(db))
+        self.assertEqual(6, len(ensure_partitions(db, months_ahead=DEFAULT_MONTHS_AHEAD + 2, dry_run=True)))
+
+        # Queries are unchanged by partitioning
+        after = db.query_waveform_data(sids=[1], signal_names=None, array_names=["raw"])
+        self.assertListEqual([(row['wid'], row['name']) for row in before],
+                             [(row['wid'], row['name']) for row in after])
+        self.assertGreater(len(db.query_scan_rows(begin=datetime(2000, 1, 1))), 0)
+
+        if partitions[0]['name'] == OLD_PARTITION:
+            self.assertEqual(6, len(drop_partitions_before(db, datetime(2000, 1, 1))))
+        self.assertNotIn(OLD_PARTITION, [item['name'] for item in list_partitions(db)])
+        after = db.query_waveform_data(sids=[1], signal_names=None, array_names=["raw"])
+        self.assertListEqual(before[0]['data'].tolist(), after[0]['data'].tolist())
+        db.close()
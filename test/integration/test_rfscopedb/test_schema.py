@@ -0,0 +1,94 @@
+"""Integration tests for the schema module"""
+import unittest
+from datetime import datetime
+
+from rfscopedb.db import WaveformDB
+from rfscopedb.partition import partition_tables
+from rfscopedb.schema import LATEST_VERSION, current_version, upgrade
+
+# A scratch database for building the schema from the migrations alone
+SCRATCH_DATABASE = "rfscopedb_baseline_test"
+
+
+def describe_schema(db):
+    """Get the columns and the column lists of the indexes of every table, ignoring index names."""
+    tables = {}
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT table_name, column_name, column_type, is_nullable, column_default, extra "
+                           "FROM information_schema.columns WHERE table_schema = DATABASE() "
+                           "AND table_name != 'schema_version' ORDER BY table_name, ordinal_position")
+            for table, *column in cursor.fetchall():
+                tables.setdefault(table, {'columns': [], 'indexes': {}})['columns'].append(tuple(column))
+            cursor.execute("SELECT table_name, index_name, non_unique, column_name FROM information_schema.statistics "
+                           "WHERE table_schema = DATABASE() AND table_name != 'schema_version' "
+                           "ORDER BY table_name, index_name, seq_in_index")
+            for table, index, non_unique, column in cursor.fetchall():
+                tables[table]['indexes'].setdefault((index, non_unique), []).append(column)
+        finally:
+            cursor.close()
+            conn.rollback()
+
+    for table in tables.values():
+        table['indexes'] = sorted((non_unique, tuple(columns)) for (_, non_unique), columns in table['indexes'].items())
+    return tables
+
+
+class TestSchema(unittest.TestCase):
+    """Integration tests for the schema migrations"""
+
+    def test_upgrade(self):
+        """Test that upgrading is idempotent and that a dry run does not change the schema"""
+        # Use the scope_owner connection to have permissions to alter tables
+        db = WaveformDB(host='localhost', user="scope_owner", password="password")
+        version = current_version(db)
+
+        statements = upgrade(db, dry_run=True)
+        self.assertEqual(version, current_version(db))
+        self.assertEqual(version == LATEST_VERSION, len(statements) == 0)
+
+        self.assertListEqual(statements, upgrade(db))
+        self.assertEqual(LATEST_VERSION, current_version(db))
+        self.assertListEqual([], upgrade(db))
+
+        # Existing data is still readable after the migrations
+        rows = db.query_waveform_data(sids=[1], signal_names=None, array_names=["raw"])
+        self.assertEqual(8192, len(rows[0]['data']))
+        db.close()
+
+    def test_baseline(self):
+        """Test that the migrations build the same schema on an empty database as on the container's database"""
+        live = WaveformDB(host='localhost', user="scope_owner", password="password")
+        upgrade(live)
+
+        # Creating a database needs more privileges than scope_owner has
+        admin = WaveformDB(host='localhost', user="root", password="password")
+        with admin.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"DROP DATABASE IF EXISTS {SCRATCH_DATABASE}")
+            cursor.execute(f"CREATE DATABASE {SCRATCH_DATABASE}")
+            cursor.close()
+
+        scratch = WaveformDB(host='localhost', user="root", password="password", database=SCRATCH_DATABASE)
+        try:
+            upgrade(scratch)
+            self.assertEqual(LATEST_VERSION, current_version(scratch))
+            # The partition tests may have partitioned the container's database
+            if live.is_partitioned():
+                partition_tables(scratch, datetime(2000, 1, 1))
+
+            exp = describe_schema(live)
+            result = describe_schema(scratch)
+            self.assertListEqual(sorted(exp.keys()), sorted(result.keys()))
+            for table, description in exp.items():
+                self.assertListEqual(description['columns'], result[table]['columns'], msg=table)
+                self.assertListEqual(description['indexes'], result[table]['indexes'], msg=table)
+        finally:
+            scratch.close()
+            with admin.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"DROP DATABASE IF EXISTS {SCRATCH_DATABASE}")
+                cursor.close()
+            admin.close()
+            live.close()
@@ -0,0 +1,44 @@
+"""Integration tests for the writer module"""
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from rfscopedb.data_model import Scan
+from rfscopedb.db import WaveformDB
+from rfscopedb.writer import AsyncScanWriter
+
+
+class TestAsyncScanWriter(unittest.TestCase):
+    """Integration tests for the AsyncScanWriter class"""
+
+    def test_submit(self):
+        """Test writing scans in the background and deleting them."""
+        # Pick dates that don't overlap with the other tests.
+        start = datetime.strptime("2005-01-01 01:23:45.123456", '%Y-%m-%d %H:%M:%S.%f')
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+
+        scans = []
+        for i in range(5):
+            x = Scan(start=start + timedelta(minutes=i), end=start + timedelta(minutes=i, seconds=10))
+            x.add_cavity_data("c1", data={'Time': t, 'GMES': np.cos(t * 2 * np.pi * (i + 1))}, sampling_rate=5000)
+            x.add_scan_data(float_data={'a': float(i)}, str_data={'c': 'on'})
+            scans.append(x)
+
+        with AsyncScanWriter(host='localhost', user='scope_rw', password='password', workers=2,
+                             max_queue_size=2, max_group_size=2) as writer:
+            futures = [writer.submit(x) for x in scans]
+            sids = [future.result(timeout=30) for future in futures]
+
+        self.assertEqual(5, len(set(sids)))
+        self.assertListEqual(sids, [x.id for x in scans])
+        with self.assertRaises(RuntimeError):
+            writer.submit(scans[0])
+
+        # User the scope_owner connection to have permissions to delete
+        db = WaveformDB(host='localhost', user="scope_owner", password="password")
+        rows = db.query_scan_rows(begin=scans[0].start, end=scans[-1].start)
+        self.assertListEqual(sorted(sids), [row['sid'] for row in rows])
+        for sid in sids:
+            db.delete_scans(sid)
+        self.assertEqual(0, len(db.query_scan_rows(begin=scans[0].start, end=scans[-1].start)))
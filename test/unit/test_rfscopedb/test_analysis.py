@@ -0,0 +1,88 @@
+"""Tests for the analysis.py module."""
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from rfscopedb.analysis import AnalysisExecutor
+from rfscopedb.data_model import Scan
+
+
+class TestAnalysisExecutor(unittest.TestCase):
+    """Tests for the AnalysisExecutor class."""
+
+    def test_analyze_signals(self):
+        """Test that the multiprocess analysis matches the in process analysis."""
+        rng = np.random.default_rng(7)
+        matrix = rng.normal(size=(9, 8192))
+        exp_scalars, exp_arrays = Scan.analyze_signals(matrix, sampling_rate=5000)
+
+        with AnalysisExecutor(workers=3) as executor:
+            scalars, arrays = executor.analyze_signals(matrix, sampling_rate=5000)
+
+        self.assertSetEqual(set(exp_scalars.keys()), set(scalars.keys()))
+        self.assertSetEqual(set(exp_arrays.keys()), set(arrays.keys()))
+        for k, v in exp_scalars.items():
+            self.assertTrue(np.allclose(v, scalars[k]), msg=f"{k} has mismatch")
+        for k, v in exp_arrays.items():
+            self.assertTrue(np.allclose(v, arrays[k]), msg=f"{k} has mismatch")
+
+    def test_analyze_signals_float32(self):
+        """Test that float32 input gives identical results with and without worker processes."""
+        rng = np.random.default_rng(11)
+        matrix = rng.normal(size=(6, 8192)).astype(np.float32)
+        exp_scalars, exp_arrays = Scan.analyze_signals(matrix, sampling_rate=5000)
+
+        with AnalysisExecutor(workers=2) as executor:
+            scalars, arrays = executor.analyze_signals(matrix, sampling_rate=5000)
+
+        for exp, result in ((exp_scalars, scalars), (exp_arrays, arrays)):
+            for k, v in exp.items():
+                self.assertEqual(v.dtype, result[k].dtype, msg=f"{k} has dtype mismatch")
+                self.assertTrue(np.array_equal(v, result[k]), msg=f"{k} has mismatch")
+        self.assertEqual(np.float32, scalars['mean'].dtype)
+
+    def test_result_dtype(self):
+        """Test that every result has the dtype stated by Scan.result_dtype."""
+        self.assertEqual(np.float32, Scan.result_dtype(np.float32))
+        self.assertEqual(np.float64, Scan.result_dtype(np.float64))
+        self.assertEqual(np.float64, Scan.result_dtype(np.int16))
+
+        matrix = np.arange(2 * 8192, dtype=np.int16).reshape(2, 8192)
+        with AnalysisExecutor(workers=2) as executor:
+            for scalars, arrays in (Scan.analyze_signals(matrix), executor.analyze_signals(matrix)):
+                for k, v in list(scalars.items()) + list(arrays.items()):
+                    self.assertEqual(np.float64, v.dtype, msg=k)
+
+    def test_add_scan_waveforms(self):
+        """Test that a scan analyzed with worker processes matches one analyzed in process."""
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        data = {f"R1{i}": {'Time': t, 'GMES': np.cos(t * 2 * np.pi * i), 'PMES': np.sin(t * 2 * np.pi * i)}
+                for i in range(1, 5)}
+        start = datetime(2020, 1, 1)
+
+        x = Scan(start=start, end=start)
+        y = Scan(start=start, end=start)
+        x.add_scan_waveforms(data, sampling_rate=5000)
+        with AnalysisExecutor(workers=2) as executor:
+            y.add_scan_waveforms(data, sampling_rate=5000, executor=executor)
+
+        for cavity, signal_name in x.get_waveform_keys():
+            for k, v in x.analysis_scalar[cavity][signal_name].items():
+                self.assertAlmostEqual(v, y.analysis_scalar[cavity][signal_name][k])
+            self.assertTrue(np.allclose(x.analysis_array[cavity][signal_name]['power_spectrum'],
+                                        y.analysis_array[cavity][signal_name]['power_spectrum']))
+
+    def test_worker_failure(self):
+        """Test that an error raised by the analysis in a worker process is the one raised to the caller."""
+        with AnalysisExecutor(workers=2) as executor:
+            with self.assertRaises(ValueError) as context:
+                executor.analyze_signals(np.ones((4, 100)))
+        self.assertIn("8192", str(context.exception))
+
+    def test_single_worker(self):
+        """Test that a single worker executor runs in process."""
+        executor = AnalysisExecutor(workers=1)
+        scalars, _ = executor.analyze_signals(np.ones((2, 8192)))
+        self.assertTrue(np.array_equal(np.ones(2), scalars['mean']))
+        executor.shutdown()
@@ -0,0 +1,183 @@
+"""Tests for the cache.py module."""
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from rfscopedb.cache import ArrayCache, QueryCache, fingerprint
+
+
+def make_rows(sids):
+    """Build rows that look like the results of WaveformDB.query_waveform_data.  Two arrays per scan."""
+    rows = []
+    for sid in sids:
+        for name in ("raw", "power_spectrum"):
+            rows.append({'sid': sid, 'wid': 10 * sid, 'cavity': 'c1', 'signal_name': 'GMES',
+                         'sample_rate_hz': 5000.0, 'name': name, 'data': np.arange(64, dtype=np.float64) * sid})
+    return rows
+
+
+class FakeFetch:
+    """Stands in for a database query and records which sids were fetched."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, sids):
+        self.calls.append(list(sids))
+        # sid 0 has no matching data
+        return make_rows([sid for sid in sids if sid != 0])
+
+    def n_fetched(self):
+        """Get the total number of sids fetched."""
+        return sum(len(sids) for sids in self.calls)
+
+
+class TestFingerprint(unittest.TestCase):
+    """Tests for the fingerprint function."""
+
+    def test_fingerprint(self):
+        """Test that the fingerprint ignores order but not content."""
+        begin = datetime(2020, 1, 1)
+        exp = fingerprint(signal_names=["GMES", "PMES"], array_names=None, begin=begin, sids=[1, 2, 3])
+        self.assertEqual(exp, fingerprint(sids=[3, 2, 1, 1], begin=begin, array_names=None,
+                                          signal_names=("PMES", "GMES")))
+        self.assertNotEqual(exp, fingerprint(signal_names=["GMES", "PMES"], array_names=[], begin=begin,
+                                             sids=[1, 2, 3]))
+        self.assertNotEqual(exp, fingerprint(signal_names=["GMES", "PMES"], array_names=None, begin=begin,
+                                             sids=[1, 2]))
+        self.assertNotEqual(exp, fingerprint(signal_names=["GMES", "PMES"], array_names=None,
+                                             begin=datetime(2020, 1, 2), sids=[1, 2, 3]))
+        self.assertEqual(fingerprint(scan_filter=[("a", ">", 1), ("b", "=", "on")]),
+                         fingerprint(scan_filter=[("b", "=", "on"), ("a", ">", 1)]))
+
+    def test_fingerprint_terms(self):
+        """Test that the fingerprint keeps the order within a filter term."""
+        self.assertNotEqual(fingerprint(scan_filter=[("a", "=", "b")]), fingerprint(scan_filter=[("b", "=", "a")]))
+        self.assertNotEqual(fingerprint(scan_filter=[("a", "BETWEEN", (10, 20))]),
+                            fingerprint(scan_filter=[("a", "BETWEEN", (20, 10))]))
+        self.assertNotEqual(fingerprint(metric_filter=[("1L22", "GMES", "rms", ">", 1.0)]),
+                            fingerprint(metric_filter=[("1L22", "rms", "GMES", ">", 1.0)]))
+        self.assertNotEqual(fingerprint(database="localhost:3306/scope_waveforms", sids=[1]),
+                            fingerprint(database="otherhost:3306/scope_waveforms", sids=[1]))
+        self.assertEqual(fingerprint(scan_filter=[{"kind": "OR", "items": [("a", "=", 1)]}, ("b", ">", 2)]),
+                         fingerprint(scan_filter=[("b", ">", 2), {"kind": "OR", "items": [("a", "=", 1)]}]))
+
+
+class TestQueryCache(unittest.TestCase):
+    """Tests for the QueryCache class."""
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_rows(self):
+        """Test that only the missing sids are fetched and the cached rows match the fetched rows."""
+        cache = QueryCache(self.path)
+        fetch = FakeFetch()
+
+        rows = cache.get_rows("waveform_data", [2, 1], fetch, signal_names=["GMES"], array_names=None)
+        self.assertListEqual([[1, 2]], fetch.calls)
+        self.assertEqual(4, len(rows))
+
+        result = cache.get_rows("waveform_data", [0, 1, 2, 3], fetch, signal_names=["GMES"], array_names=None)
+        self.assertListEqual([[1, 2], [0, 3]], fetch.calls)
+        exp = make_rows([1, 2, 3])
+        self.assertEqual(len(exp), len(result))
+        for exp_row, row in zip(exp, result):
+            self.assertTrue(np.array_equal(exp_row.pop('data'), row.pop('data')))
+            self.assertDictEqual(exp_row, row)
+
+        # sid 0 has no rows, but the empty result is cached too.  Different parameters are a different entry.
+        cache.get_rows("waveform_data", [0, 1, 2, 3], fetch, signal_names=["GMES"], array_names=None)
+        cache.get_rows("waveform_data", [1], fetch, signal_names=["PMES"], array_names=None)
+        self.assertListEqual([[1, 2], [0, 3], [1]], fetch.calls)
+
+        stats = cache.stats()
+        self.assertEqual(6, stats['hits'])
+        self.assertEqual(5, stats['misses'])
+        self.assertEqual(5, stats['n_entries'])
+
+    def test_reopen(self):
+        """Test that a new cache on the same directory reuses the entries."""
+        fetch = FakeFetch()
+        QueryCache(self.path).get_rows("waveform_data", [1, 2], fetch, signal_names=["GMES"])
+        cache = QueryCache(self.path)
+        self.assertEqual(2, cache.stats()['n_entries'])
+        cache.get_rows("waveform_data", [1, 2], fetch, signal_names=["GMES"])
+        self.assertEqual(2, fetch.n_fetched())
+
+    def test_eviction(self):
+        """Test that the least recently used entries are evicted once the cache is full."""
+        fetch = FakeFetch()
+        cache = QueryCache(self.path)
+        cache.get_rows("waveform_data", [1], fetch)
+        entry_size = cache.stats()['n_bytes']
+
+        cache = QueryCache(self.path, max_bytes=int(2.5 * entry_size))
+        cache.get_rows("waveform_data", [2], fetch)
+        cache.get_rows("waveform_data", [1], fetch)
+        cache.get_rows("waveform_data", [3], fetch)
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(2, stats['n_entries'])
+        self.assertLessEqual(stats['n_bytes'], cache.max_bytes)
+
+        # sid 2 was the least recently used
+        cache.get_rows("waveform_data", [1, 2, 3], fetch)
+        self.assertListEqual([2], fetch.calls[-1])
+
+        cache.clear()
+        self.assertEqual(0, cache.stats()['n_entries'])
+        self.assertListEqual([], os.listdir(self.path))
+
+
+class TestArrayCache(unittest.TestCase):
+    """Tests for the ArrayCache class."""
+
+    def test_get_put(self):
+        """Test that cached arrays are read-only and that hits and misses are counted."""
+        cache = ArrayCache()
+        self.assertIsNone(cache.get(1, "raw"))
+
+        data = cache.put(1, "raw", np.arange(8, dtype=np.float64))
+        self.assertFalse(data.flags.writeable)
+        self.assertIs(data, cache.get(1, "raw"))
+        self.assertIsNone(cache.get(1, "power_spectrum"))
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(1, stats['n_entries'])
+        self.assertEqual(64, stats['n_bytes'])
+
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.stats()['n_bytes'])
+
+    def test_eviction(self):
+        """Test that the least recently used arrays are evicted once the cache is full."""
+        cache = ArrayCache(max_bytes=200)
+        for wid in (1, 2, 3):
+            cache.put(wid, "raw", np.zeros(8))
+        cache.get(1, "raw")
+        cache.put(4, "raw", np.zeros(8))
+
+        self.assertIsNone(cache.get(2, "raw"))
+        for wid in (1, 3, 4):
+            self.assertIsNotNone(cache.get(wid, "raw"))
+        self.assertEqual(1, cache.stats()['evictions'])
+        self.assertEqual(192, cache.stats()['n_bytes'])
+
+        # Arrays larger than the cache are returned but not cached
+        data = cache.put(5, "raw", np.zeros(100))
+        self.assertFalse(data.flags.writeable)
+        self.assertIsNone(cache.get(5, "raw"))
+        self.assertEqual(3, len(cache))
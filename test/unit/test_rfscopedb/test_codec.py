@@ -0,0 +1,85 @@
+"""Tests for the codec.py module."""
+import json
+import unittest
+
+import numpy as np
+
+from rfscopedb.codec import ArrayCodec, decode_array, encode_json, is_binary, read_header, HEADER, zstandard
+
+
+class TestArrayCodec(unittest.TestCase):
+    """Tests for the ArrayCodec class and the decode functions."""
+
+    def test_round_trip_float64(self):
+        """Test that float64 arrays are encoded exactly and compactly."""
+        arr = np.random.default_rng(1).normal(size=8192)
+        data = ArrayCodec().encode(arr)
+
+        self.assertTrue(is_binary(data))
+        self.assertEqual(HEADER.size + 8 * 8192, len(data))
+        result = decode_array(data)
+        self.assertEqual(np.dtype("<f8"), result.dtype)
+        self.assertTrue(np.array_equal(arr, result))
+
+    def test_round_trip_float32(self):
+        """Test that float32 arrays are encoded with half the size and approximately equal values."""
+        arr = np.linspace(0, 1, 4097)
+        data = ArrayCodec(dtype="float32").encode(arr)
+
+        self.assertEqual(HEADER.size + 4 * 4097, len(data))
+        result = decode_array(data)
+        self.assertEqual(np.dtype("<f4"), result.dtype)
+        self.assertTrue(np.allclose(arr, result))
+
+    def test_round_trip_compressed(self):
+        """Test that every compression and filter combination round trips exactly."""
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        arr = 0.5 * np.cos(t * 2 * np.pi * 6.103) + 1
+        compressions = [None, "zlib", "lzma"]
+        if zstandard is not None:
+            compressions.append("zstd")
+
+        for compression in compressions:
+            for filters in [(), ("shuffle",), ("delta",), ("delta", "shuffle")]:
+                for dtype in ("float32", "float64"):
+                    codec = ArrayCodec(dtype=dtype, compression=compression, filters=filters)
+                    data = codec.encode(arr)
+                    result = decode_array(data)
+                    self.assertTrue(np.array_equal(arr.astype(dtype), result), msg=repr(codec))
+                    self.assertEqual(8192, read_header(data)[3])
+
+    def test_compression_ratio(self):
+        """Test that a smooth waveform compresses better with the shuffle filter."""
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        arr = 0.5 * np.cos(t * 2 * np.pi * 6.103) + 1
+
+        plain = ArrayCodec(compression="zlib").encode(arr)
+        shuffled = ArrayCodec(compression="zlib", filters=("shuffle",)).encode(arr)
+        self.assertLess(len(plain), HEADER.size + 8 * 8192)
+        self.assertLess(len(shuffled), len(plain))
+
+    def test_decode_legacy_json(self):
+        """Test that legacy JSON rows are still decoded whether returned as str or bytes."""
+        arr = np.linspace(0, 1, 100)
+        self.assertTrue(np.array_equal(arr, decode_array(encode_json(arr))))
+        self.assertTrue(np.array_equal(arr, decode_array(json.dumps(arr.tolist()).encode())))
+        self.assertFalse(is_binary(encode_json(arr)))
+
+    def test_codec_checks(self):
+        """Test that unsupported types and shapes are rejected."""
+        with self.assertRaises(TypeError):
+            ArrayCodec(dtype="not_a_type")
+        with self.assertRaises(ValueError):
+            ArrayCodec(dtype="int32")
+        with self.assertRaises(ValueError):
+            ArrayCodec().encode(np.ones((2, 2)))
+        with self.assertRaises(ValueError):
+            ArrayCodec(compression="bz2")
+        with self.assertRaises(ValueError):
+            ArrayCodec(filters=("bitround",))
+
+        # Bad version number in an otherwise valid header
+        data = bytearray(ArrayCodec().encode(np.ones(3)))
+        data[4] = 99
+        with self.assertRaises(ValueError):
+            decode_array(bytes(data))
@@ -3,14 +3,84 @@ import unittest
 from datetime import datetime
 
 import numpy as np
+from scipy.signal import periodogram
 
-from rfscopedb.db import QueryFilter
+from rfscopedb.db import (FilterGroup, QueryFilter, WaveformDB, WaveformMetricFilter, WAVEFORM_FIELDS,
+                          _decode_page_token, _encode_page_token)
 from rfscopedb.data_model import Scan
 
 scan_start = datetime.strptime("2020-01-01 01:23:45.123456", '%Y-%m-%d %H:%M:%S.%f')
 scan_end = datetime.strptime("2020-01-01 01:23:55.123456", '%Y-%m-%d %H:%M:%S.%f')
 
 
+def reference_analysis(arr, sampling_rate):
+    """Compute the expected metrics and power spectrum of one waveform independently of Scan."""
+    f, pxx = periodogram(arr, sampling_rate)
+    scalars = {
+        "minimum": np.min(arr),
+        "maximum": np.max(arr),
+        "peak_to_peak": np.max(arr) - np.min(arr),
+        "mean": np.mean(arr),
+        "median": np.median(arr),
+        "standard_deviation": np.std(arr),
+        "rms": np.sqrt(np.mean(arr ** 2)),
+        "25th_quartile": np.percentile(arr, 25),
+        "75th_quartile": np.percentile(arr, 75),
+        "dominant_frequency": f[np.argmax(pxx)],
+    }
+    return scalars, {"power_spectrum": pxx}
+
+
+class FakeCursor:
+    """Records the statements executed and allocates auto-increment IDs like a server in the given lock mode."""
+
+    def __init__(self, lock_mode, id_step=2):
+        self.lock_mode = lock_mode
+        self.id_step = id_step
+        self.inserts = []
+        self.next_ids = {}
+        self.rowcount = 0
+        self.lastrowid = None
+        self._result = None
+
+    def execute(self, sql, data=None):  # pylint: disable=unused-argument
+        """Answer the ID allocation query and record the table and row count of each INSERT."""
+        if sql.startswith("SELECT"):
+            self._result = (self.id_step, self.lock_mode)
+            return
+        table = sql.split()[2]
+        n_rows = sql.count("), (") + 1
+        self.inserts.append((table, n_rows))
+        self.lastrowid = self.next_ids.get(table, 1)
+        # Leave a gap after every statement as a concurrent writer would
+        self.next_ids[table] = self.lastrowid + (n_rows + 10) * self.id_step
+        self.rowcount = n_rows
+
+    def fetchone(self):
+        """Return the result of the last SELECT."""
+        return self._result
+
+    def close(self):
+        """Nothing to release."""
+
+
+class FakeConnection:
+    """A connection that hands out a single FakeCursor."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        """Return the fake cursor."""
+        return self._cursor
+
+    def commit(self):
+        """Nothing to commit."""
+
+    def rollback(self):
+        """Nothing to roll back."""
+
+
 class TestQueryFilter(unittest.TestCase):
     """Tests for the QueryFilter class."""
 
@@ -41,6 +111,47 @@ class TestQueryFilter(unittest.TestCase):
         with self.assertRaises(ValueError):
             QueryFilter(['c', ], ['>'], [73, 24, 'asdf'])
 
+    def test_query_filter_ops(self):
+        """Test that the values of IN, BETWEEN and PREFIX are checked"""
+        QueryFilter(["mode", "a", "comment"], ["IN", "BETWEEN", "PREFIX"], [["CW", "pulsed"], (10, 20), "trip"])
+        for op, value in (("IN", []), ("IN", "CW"), ("IN", ["CW", 1.0]), ("BETWEEN", (1.0,)),
+                          ("BETWEEN", (1.0, "b")), ("PREFIX", 1.0), ("PREFIX", ""), (">", [1.0, 2.0])):
+            with self.assertRaises(ValueError, msg=f"{op} {value}"):
+                QueryFilter(["a"], [op], [value])
+
+        self.assertEqual("scan_sdata", QueryFilter.get_table("IN", ["CW", "pulsed"]))
+        self.assertEqual("scan_fdata", QueryFilter.get_table("BETWEEN", (10, 20)))
+        self.assertEqual(("value LIKE %s", ["trip\\_%"]), QueryFilter.gen_value_test("PREFIX", "trip_"))
+        self.assertEqual(("x IN (%s, %s)", ["CW", "pulsed"]), QueryFilter.gen_value_test("IN", ["CW", "pulsed"], "x"))
+
+    def test_filter_group(self):
+        """Test that groups are validated and compiled to UNION and INTERSECT subqueries"""
+        group = FilterGroup("OR", [("mode", "IN", ["CW", "pulsed"]),
+                                   FilterGroup("AND", [("a", "BETWEEN", (10.0, 20.0)), ("c", "=", "on")])])
+        q_filter = QueryFilter(["b"], [">"], [1.0], groups=[group])
+        self.assertEqual(2, len(q_filter))
+        self.assertEqual(1, len(QueryFilter(None, None, None, groups=[group])))
+
+        sql, data = WaveformDB.gen_scan_join_statements(q_filter.get_items())
+        self.assertEqual(" JOIN (SELECT scan_fdata.sid FROM scan_fdata WHERE name = %s and value > %s) as s0 "
+                         "ON scan.sid = s0.sid\n"
+                         " JOIN (SELECT scan_sdata.sid FROM scan_sdata WHERE name = %s and value IN (%s, %s) UNION "
+                         "SELECT g.sid FROM (SELECT scan_fdata.sid FROM scan_fdata WHERE name = %s and value "
+                         "BETWEEN %s AND %s INTERSECT SELECT scan_sdata.sid FROM scan_sdata WHERE name = %s and "
+                         "value = %s) AS g) as s1 ON scan.sid = s1.sid\n", sql)
+        self.assertListEqual(["b", 1.0, "mode", "CW", "pulsed", "a", 10.0, 20.0, "c", "on"], data)
+
+        with self.assertRaises(ValueError):
+            FilterGroup("XOR", [("a", "=", 1.0)])
+        with self.assertRaises(ValueError):
+            FilterGroup("OR", [])
+        with self.assertRaises(ValueError):
+            FilterGroup("OR", [("a", "=")])
+        with self.assertRaises(ValueError):
+            FilterGroup("OR", [("a", "~", 1.0)])
+        with self.assertRaises(ValueError):
+            QueryFilter(None, None, None, groups=[("a", "=", 1.0)])
+
     def test_query_len1(self):
         """Test that the len method works as expected"""
         f = QueryFilter(filter_params=['c', 'b', 'a'], filter_ops=['=', '<=', '='], filter_values=[73, 24, "asdf"])
@@ -57,6 +168,170 @@ class TestQueryFilter(unittest.TestCase):
         self.assertEqual(0, len(f))
 
 
+# pylint: disable=protected-access
+class TestWaveformMetricFilter(unittest.TestCase):
+    """Tests for the WaveformMetricFilter class."""
+
+    def test_creation_checks(self):
+        """Test that mismatched lengths, unknown operations and string values are rejected."""
+        self.assertEqual(2, len(WaveformMetricFilter(["1L10-3", None], ["GMES", "PMES"], ["rms", "mean"], [">", "<"],
+                                                     [0.2, 1.0])))
+        with self.assertRaises(ValueError):
+            WaveformMetricFilter(["1L10-3"], ["GMES"], ["rms"], [">"], [0.2, 0.3])
+        with self.assertRaises(ValueError):
+            WaveformMetricFilter(["1L10-3"], ["GMES"], ["rms"], ["LIKE"], [0.2])
+        with self.assertRaises(ValueError):
+            WaveformMetricFilter(["1L10-3"], ["GMES"], ["rms"], ["="], ["high"])
+
+    def test_gen_conditions(self):
+        """Test that the placeholders and data line up in the generated SQL."""
+        metric_filter = WaveformMetricFilter(["1L10-3", "2L22*", None], ["GMES"] * 3, ["rms", "mean", "maximum"],
+                                             [">", "<", ">="], [0.2, 1.0, 5.0])
+        conditions, data = metric_filter.gen_conditions(None, None)
+        self.assertEqual(3, len(conditions))
+        self.assertTrue(all(item.startswith("scan.sid IN (SELECT waveform.sid FROM waveform") for item in conditions))
+        self.assertIn("(waveform.cavity IN (%s))", conditions[0])
+        self.assertIn("(waveform.cavity LIKE %s)", conditions[1])
+        self.assertNotIn("cavity", conditions[2])
+        self.assertIn("waveform_sdata.value >= %s", conditions[2])
+        self.assertEqual(sum(item.count("%s") for item in conditions), len(data))
+        self.assertListEqual(["GMES", "1L10-3", "rms", 0.2, "GMES", "2L22%", "mean", 1.0, "GMES", "maximum", 5.0],
+                             data)
+
+        # Partitioned tables are limited to the time range of the query
+        conditions, data = metric_filter.gen_conditions(scan_start, None, partitioned=True)
+        self.assertIn("waveform_sdata.scan_start_utc >= %s", conditions[0])
+        self.assertEqual(sum(item.count("%s") for item in conditions), len(data))
+
+        sql, data = WaveformDB.get_scan_join_clauses(None, None, QueryFilter(["a"], [">"], [1.0]), metric_filter)
+        self.assertIn(" WHERE scan.sid IN (SELECT waveform.sid", sql)
+        self.assertEqual(sql.count("%s"), len(data))
+
+
+class TestWaveformDB(unittest.TestCase):
+    """Tests for the WaveformDB class that do not require a database connection."""
+
+    def test_lazy_creation(self):
+        """Test that lazy construction does not connect until needed."""
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', lazy=True)
+        self.assertIsNone(db.conn)
+        db.close()
+        db.close()
+
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', pool_size=4, lazy=True)
+        self.assertEqual(4, db.pool_size)
+        self.assertIsNone(db.conn)
+        db.close()
+
+    def test_pool_size_checks(self):
+        """Test that invalid pool sizes are rejected."""
+        with self.assertRaises(ValueError):
+            WaveformDB(host='localhost', user='scope_rw', password='password', pool_size=0, lazy=True)
+        with self.assertRaises(ValueError):
+            WaveformDB(host='localhost', user='scope_rw', password='password', pool_size=1000, lazy=True)
+
+    def test_chunk_sids(self):
+        """Test that sids are split into sorted, de-duplicated chunks."""
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', lazy=True, sid_chunk_size=2)
+        self.assertListEqual([[1, 2], [3, 5], [9]], db._chunk_sids([9, 3, 1, 5, 2, 3]))
+
+        with self.assertRaises(ValueError):
+            WaveformDB(host='localhost', user='scope_rw', password='password', lazy=True, sid_chunk_size=0)
+
+    def test_fan_out(self):
+        """Test that chunked results are merged in sid order, both sequentially and concurrently."""
+        def query(sids, name):
+            return [{'sid': sid, 'name': name} for sid in reversed(sids)]
+
+        for pool_size in (None, 3):
+            db = WaveformDB(host='localhost', user='scope_rw', password='password', lazy=True, pool_size=pool_size,
+                            sid_chunk_size=2)
+            result = db._fan_out(query, list(range(7, 0, -1)), "a")
+            self.assertListEqual([2, 1, 4, 3, 6, 5, 7], [row['sid'] for row in result])
+            self.assertTrue(all(row['name'] == "a" for row in result))
+
+    def test_pivot_scan_metadata(self):
+        """Test that the metadata rows are pivoted into one row per scan with NaN for missing metadata."""
+        rows = [(1, scan_start, 's', 'c', 'on', None), (1, scan_start, 'f', 'a', None, 1.0),
+                (1, scan_start, 'f', 'c', None, 100.0), (2, scan_end, 'f', 'd', None, -10.0),
+                (2, scan_end, 's', 'c', 'off', None)]
+        result = WaveformDB._pivot_scan_metadata(rows)
+
+        self.assertListEqual(['sid', 'scan_start_utc', 's_c', 'f_a', 'f_c', 'f_d'], list(result.columns))
+        self.assertListEqual([1, 2], result.sid.tolist())
+        self.assertListEqual([scan_start, scan_end], result.scan_start_utc.tolist())
+        self.assertListEqual(['on', 'off'], result.s_c.tolist())
+        self.assertEqual(np.float64, result.f_a.dtype)
+        self.assertTrue(np.isnan(result.f_d.values[0]))
+        self.assertEqual(-10.0, result.f_d.values[1])
+
+        result = WaveformDB._pivot_scan_metadata([])
+        self.assertListEqual(['sid', 'scan_start_utc'], list(result.columns))
+        self.assertEqual(0, len(result))
+
+    def test_get_columns(self):
+        """Test that requested waveform columns are validated and put in canonical order."""
+        self.assertEqual(WAVEFORM_FIELDS, WaveformDB._get_columns(None))
+        self.assertEqual(("sid", "cavity"), WaveformDB._get_columns(["cavity", "sid"]))
+        self.assertEqual((), WaveformDB._get_columns([]))
+        with self.assertRaises(ValueError):
+            WaveformDB._get_columns(["cavity", "data"])
+
+    def test_get_cavity_clause(self):
+        """Test that cavity names use IN, glob patterns use LIKE, and that the LIKE wildcards are escaped."""
+        self.assertEqual(("", []), WaveformDB.get_cavity_clause(None))
+        self.assertEqual(("", []), WaveformDB.get_cavity_clause([]))
+        self.assertEqual(("(waveform.cavity IN (%s, %s))", ["1L10-3", "1L10-4"]),
+                         WaveformDB.get_cavity_clause(["1L10-3", "1L10-4"]))
+
+        sql, data = WaveformDB.get_cavity_clause(["2L22*", "1L10-3", "R1?_%"], table="w")
+        self.assertEqual("(w.cavity IN (%s) OR w.cavity LIKE %s OR w.cavity LIKE %s)", sql)
+        self.assertListEqual(["1L10-3", "2L22%", "R1_\\_\\%"], data)
+
+        sql, data = WaveformDB._gen_waveform_data_sql([1, 2], ["GMES"], None, cavities=["2L22*"])
+        self.assertIn("AND (waveform.cavity LIKE %s)", sql)
+        self.assertEqual(sql.count("%s"), len(data))
+        self.assertListEqual([1, 2, "GMES", "2L22%"], data)
+
+    def test_write_scans_lock_mode(self):
+        """Test that scans and waveforms are only batched when the server allocates consecutive IDs."""
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        scans = []
+        for _ in range(3):
+            x = Scan(start=scan_start, end=scan_end)
+            x.add_cavity_data("c1", data={'Time': t, 'GMES': np.cos(t), 'PMES': np.sin(t)}, sampling_rate=5000)
+            scans.append(x)
+
+        cursor = FakeCursor(lock_mode=1)
+        sids = WaveformDB.write_scans(FakeConnection(cursor), scans, partitioned=False)
+        self.assertListEqual([1, 3, 5], sids)
+        self.assertIn(("scan", 3), cursor.inserts)
+        self.assertIn(("waveform", 6), cursor.inserts)
+
+        # Interleaved IDs must be read back one row at a time
+        cursor = FakeCursor(lock_mode=2)
+        sids = WaveformDB.write_scans(FakeConnection(cursor), scans, partitioned=False)
+        self.assertListEqual([1, 23, 45], sids)
+        self.assertListEqual([("scan", 1)] * 3, [item for item in cursor.inserts if item[0] == "scan"])
+        self.assertListEqual([("waveform", 1)] * 6, [item for item in cursor.inserts if item[0] == "waveform"])
+        self.assertIn(("waveform_sdata", 60), cursor.inserts)
+        self.assertListEqual(sids, [x.id for x in scans])
+
+    def test_page_token(self):
+        """Test that continuation tokens round trip and that invalid tokens and limits are rejected."""
+        token = _encode_page_token(scan_start, 42)
+        self.assertEqual((scan_start, 42), _decode_page_token(token))
+        self.assertIsNone(_decode_page_token(None))
+        with self.assertRaises(ValueError):
+            _decode_page_token("not a token")
+
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', lazy=True)
+        with self.assertRaises(ValueError):
+            db.query_scan_rows_page(limit=0)
+        self.assertIsNone(db.conn)
+        db.close()
+
+
 class TestScan(unittest.TestCase):
     """Tests for the Scan class."""
 
@@ -189,3 +464,85 @@ class TestScan(unittest.TestCase):
                 for k in x.analysis_scalar[cavity][signal].keys():
                     self.assertAlmostEqual(scalar_data[cavity][signal][k], x.analysis_scalar[cavity][signal][k],
                                            msg=f"{cavity}-{signal}-{k} has mismatch")
+
+    def test_analyze_signals(self):
+        """Test that the batched analysis matches per-waveform numpy and scipy references."""
+        rng = np.random.default_rng(42)
+        matrix = rng.normal(size=(5, 8192))
+
+        scalars, arrays = Scan.analyze_signals(matrix, sampling_rate=5000)
+        for i in range(matrix.shape[0]):
+            exp_scalars, exp_arrays = reference_analysis(matrix[i], sampling_rate=5000)
+            self.assertSetEqual(set(exp_scalars.keys()), set(scalars.keys()))
+            for k, v in exp_scalars.items():
+                self.assertAlmostEqual(v, scalars[k][i], msg=f"{i}-{k} has mismatch")
+            self.assertTrue(np.allclose(exp_arrays['power_spectrum'], arrays['power_spectrum'][i]))
+
+        # A pure tone at the center of a frequency bin
+        t = np.arange(8192) / 5000
+        scalars, arrays = Scan.analyze_signals(np.cos(2 * np.pi * 5000 * 10 / 8192 * t)[np.newaxis, :])
+        self.assertAlmostEqual(5000 * 10 / 8192, scalars['dominant_frequency'][0])
+        self.assertAlmostEqual(1.0, scalars['peak_to_peak'][0] / 2, places=3)
+        self.assertAlmostEqual(np.sqrt(0.5), scalars['rms'][0])
+        self.assertEqual(4097, arrays['power_spectrum'].shape[1])
+
+        with self.assertRaises(ValueError):
+            Scan.analyze_signals(np.ones((2, 100)))
+        with self.assertRaises(ValueError):
+            Scan.analyze_signals(np.ones(8192))
+
+    def test_add_scan_waveforms(self):
+        """Test that adding many cavities at once stores the expected metrics of every waveform"""
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        data = {
+            "R123": {'Time': t, 'GMES': np.cos(t * 2 * np.pi * 6.103), 'PMES': np.sin(t * 2 * np.pi * 10.0)},
+            "R124": {'Time': t, 'GMES': np.cos(t * 2 * np.pi * 20.0) + 1},
+        }
+        rates = {"R123": 5000, "R124": 2500}
+
+        x = Scan(start=scan_start, end=scan_end)
+        x.add_scan_waveforms(data, sampling_rate=rates)
+
+        self.assertDictEqual(rates, x.sampling_rate)
+        self.assertListEqual([("R123", "GMES"), ("R123", "PMES"), ("R124", "GMES")], sorted(x.get_waveform_keys()))
+        for cavity, signal_name in x.get_waveform_keys():
+            exp_scalars, exp_arrays = reference_analysis(data[cavity][signal_name], rates[cavity])
+            for k, v in exp_scalars.items():
+                self.assertAlmostEqual(v, x.analysis_scalar[cavity][signal_name][k], msg=f"{cavity}-{signal_name}-{k}")
+            self.assertTrue(np.allclose(exp_arrays['power_spectrum'],
+                                        x.analysis_array[cavity][signal_name]['power_spectrum']))
+        self.assertAlmostEqual(1.0, x.analysis_scalar["R124"]["GMES"]["mean"], places=2)
+
+    def test_compute_envelopes(self):
+        """Test that the envelopes hold the min and max of each bucket at every level"""
+        rng = np.random.default_rng(7)
+        matrix = rng.normal(size=(3, 8192))
+
+        envelopes = Scan.compute_envelopes(matrix, levels=(64, 1024, 128))
+        self.assertListEqual(["envelope_1024", "envelope_128", "envelope_64"], sorted(envelopes.keys()))
+        for level in (64, 128, 1024):
+            envelope = envelopes[Scan.envelope_name(level)]
+            buckets = matrix.reshape(3, level, 8192 // level)
+            self.assertTupleEqual((3, 2 * level), envelope.shape)
+            self.assertTrue(np.array_equal(buckets.min(axis=2), envelope[:, 0::2]))
+            self.assertTrue(np.array_equal(buckets.max(axis=2), envelope[:, 1::2]))
+
+        with self.assertRaises(ValueError):
+            Scan.compute_envelopes(matrix, levels=(100,))
+        with self.assertRaises(ValueError):
+            Scan.compute_envelopes(matrix[0])
+
+    def test_add_scan_waveforms_envelopes(self):
+        """Test that envelopes are stored next to the other arrays only when requested"""
+        t = np.linspace(0, 1638.2, 8192) / 1000.0
+        data = {"R123": {'Time': t, 'GMES': np.cos(t * 2 * np.pi * 6.103)}}
+
+        x = Scan(start=scan_start, end=scan_end)
+        x.add_scan_waveforms(data, sampling_rate=5000, envelope_levels=Scan.envelope_levels)
+        self.assertListEqual(["envelope_1024", "envelope_256", "envelope_64", "power_spectrum"],
+                             sorted(x.analysis_array["R123"]["GMES"].keys()))
+        self.assertEqual(1.0, x.analysis_array["R123"]["GMES"]["envelope_64"][1])
+
+        y = Scan(start=scan_start, end=scan_end)
+        y.add_cavity_data("R123", data["R123"], sampling_rate=5000)
+        self.assertListEqual(["power_spectrum"], list(y.analysis_array["R123"]["GMES"].keys()))
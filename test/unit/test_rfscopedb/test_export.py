@@ -0,0 +1,114 @@
+"""Tests for the export.py module."""
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from rfscopedb.export import build_record_batch, build_schema, to_table, write_parquet, pa, ds
+
+scan_start = datetime.strptime("2020-01-01 01:23:45.123456", '%Y-%m-%d %H:%M:%S.%f')
+
+
+def make_rows(sid, wid, cavity, n_samples=16):
+    """Build array and metric rows that look like the results of WaveformDB queries for one waveform."""
+    base = {'sid': sid, 'wid': wid, 'cavity': cavity, 'signal_name': 'GMES', 'sample_rate_hz': 5000.0}
+    raw = np.arange(n_samples, dtype=np.float64) + wid
+    array_rows = [dict(base, name='raw', data=raw),
+                  dict(base, name='power_spectrum', data=raw[:n_samples // 2 + 1] * 2)]
+    metric_rows = [dict(base, mean=float(raw.mean()), maximum=float(raw.max()))]
+    return array_rows, metric_rows
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class TestExport(unittest.TestCase):
+    """Tests for the Arrow conversion and Parquet writer functions."""
+
+    def setUp(self):
+        self.scan_meta = pd.DataFrame({'sid': [1, 2], 'scan_start_utc': [scan_start, scan_start.replace(year=2021)]})
+        self.array_rows = []
+        self.metric_rows = []
+        for sid, wid, cavity in ((1, 10, 'c1'), (1, 11, 'c2'), (2, 12, 'c1')):
+            arrays, metrics = make_rows(sid, wid, cavity)
+            self.array_rows += arrays
+            self.metric_rows += metrics
+
+    def test_build_record_batch(self):
+        """Test that a batch has one row per waveform with list arrays."""
+        batch = build_record_batch(self.scan_meta, self.array_rows, self.metric_rows)
+
+        self.assertEqual(3, batch.num_rows)
+        self.assertListEqual([10, 11, 12], batch.column('wid').to_pylist())
+        self.assertListEqual(['2020-01-01', '2020-01-01', '2021-01-01'], batch.column('date').to_pylist())
+        self.assertEqual(pa.large_list(pa.float64()), batch.schema.field('raw').type)
+        self.assertEqual(pa.large_list(pa.float64()), batch.schema.field('power_spectrum').type)
+        self.assertListEqual([9, 9, 9], batch.column('power_spectrum').value_lengths().to_pylist())
+        self.assertEqual(pa.float64(), batch.schema.field('mean').type)
+
+        raw = np.asarray(batch.column('raw').values).reshape(3, 16)
+        self.assertTrue(np.array_equal(np.arange(16) + 11.0, raw[1]))
+        self.assertListEqual([17.5, 18.5, 19.5], batch.column('mean').to_pylist())
+
+    def test_build_record_batch_schema(self):
+        """Test that a batch conforms to a given schema and marks missing arrays and metrics as null."""
+        schema = build_schema(['raw', 'power_spectrum', 'other'], ['mean', 'maximum', 'minimum'])
+        batch = build_record_batch(self.scan_meta, self.array_rows, self.metric_rows, schema=schema)
+
+        self.assertTrue(schema.equals(batch.schema))
+        self.assertEqual(3, batch.column('other').null_count)
+        self.assertEqual(3, batch.column('minimum').null_count)
+        self.assertEqual(0, batch.column('raw').null_count)
+
+    def test_build_record_batch_mismatch(self):
+        """Test that data which does not fit the schema raises an error instead of being dropped."""
+        schema = build_record_batch(self.scan_meta, [], [], metric_names=['mean', 'maximum']).schema
+        self.assertListEqual(['mean', 'maximum'], schema.names[-2:])
+        with self.assertRaises(ValueError):
+            build_record_batch(self.scan_meta, self.array_rows, self.metric_rows, schema=schema)
+
+        schema = build_schema(['raw', 'power_spectrum'], ['mean'])
+        with self.assertRaises(ValueError):
+            build_record_batch(self.scan_meta, self.array_rows, self.metric_rows, schema=schema)
+
+        schema = build_schema(['raw'], ['mean', 'maximum'])
+        with self.assertRaises(ValueError):
+            build_record_batch(self.scan_meta, self.array_rows, self.metric_rows, schema=schema)
+
+    def test_mixed_lengths(self):
+        """Test that arrays of different lengths share a column within and across batches."""
+        schema = build_record_batch(self.scan_meta, self.array_rows, self.metric_rows).schema
+        array_rows, metric_rows = make_rows(2, 13, 'c2', n_samples=32)
+        batch = build_record_batch(self.scan_meta, self.array_rows + array_rows, self.metric_rows + metric_rows,
+                                   schema=schema)
+        self.assertListEqual([16, 16, 16, 32], batch.column('raw').value_lengths().to_pylist())
+        self.assertTrue(np.array_equal(np.arange(32) + 13.0, batch.column('raw')[3].values.to_numpy()))
+
+        with tempfile.TemporaryDirectory() as path:
+            write_parquet([build_record_batch(self.scan_meta, self.array_rows, self.metric_rows), batch], path)
+            table = ds.dataset(path, format="parquet", partitioning="hive").to_table(columns=['wid', 'raw'])
+        lengths = dict(zip(table.column('wid').to_pylist(), table.column('raw').combine_chunks().value_lengths()))
+        self.assertEqual(32, lengths[13].as_py())
+        self.assertEqual(16, lengths[10].as_py())
+
+    def test_to_table(self):
+        """Test combining batches into a table."""
+        self.assertIsNone(to_table([]))
+        batch = build_record_batch(self.scan_meta, self.array_rows, self.metric_rows)
+        table = to_table([batch, batch])
+        self.assertEqual(6, table.num_rows)
+
+    def test_write_parquet(self):
+        """Test writing a partitioned dataset and reading back a subset of the columns."""
+        batch = build_record_batch(self.scan_meta, self.array_rows, self.metric_rows)
+        with tempfile.TemporaryDirectory() as path:
+            write_parquet([batch], path)
+            dataset = ds.dataset(path, format="parquet", partitioning="hive")
+            table = dataset.to_table(columns=['wid', 'raw'], filter=ds.field('cavity') == 'c1')
+
+            # Exports are never mixed into an existing dataset
+            with self.assertRaises(FileExistsError):
+                write_parquet([batch], path)
+
+        self.assertListEqual([10, 12], sorted(table.column('wid').to_pylist()))
+        self.assertListEqual([16, 16], table.column('raw').combine_chunks().value_lengths().to_pylist())
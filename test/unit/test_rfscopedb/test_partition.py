@@ -0,0 +1,78 @@
+"""Tests for the partition.py module."""
+import unittest
+from datetime import datetime, timezone, timedelta
+
+from rfscopedb.db import WaveformDB
+from rfscopedb.partition import (PARTITIONED_TABLES, gen_partition_definitions, gen_partition_statements, month_start,
+                                 partition_name)
+
+
+class TestPartition(unittest.TestCase):
+    """Tests for generating the partitioning DDL."""
+
+    def test_month_start(self):
+        """Test finding and shifting the start of a month."""
+        self.assertEqual(datetime(2024, 2, 1), month_start(datetime(2024, 2, 29, 23, 59)))
+        self.assertEqual(datetime(2025, 1, 1), month_start(datetime(2024, 12, 15), 1))
+        self.assertEqual(datetime(2023, 11, 1), month_start(datetime(2024, 1, 15), -2))
+        # Aware times are converted to UTC first
+        eastern = timezone(timedelta(hours=-4))
+        self.assertEqual(datetime(2024, 3, 1), month_start(datetime(2024, 2, 29, 22, tzinfo=eastern)))
+        self.assertEqual("p202402", partition_name(datetime(2024, 2, 10)))
+
+    def test_gen_partition_definitions(self):
+        """Test that each month gets a partition between pold and pmax."""
+        defs = gen_partition_definitions(datetime(2024, 11, 5), datetime(2025, 1, 20))
+        self.assertListEqual([
+            "PARTITION pold VALUES LESS THAN ('2024-11-01 00:00:00')",
+            "PARTITION p202411 VALUES LESS THAN ('2024-12-01 00:00:00')",
+            "PARTITION p202412 VALUES LESS THAN ('2025-01-01 00:00:00')",
+            "PARTITION p202501 VALUES LESS THAN ('2025-02-01 00:00:00')",
+            "PARTITION pmax VALUES LESS THAN (MAXVALUE)",
+        ], defs)
+
+        defs = gen_partition_definitions(datetime(2025, 2, 1), datetime(2025, 1, 1), include_old=False)
+        self.assertListEqual(["PARTITION pmax VALUES LESS THAN (MAXVALUE)"], defs)
+
+    def test_gen_partition_statements(self):
+        """Test that foreign keys are dropped and children are backfilled before any table is partitioned."""
+        statements = gen_partition_statements([("waveform", "waveform_ibfk_1")], datetime(2024, 1, 1),
+                                              datetime(2024, 3, 1))
+        self.assertEqual("ALTER TABLE waveform DROP FOREIGN KEY waveform_ibfk_1", statements[0])
+
+        backfill = statements.index("UPDATE waveform_adata JOIN waveform ON waveform_adata.wid = waveform.wid "
+                                    "SET waveform_adata.scan_start_utc = waveform.scan_start_utc")
+        self.assertLess(statements.index("UPDATE waveform JOIN scan ON waveform.sid = scan.sid "
+                                         "SET waveform.scan_start_utc = scan.scan_start_utc"), backfill)
+
+        partitioned = [stmt.split()[2] for stmt in statements if "PARTITION BY RANGE COLUMNS (scan_start_utc)" in stmt]
+        self.assertListEqual(list(PARTITIONED_TABLES), partitioned)
+        self.assertGreater(statements.index(next(stmt for stmt in statements if "PARTITION BY" in stmt)), backfill)
+        self.assertIn("ALTER TABLE scan DROP PRIMARY KEY, ADD PRIMARY KEY (sid, scan_start_utc)", statements)
+        self.assertIn("ALTER TABLE waveform_sdata MODIFY scan_start_utc DATETIME(6) NOT NULL, DROP PRIMARY KEY, "
+                      "ADD PRIMARY KEY (wsdid, scan_start_utc)", statements)
+
+
+class TestPartitionPruning(unittest.TestCase):
+    """Tests for the predicates that allow partition pruning."""
+
+    def test_gen_waveform_data_sql(self):
+        """Test that both tables are limited to the scans' time range."""
+        # pylint: disable=protected-access
+        time_range = (datetime(2024, 1, 1), datetime(2024, 2, 1))
+        sql, data = WaveformDB._gen_waveform_data_sql([1, 2], ["GMES"], None, time_range=time_range)
+        self.assertIn("waveform.scan_start_utc BETWEEN %s AND %s AND waveform_adata.scan_start_utc BETWEEN %s AND %s",
+                      sql)
+        self.assertEqual(sql.count("%s"), len(data))
+        self.assertListEqual([1, 2, "GMES", *time_range, *time_range], data)
+
+        sql, data = WaveformDB._gen_waveform_data_sql([1, 2], None, None)
+        self.assertNotIn("scan_start_utc", sql)
+        self.assertListEqual([1, 2], data)
+
+    def test_get_scan_time_clauses(self):
+        """Test comparing the start time of a child table to constants."""
+        tests, data = WaveformDB.get_scan_time_clauses(datetime(2024, 1, 1, tzinfo=timezone.utc), None,
+                                                       table="scan_fdata")
+        self.assertListEqual(["scan_fdata.scan_start_utc >= %s"], tests)
+        self.assertListEqual(["2024-01-01 00:00:00.000000"], data)
@@ -0,0 +1,214 @@
+"""Tests for the planner.py module."""
+import time
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from rfscopedb.db import FilterGroup, QueryFilter, WaveformDB, WaveformMetricFilter
+from rfscopedb.planner import FilterPlanner, MetadataStats
+
+
+def make_planner():
+    """Build a planner with statistics for 1000 scans spread over 2020 without querying a database."""
+    planner = FilterPlanner(n_buckets=4)
+    planner.n_scans = 1000
+    planner.scan_start_range = (datetime(2020, 1, 1), datetime(2021, 1, 1))
+
+    # 'a' is uniform over [0, 100] and every scan has it
+    a = MetadataStats("a", "scan_fdata", n_rows=1000, n_distinct=1000, min_value=0.0, max_value=100.0)
+    a.bucket_edges = [0.0, 25.0, 50.0, 75.0, 100.0]
+    a.bucket_counts = [250, 250, 250, 250]
+    # 'b' is rare
+    b = MetadataStats("b", "scan_fdata", n_rows=10, n_distinct=2, min_value=1.0, max_value=2.0)
+    b.bucket_edges = [1.0, 1.25, 1.5, 1.75, 2.0]
+    b.bucket_counts = [5, 0, 0, 5]
+    c = MetadataStats("c", "scan_sdata", n_rows=1000, n_distinct=2, min_value="off", max_value="on")
+    c.value_counts = {"on": 900, "off": 100}
+
+    planner.stats = {(item.table, item.name): item for item in (a, b, c)}
+    planner.loaded_at = time.monotonic()
+    return planner
+
+
+class StatsCursor:
+    """Answers the statistics queries with one scan and one float metadata name."""
+
+    def __init__(self):
+        self._sql = ""
+
+    def execute(self, sql, data=None):  # pylint: disable=unused-argument
+        """Remember the statement so the fetch methods can answer it."""
+        self._sql = sql
+
+    def fetchone(self):
+        """Return the scan count and time range."""
+        return 1, datetime(2020, 1, 1), datetime(2020, 1, 1)
+
+    def fetchall(self):
+        """Return the rows for the last statement."""
+        if "bucket" in self._sql:
+            return [("a", None, 1)]
+        if "FROM scan_fdata GROUP BY name" in self._sql:
+            return [("a", 1, 1, 5.0, 5.0)]
+        return []
+
+    def close(self):
+        """Nothing to release."""
+
+
+class StatsConnection:
+    """A shared connection that records whether its read transaction was ended."""
+
+    def __init__(self):
+        self.rolled_back = False
+
+    def cursor(self):
+        """Return a cursor with canned statistics."""
+        return StatsCursor()
+
+    def rollback(self):
+        """Record the rollback."""
+        self.rolled_back = True
+
+
+class StatsWaveformDB(WaveformDB):
+    """A lazy database whose connection is a StatsConnection."""
+
+    def __init__(self):
+        super().__init__(host='localhost', user='scope_rw', password='password', lazy=True)
+        self.stats_conn = StatsConnection()
+
+    @contextmanager
+    def connection(self):
+        yield self.stats_conn
+
+
+class TestMetadataStats(unittest.TestCase):
+    """Tests for the MetadataStats class."""
+
+    def test_estimate_rows(self):
+        """Test the row estimates of each kind of comparison."""
+        planner = make_planner()
+        a = planner.stats[("scan_fdata", "a")]
+        self.assertAlmostEqual(375.0, a.estimate_rows("<", 37.5))
+        self.assertAlmostEqual(625.0, a.estimate_rows(">=", 37.5))
+        self.assertEqual(0.0, a.estimate_rows("<", -1.0))
+        self.assertEqual(1000.0, a.estimate_rows("<=", 200.0))
+        self.assertEqual(1.0, a.estimate_rows("=", 50.0))
+        self.assertEqual(0.0, a.estimate_rows("=", 101.0))
+        self.assertEqual(1000.0, a.estimate_rows("!=", 101.0))
+
+        c = planner.stats[("scan_sdata", "c")]
+        self.assertEqual(100.0, c.estimate_rows("=", "off"))
+        self.assertEqual(900.0, c.estimate_rows("!=", "off"))
+        self.assertEqual(0.0, c.estimate_rows("=", "unknown"))
+
+    def test_estimate_rows_ops(self):
+        """Test the row estimates of IN, BETWEEN and PREFIX."""
+        planner = make_planner()
+        a = planner.stats[("scan_fdata", "a")]
+        self.assertAlmostEqual(250.0, a.estimate_rows("BETWEEN", (25.0, 50.0)))
+        self.assertEqual(0.0, a.estimate_rows("BETWEEN", (200.0, 300.0)))
+        self.assertEqual(2.0, a.estimate_rows("IN", [10.0, 20.0, 20.0]))
+
+        c = planner.stats[("scan_sdata", "c")]
+        self.assertEqual(1000.0, c.estimate_rows("IN", ["on", "off", "unknown"]))
+        self.assertEqual(100.0, c.estimate_rows("PREFIX", "of"))
+        self.assertEqual(100.0, c.estimate_rows("BETWEEN", ("a", "off")))
+
+        d = MetadataStats("d", "scan_sdata", n_rows=300, n_distinct=300, min_value="a", max_value="m")
+        self.assertEqual(0.0, d.estimate_rows("PREFIX", "z"))
+        self.assertEqual(100.0, d.estimate_rows("PREFIX", "b"))
+
+    def test_estimate_time_range(self):
+        """Test that scans are assumed to be spread evenly over time."""
+        planner = make_planner()
+        self.assertEqual(1000.0, planner.estimate_time_range(None, None))
+        begin = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        end = datetime(2020, 2, 1, tzinfo=timezone.utc)
+        self.assertAlmostEqual(1000.0 * 31 / 366, planner.estimate_time_range(begin, end))
+        self.assertEqual(0.0, planner.estimate_time_range(datetime(2022, 1, 1, tzinfo=timezone.utc), None))
+
+
+class TestFilterPlanner(unittest.TestCase):
+    """Tests for the FilterPlanner class."""
+
+    def test_plan_terms(self):
+        """Test that terms are ordered by selectivity and that unselective terms use EXISTS."""
+        planner = make_planner()
+        q_filter = QueryFilter(["a", "c", "b", "missing"], [">", "=", "<", "="], [10.0, "on", 1.5, 1.0])
+        terms = planner.plan_terms(None, None, q_filter)
+
+        # The unknown name matches nothing, so it drives the query and ends it right away
+        self.assertListEqual(["missing", "b", "a", "c"], [term.name for term in terms])
+        self.assertListEqual(["drive", "exists", "exists", "exists"], [term.strategy for term in terms])
+
+        # A narrow time range is more selective than any term
+        begin = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        end = datetime(2020, 1, 2, tzinfo=timezone.utc)
+        terms = planner.plan_terms(begin, end, QueryFilter(["a", "b"], [">", "<"], [10.0, 1.5]))
+        self.assertListEqual(["b", "a"], [term.name for term in terms])
+        self.assertListEqual(["exists", "exists"], [term.strategy for term in terms])
+
+        # Terms matching no more rows than the driver are joined
+        terms = planner.plan_terms(None, None, QueryFilter(["c", "b", "b"], ["=", "=", "<"], ["off", 2.0, 1.5]))
+        self.assertListEqual(["b", "b", "c"], [term.name for term in terms])
+        self.assertListEqual(["drive", "join", "exists"], [term.strategy for term in terms])
+
+        self.assertListEqual([], planner.plan_terms(None, None, None))
+
+        # A group is planned as a whole.  OR groups match up to the sum of their terms.
+        group = FilterGroup("OR", [("b", "=", 1.0), FilterGroup("AND", [("a", "<", 10.0), ("c", "=", "off")])])
+        self.assertAlmostEqual(5.0 + 100.0, planner.estimate_group(group))
+        terms = planner.plan_terms(None, None, QueryFilter(["a"], ["BETWEEN"], [(0.0, 50.0)], groups=[group]))
+        self.assertListEqual(["OR", "BETWEEN"], [term.op for term in terms])
+        self.assertListEqual(["drive", "exists"], [term.strategy for term in terms])
+
+    def test_refresh(self):
+        """Test that the statistics are loaded and the read transaction is not left open."""
+        planner = FilterPlanner(n_buckets=4)
+        db = StatsWaveformDB()
+        planner.refresh(db)
+
+        self.assertTrue(db.stats_conn.rolled_back)
+        self.assertEqual(1, planner.n_scans)
+        self.assertListEqual([1, 0, 0, 0], planner.stats[("scan_fdata", "a")].bucket_counts)
+
+    def test_gen_from_clause(self):
+        """Test that the placeholders and data line up in the generated SQL."""
+        planner = make_planner()
+        db = WaveformDB(host='localhost', user='scope_rw', password='password', lazy=True)
+        begin = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+        sql, data = planner.gen_from_clause(db, begin, None, QueryFilter(["a", "b"], [">", "<"], [10.0, 1.5]))
+        self.assertTrue(sql.startswith("FROM (SELECT scan_fdata.sid FROM scan_fdata WHERE name = %s and value < %s)"))
+        self.assertIn("STRAIGHT_JOIN scan ON scan.sid = s0.sid", sql)
+        self.assertIn("WHERE scan.scan_start_utc >= %s AND EXISTS", sql)
+        self.assertEqual(sql.count("%s"), len(data))
+        self.assertListEqual(["b", 1.5, "2020-01-01 00:00:00.000000", "a", 10.0], data)
+
+        sql, data = planner.gen_from_clause(db, None, None, None)
+        self.assertEqual("FROM scan \n", sql)
+        self.assertListEqual([], data)
+
+        group = FilterGroup("OR", [("c", "IN", ["off"]), ("b", "PREFIX", "x")])
+        sql, data = planner.gen_from_clause(db, None, None, QueryFilter(["a"], ["BETWEEN"], [(0.0, 100.0)],
+                                                                        groups=[group]))
+        self.assertTrue(sql.startswith("FROM (SELECT scan_sdata.sid FROM scan_sdata WHERE name = %s and value IN "
+                                       "(%s) UNION SELECT scan_sdata.sid FROM scan_sdata WHERE name = %s and "
+                                       "value LIKE %s)"))
+        self.assertIn("WHERE EXISTS (SELECT 1 FROM scan_fdata WHERE scan_fdata.sid = scan.sid AND name = %s AND "
+                      "value BETWEEN %s AND %s)", sql)
+        self.assertEqual(sql.count("%s"), len(data))
+        self.assertListEqual(["c", "off", "b", "x%", "a", 0.0, 100.0], data)
+
+        # Waveform metric conditions follow the planned terms
+        # pylint: disable=protected-access
+        db._partitioned = False
+        metric_filter = WaveformMetricFilter(["1L10-3"], ["GMES"], ["rms"], [">"], [0.2])
+        sql, data = planner.gen_from_clause(db, None, None, QueryFilter(["b"], ["<"], [1.5]),
+                                            metric_filter=metric_filter)
+        self.assertTrue(sql.endswith("waveform_sdata.value > %s)"))
+        self.assertEqual(sql.count("%s"), len(data))
+        self.assertListEqual(["b", 1.5, "GMES", "1L10-3", "rms", 0.2], data)
+        db.close()
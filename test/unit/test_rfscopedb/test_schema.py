@@ -0,0 +1,48 @@
+"""Tests for the schema.py module."""
+import unittest
+
+from rfscopedb.schema import (LATEST_VERSION, MIGRATIONS, is_redundant_index, parse_create_index,
+                              pending_migrations)
+
+
+class TestMigrations(unittest.TestCase):
+    """Tests for the list of migrations."""
+
+    def test_versions(self):
+        """Test that the migrations are numbered consecutively from one."""
+        self.assertListEqual(list(range(1, len(MIGRATIONS) + 1)), [migration.version for migration in MIGRATIONS])
+        self.assertEqual(MIGRATIONS[-1].version, LATEST_VERSION)
+        for migration in MIGRATIONS:
+            self.assertGreater(len(migration.statements), 0)
+
+    def test_pending_migrations(self):
+        """Test selecting the migrations between two versions."""
+        self.assertListEqual(list(MIGRATIONS), pending_migrations(0))
+        self.assertListEqual([], pending_migrations(LATEST_VERSION))
+        self.assertListEqual([MIGRATIONS[1]], pending_migrations(1, 2))
+
+        with self.assertRaises(ValueError):
+            pending_migrations(2, 1)
+        with self.assertRaises(ValueError):
+            pending_migrations(0, LATEST_VERSION + 1)
+
+    def test_parse_create_index(self):
+        """Test parsing the CREATE INDEX statements of the migrations."""
+        self.assertTupleEqual(("i_scan_fdata_name_value", "scan_fdata", ["name", "value", "sid"]),
+                              parse_create_index(MIGRATIONS[1].statements[0]))
+        self.assertTupleEqual(("i", "t", ["a"]), parse_create_index("  create index i on t (a)"))
+        self.assertIsNone(parse_create_index("ALTER TABLE waveform_adata MODIFY data LONGBLOB NOT NULL"))
+        for migration in MIGRATIONS[1:]:
+            for statement in migration.statements:
+                if statement.upper().startswith("CREATE INDEX"):
+                    self.assertIsNotNone(parse_create_index(statement), msg=statement)
+
+    def test_is_redundant_index(self):
+        """Test that an index is redundant only if an existing index starts with the same columns."""
+        indexes = {"PRIMARY": ["sfid"], "sid": ["sid"], "by_name": ["NAME", "value", "sid"]}
+        self.assertTrue(is_redundant_index(["name", "value", "sid"], indexes))
+        self.assertTrue(is_redundant_index(["name", "value"], indexes))
+        self.assertTrue(is_redundant_index(["sid"], indexes))
+        self.assertFalse(is_redundant_index(["sid", "name"], indexes))
+        self.assertFalse(is_redundant_index(["value", "name"], indexes))
+        self.assertFalse(is_redundant_index(["name"], {}))
@@ -0,0 +1,25 @@
+"""Tests for the utils.py module."""
+import unittest
+
+import numpy as np
+from scipy.signal import periodogram
+
+from rfscopedb.utils import get_frequency_range
+
+
+class TestGetFrequencyRange(unittest.TestCase):
+    """Tests for the get_frequency_range function."""
+
+    def test_matches_periodogram(self):
+        """Test that the frequencies match the distribution supplied by scipy's periodogram."""
+        for fs, n in ((5000.0, 8192), (317.2, 4101), (1.0, 17)):
+            exp, _ = periodogram(np.ones(n), fs)
+            self.assertTrue(np.allclose(exp, get_frequency_range(fs, n)), msg=f"fs={fs}, n={n}")
+
+    def test_cached_read_only(self):
+        """Test that repeated calls share a single read-only array."""
+        result = get_frequency_range(5000.0, 8192)
+        self.assertIs(result, get_frequency_range(5000.0, 8192))
+        self.assertFalse(result.flags.writeable)
+        with self.assertRaises(ValueError):
+            result[0] = 1.0
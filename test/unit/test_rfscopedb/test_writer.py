@@ -0,0 +1,77 @@
+"""Tests for the writer.py module."""
+import threading
+import unittest
+from datetime import datetime
+
+from rfscopedb.data_model import Scan
+from rfscopedb.writer import AsyncScanWriter
+
+scan_start = datetime.strptime("2020-01-01 01:23:45.123456", '%Y-%m-%d %H:%M:%S.%f')
+scan_end = datetime.strptime("2020-01-01 01:23:55.123456", '%Y-%m-%d %H:%M:%S.%f')
+
+
+class FailingWriter(AsyncScanWriter):
+    """A writer whose workers fail unexpectedly once release is set.  Never connects to a database."""
+
+    def __init__(self, **kwargs):
+        self.release = threading.Event()
+        super().__init__(host='localhost', user='nobody', password='nothing', lazy=True, **kwargs)
+
+    def _write_group(self, db, group):
+        self.release.wait(timeout=10)
+        raise ValueError("worker failure")
+
+
+class TestAsyncScanWriter(unittest.TestCase):
+    """Tests for the AsyncScanWriter class that do not need a database."""
+
+    def test_creation_checks(self):
+        """Test that invalid sizes are rejected before connecting."""
+        for kwargs in ({'workers': 0}, {'max_queue_size': 0}, {'max_group_size': 0}, {'batch_size': 0}):
+            with self.assertRaises(ValueError, msg=str(kwargs)):
+                AsyncScanWriter(host='localhost', user='nobody', password='nothing', lazy=True, **kwargs)
+
+    def test_worker_failure(self):
+        """Test that a failed worker fails its scans and is surfaced by submit and close."""
+        writer = FailingWriter()
+        writer.release.set()
+        future = writer.submit(Scan(start=scan_start, end=scan_end))
+        self.assertIsInstance(future.exception(timeout=10), ValueError)
+
+        # pylint: disable=protected-access
+        writer._threads[0].join(timeout=10)
+        with self.assertRaises(RuntimeError) as context:
+            writer.submit(Scan(start=scan_start, end=scan_end))
+        self.assertIsInstance(context.exception.__cause__, ValueError)
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+    def test_blocked_submit(self):
+        """Test that a submit blocked on a full queue does not hang once the workers die."""
+        writer = FailingWriter(max_queue_size=1)
+        futures = [writer.submit(Scan(start=scan_start, end=scan_end))]
+        while writer.qsize() > 0:
+            # Wait for the worker to take the first scan so that the second fills the queue
+            threading.Event().wait(0.01)
+        futures.append(writer.submit(Scan(start=scan_start, end=scan_end)))
+
+        outcome = []
+
+        def submit():
+            try:
+                outcome.append(writer.submit(Scan(start=scan_start, end=scan_end)).exception(timeout=10))
+            except RuntimeError as e:
+                outcome.append(e)
+
+        thread = threading.Thread(target=submit, daemon=True)
+        thread.start()
+        writer.release.set()
+        thread.join(timeout=10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, len(outcome))
+        self.assertIsInstance(outcome[0], (RuntimeError, ValueError))
+        for future in futures:
+            self.assertIsNotNone(future.exception(timeout=10))
+        with self.assertRaises(RuntimeError):
+            writer.close()